@@ -6,7 +6,8 @@ import puf_extrapolate_custom as xc
 import puf_utilities as pu
 
 
-def advance_puf(puf, year, savepath):
+def advance_puf(puf, year, savepath, profile='full'):
+    # profile: tax-calculator output profile to save, see pu.tc_dataframe
     print('creating records object...')
     recs = tc.Records(data=puf, start_year=2011)  # start_year not needed for puf.csv
     pol = tc.Policy()
@@ -15,7 +16,7 @@ def advance_puf(puf, year, savepath):
     calc.advance_to_year(year)
     print(f'calculating policy for {year}...')
     calc.calc_all()
-    pufdf = calc.dataframe(variable_list=[], all_vars=True)
+    pufdf = pu.tc_dataframe(calc, profile)
     pufdf['pid'] = np.arange(len(pufdf))
     pufdf['filer'] = pu.filers(pufdf)
 
@@ -25,16 +26,24 @@ def advance_puf(puf, year, savepath):
     return None
 
 
-def advance_puf_custom(puf, year, gfcustom, gfones, weights, savepath):
+def advance_puf_custom(puf, year, gfcustom, gfones, weights, savepath, profile='full'):
     # extrapolate the underlying data with custom growfactors, BEFORE creating Records object
     # then create record objects with a dummy set of growfactors equal to one so that
     # tax-calculator won't extrapolate further (i.e., again)
 
     gfactor_custom = pd.read_csv(gfcustom)
-    gfactor_ones = tc.GrowFactors(gfones)
     print(f'extrapolating puf to {year} with custom growfactors...')
     puf_extrap = xc.extrapolate_custom(puf, gfactor_custom, year)
+    advance_puf_extrapolated(puf_extrap, year, gfones, weights, savepath, profile)
+    return None
 
+
+def advance_puf_extrapolated(puf_extrap, year, gfones, weights, savepath, profile='full'):
+    # create records from a puf that has already been extrapolated to year with
+    # custom growfactors (e.g., by xc.extrapolate_custom or, for several years
+    # at once, xc.extrapolate_custom_years and xc.read_extrapolated_year),
+    # calculate, and save
+    gfactor_ones = tc.GrowFactors(gfones)
     print('creating records object and advancing with dummy growfactors...')
     recs_extrap = tc.Records(data=puf_extrap,
                   start_year=2011,
@@ -46,9 +55,9 @@ def advance_puf_custom(puf, year, gfcustom, gfones, weights, savepath):
     calc_extrap = tc.Calculator(policy=pol, records=recs_extrap)
     calc_extrap.advance_to_year(year)
     calc_extrap.calc_all()
-    pufdf_custom = calc_extrap.dataframe(variable_list=[], all_vars=True)
+    pufdf_custom = pu.tc_dataframe(calc_extrap, profile)
     pufdf_custom['pid'] = np.arange(len(pufdf_custom))
-    pufdf_custom['filer'] = pu.filers(pufdf_custom)
+    pufdf_custom['filer'] = pu.filers(pufdf_custom, year=year)
     print(f'saving the custom-grown puf to {savepath}')
     pufdf_custom.to_parquet(savepath, engine='pyarrow')
     return None
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Exact derivatives of the least-squares geoweighting objective (f in
+puf_geoweight.py). x is whs.flatten(), h x s record-major; f is quadratic,
+so the hessian is constant and block diagonal by state.
+"""
+
+# %% imports
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+
+
+# %% objective and gradient
+def diffs(x, xmat, targets):
+    # s x k differences between the weighted sums and the targets
+    whs = x.reshape((xmat.shape[0], targets.shape[0]))
+    return whs.T @ xmat - targets
+
+
+def objective(x, xmat, targets, objscale, diff_weights):
+    return np.square(diffs(x, xmat, targets) * diff_weights).sum() * objscale
+
+
+def gradient(x, xmat, targets, objscale, diff_weights):
+    # df/dwhs = 2 * objscale * xmat @ (diffs * diff_weights**2).T, h x s
+    dw2 = np.square(diff_weights)
+    grad = 2 * objscale * xmat @ (diffs(x, xmat, targets) * dw2).T
+    return grad.ravel()
+
+
+def objective_and_gradient(x, xmat, targets, objscale, diff_weights):
+    # for minimize(..., jac=True): the differences are computed once
+    dw2 = np.square(diff_weights)
+    d = diffs(x, xmat, targets)
+    obj = np.sum(np.square(d) * dw2) * objscale
+    grad = 2 * objscale * xmat @ (d * dw2).T
+    return obj, grad.ravel()
+
+
+# %% hessian
+def hessp(x, p, xmat, targets, objscale, diff_weights):
+    # Hessian times p: for each state j, H_j @ P[:, j] where P is p as h x s;
+    # all states at once as two products with xmat
+    P = p.reshape((xmat.shape[0], targets.shape[0]))
+    Hp = 2 * objscale * xmat @ ((xmat.T @ P) * np.square(diff_weights).T)
+    return Hp.ravel()
+
+
+def hess_diag(xmat, targets, objscale, diff_weights):
+    # diagonal of the Hessian, in x order
+    return (2 * objscale * np.square(xmat) @ np.square(diff_weights).T).ravel()
+
+
+def hess_blocks(xmat, objscale, diff_weights):
+    # s x h x h, block j is 2 * objscale * xmat @ diag(diff_weights[j]**2) @ xmat.T
+    # s * h^2 values, so small stubs or a few states only
+    h = xmat.shape[0]
+    s = diff_weights.shape[0]
+    blocks = np.empty((s, h, h))
+    for j in range(s):
+        xw = xmat * (np.sqrt(2 * objscale) * diff_weights[j])
+        blocks[j] = xw @ xw.T
+    return blocks
+
+
+def hess_operator(xmat, targets, objscale, diff_weights):
+    # the Hessian as a LinearOperator, e.g., for trust-constr's hess option
+    # (hess=lambda x, *args: op) or for scipy.sparse.linalg solvers
+    n = xmat.shape[0] * targets.shape[0]
+    matvec = lambda p: hessp(None, p, xmat, targets, objscale, diff_weights)
+    return LinearOperator((n, n), matvec=matvec, rmatvec=matvec, dtype=float)
+
+
+def hess_structure(h, s):
+    # lower triangle indexes in x order, (i * s + j, i2 * s + j) with i >= i2,
+    # for ipopt's hessianstructure
+    ii, i2 = np.tril_indices(h)
+    states = np.arange(s).repeat(ii.size)
+    rows = np.tile(ii, s) * s + states
+    cols = np.tile(i2, s) * s + states
+    return rows, cols
+
+
+def hess_lower(xmat, objscale, diff_weights):
+    # (rows, cols, values) of the lower triangle; constant, so an ipopt hessian
+    # callback can compute it once and return obj_factor * values
+    h = xmat.shape[0]
+    s = diff_weights.shape[0]
+    rows, cols = hess_structure(h, s)
+    ii, i2 = np.tril_indices(h)
+    values = np.concatenate([block[ii, i2] for block in hess_blocks(xmat, objscale, diff_weights)])
+    return rows, cols, values
@@ -5,10 +5,17 @@ Created on Mon Nov 16 11:58:25 2020
 @author: donbo
 """
 
+import hashlib
+import json
+import os
 import sys
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from timeit import default_timer as timer
 
+import puf_constants as pc
 import puf_utilities as pu
 # microweight - apparently we have to tell python where to find this
 sys.path.append('c:/programs_python/weighting/')  # needed
@@ -16,7 +23,11 @@ import src.microweight as mw
 
 
 def collapse_ht2(ht2_path, compstates):
+    # compstates='all' keeps every area in pc.STATES_DCPROA as its own group
+    # (53 groups, no 'other') for all-states geoweighting
     ht2_shares = pd.read_csv(ht2_path)
+    if isinstance(compstates, str) and compstates == 'all':
+        compstates = pc.STATES_DCPROA
 
     # collapse target shares to these states and all others
     m_states = ht2_shares.state.isin(compstates)
@@ -35,6 +46,23 @@ def get_geo_weights(df, weightdf, targvars, ht2wide, dropsdf_wide,
 
     print(f'\nIncome stub {df.name:3d}')
     stub = df.name
+
+    pufstub, prob = geo_stub_problem(df, stub, weightdf, targvars, ht2wide, dropsdf_wide,
+                                     independent, options)
+
+    whs_opt = geo_stub_solve(prob['wh'], prob['xmat'], prob['targets'],
+                             geomethod, prob['options'], prob['Q'])
+    if prob['qstore'] is not None:
+        qstore_save(prob['qstore'], targvars, prob['sts'], stub, pufstub.pid, whs_opt)
+    return geo_stub_result(pufstub, whs_opt, prob['sts'], stub, intermediate_path)
+
+
+def geo_stub_problem(df, stub, weightdf, targvars, ht2wide, dropsdf_wide,
+                     independent, options):
+    # get the records and the arrays that define the geoweighting problem for
+    # a single ht2 stub; returns the stub records (pid, ht2_stub, weight, targvars)
+    # and a dict with wh, xmat, targets, sts (state groups), Q, options, and
+    # qstore (the Q warm-start store directory, or None)
     qx = '(ht2_stub == @stub)'
 
     # create local copy of weights with proper names
@@ -44,7 +72,7 @@ def get_geo_weights(df, weightdf, targvars, ht2wide, dropsdf_wide,
 
 
     # df = df.copy().drop(columns='weight', errors='ignore')
-    df['ht2_stub'] = df.name
+    df['ht2_stub'] = stub
     df = df.drop(columns='weight', errors='ignore')
     df = pd.merge(df, weightdf, how='left', on='pid')
 
@@ -62,8 +90,6 @@ def get_geo_weights(df, weightdf, targvars, ht2wide, dropsdf_wide,
     dropsdf_stub = dropsdf_wide.query(qx)[['stgroup'] + targvars]
     drops = np.asarray(dropsdf_stub[targvars], dtype=bool)  # True means we drop
 
-    stub_prob = mw.Microweight(wh=wh, xmat=xmat, geotargets=targets)
-
     # call the solver
     options_defaults = {'drops': drops, 'independent': independent, 'qmax_iter': 20}
     options_all = options_defaults.copy()
@@ -80,24 +106,53 @@ def get_geo_weights(df, weightdf, targvars, ht2wide, dropsdf_wide,
     #     init_shares = (targetsdf.nret_all / targetsdf.nret_all.sum()).to_numpy()
     #     Q_init = np.tile(init_shares, (wh.size, 1))
 
+    # a Q store warm start is used when there is no qshares and the store has
+    # Q for these targvars and state groups
+    qstore = options_all.pop('qstore', None)
+    Q_stored = None
+    if qstore is not None and options_all.get('qshares') is None:
+        Q_stored = qstore_load(qstore, targvars, sts, stub, pufstub.pid)
+
     if 'qshares' in options_all and options_all['qshares'] is not None:
         print('qshares found and is not None')
         # create matrix from passed-in dataframe
         qshares = options_all['qshares']
         qshares = qshares.query(qx).drop(columns=['pid', 'ht2_stub'])
         Q_init = qshares.to_numpy()
+    elif Q_stored is not None:
+        print('Q warm start found in qstore')
+        Q_init = Q_stored
     else:
         print('qshares not found or is found but None')
         # create initial Q, is n x m (# of households) x (# of areas)
         init_shares = (targetsdf.nret_all / targetsdf.nret_all.sum()).to_numpy()
         Q_init = np.tile(init_shares, (wh.size, 1))
 
-    # print(Q_init.shape)
-    options_all['Q'] = Q_init
+    # the Q matrix is passed to the solver separately
+    options_all.pop('qshares', None)
+
+    prob = {'wh': wh, 'xmat': xmat, 'targets': targets, 'sts': sts,
+            'Q': Q_init, 'options': options_all, 'qstore': qstore}
+    return pufstub, prob
 
-    gw = stub_prob.geoweight(method=geomethod, options=options_all)
+
+def geo_stub_solve(wh, xmat, targets, geomethod, options, Q):
+    # solve a single stub problem and return the n x m matrix of state weights
+    stub_prob = mw.Microweight(wh=wh, xmat=xmat, geotargets=targets)
+
+    options = options.copy()
+    options['Q'] = Q
+    # print(Q.shape)
+
+    gw = stub_prob.geoweight(method=geomethod, options=options)
     # gw = stub_prob.geoweight(method='poisson', user_options=uo)
-    whsdf = pd.DataFrame(gw.whs_opt, columns=sts)
+    return gw.whs_opt
+
+
+def geo_stub_result(pufstub, whs_opt, sts, stub, intermediate_path=None):
+    # put the state weights for a stub into the pid, ht2_stub, weight,
+    # geoweight_sum, <states> layout
+    whsdf = pd.DataFrame(whs_opt, columns=sts)
     whsdf['geoweight_sum'] = whsdf.sum(axis=1)
     whsdf = whsdf[['geoweight_sum'] + sts]
     df2 = pd.concat([pufstub[['pid', 'ht2_stub', 'weight']],
@@ -108,4 +163,176 @@ def get_geo_weights(df, weightdf, targvars, ht2wide, dropsdf_wide,
     return df2
 
 
+# %% parallel geoweighting
+def get_geo_weights_parallel(pufsub, weightdf, targvars, ht2wide, dropsdf_wide,
+                             independent,
+                             geomethod,
+                             options,
+                             workers=4,
+                             intermediate_path=None):
+    # geoweight all ht2 stubs in a pool of worker processes, biggest stubs first;
+    # same arguments as get_geo_weights, but called on all of pufsub. xmat, wh, and
+    # the initial Q go to the workers in shared memory. returns the state weights
+    # (laid out as the grouped.apply result) and a frame of stub statistics;
+    # raises RuntimeError, after all stubs finish, if any stub failed
+    # on Windows, a calling script needs an if __name__ == '__main__': guard
+    grouped = pufsub.groupby('ht2_stub')
+
+    print('setting up stub problems in shared memory...')
+    stubs = {}
+    shared = []
+    try:
+        for stub, df in grouped:
+            pufstub, prob = geo_stub_problem(df.copy(), stub, weightdf, targvars,
+                                             ht2wide, dropsdf_wide, independent, options)
+            specs = {}
+            for name in ['wh', 'xmat', 'Q']:
+                shm, specs[name] = to_shared(prob[name])
+                shared.append(shm)
+            stubs[stub] = (pufstub, prob, specs)
+
+        order = sorted(stubs, key=lambda stub: stubs[stub][1]['xmat'].size, reverse=True)
+
+        print(f'solving {len(order)} stubs with {workers} workers...')
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {stub: executor.submit(geo_stub_worker, stub, stubs[stub][2],
+                                             stubs[stub][1]['targets'], geomethod,
+                                             stubs[stub][1]['options'])
+                       for stub in order}
+            results = {stub: future.result() for stub, future in futures.items()}
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+    dflist = {}
+    statlist = []
+    for stub in sorted(stubs):
+        pufstub, prob, specs = stubs[stub]
+        whs_opt, stats = results[stub]
+        statlist.append(stats)
+        if whs_opt is not None:
+            if prob['qstore'] is not None:
+                qstore_save(prob['qstore'], targvars, prob['sts'], stub, pufstub.pid, whs_opt)
+            dflist[stub] = geo_stub_result(pufstub, whs_opt, prob['sts'], stub, intermediate_path)
+
+    stub_stats = pd.DataFrame(statlist)
+    print(stub_stats)
+    # a failed stub would be missing from geo_weights, and from every state
+    # sum built on it, so fail loudly once all stubs have finished (solved
+    # stubs are already in the qstore and intermediate files)
+    failed = stub_stats[stub_stats.status != 'solved']
+    if len(failed) > 0:
+        raise RuntimeError(f'geoweighting failed for ht2 stubs {failed.ht2_stub.tolist()}:\n'
+                           + failed[['ht2_stub', 'status']].to_string(index=False))
+    geo_weights = pd.concat(dflist, names=['ht2_stub', None])
+    # the concat keys come back int64; keep ht2_stub's dtype, as apply does
+    stub_level = geo_weights.index.levels[0].astype(grouped.obj['ht2_stub'].dtype)
+    geo_weights.index = geo_weights.index.set_levels(stub_level, level=0)
+    return geo_weights, stub_stats
+
+
+def geo_stub_worker(stub, specs, targets, geomethod, options):
+    # runs in a worker process: attach to the shared arrays, solve, and
+    # return the state weights and a dict of stub statistics; a solver error
+    # is returned in the status (so the other stubs still finish) and raised
+    # by get_geo_weights_parallel
+    arrays = {}
+    handles = []
+    for name, spec in specs.items():
+        shm, arrays[name] = from_shared(spec)
+        handles.append(shm)
+
+    a = timer()
+    try:
+        whs_opt = geo_stub_solve(arrays['wh'], arrays['xmat'], targets,
+                                 geomethod, options, arrays['Q'])
+        status = 'solved'
+    except Exception as e:
+        whs_opt = None
+        status = 'failed: ' + repr(e)
+    b = timer()
+
+    stats = {'ht2_stub': stub, 'nrecs': arrays['wh'].size,
+             'seconds': b - a, 'status': status, 'max_abspdiff': np.nan}
+    if whs_opt is not None:
+        # largest % difference from a targeted (not dropped) state target
+        calc = np.dot(whs_opt.T, arrays['xmat'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pdiff = np.abs(calc / targets * 100 - 100)
+        keep = ~np.asarray(options.get('drops', np.zeros(targets.shape, dtype=bool)))
+        stats['max_abspdiff'] = np.nanmax(np.where(keep, pdiff, np.nan))
+        whs_opt = np.array(whs_opt)  # own copy, not a view of shared memory
+
+    for shm in handles:
+        shm.close()
+    return whs_opt, stats
+
+
+# %% Q warm-start store
+# solved state shares are saved per stub as .npy files (the Q matrix and the
+# pids of its rows) in a subdirectory of the store keyed by the target
+# variables and state groups, but not by target values, so that a rerun after
+# small target edits starts near the previous solution; pass the store
+# directory as options['qstore'] to get_geo_weights or get_geo_weights_parallel
+
+def qstore_dir(qstore, targvars, sts):
+    # directory for one target set and state grouping; created with an
+    # index.json that records what the key stands for
+    spec = {'targvars': list(targvars), 'sts': list(sts)}
+    key = hashlib.sha256(json.dumps(spec).encode()).hexdigest()[:16]
+    path = os.path.join(qstore, 'q_' + key)
+    if not os.path.exists(path):
+        os.makedirs(path)
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump(spec, f, indent=1)
+    return path
+
+
+def qstore_load(qstore, targvars, sts, stub, pids, min_match=0.5):
+    # return the stored n x m Q for pids, or None if there is no stored Q for
+    # this stub or fewer than min_match of pids are in it; pids that are not
+    # in the stored Q start at the average stored shares
+    path = qstore_dir(qstore, targvars, sts)
+    qfile = os.path.join(path, 'stub_' + str(stub) + '_Q.npy')
+    pidfile = os.path.join(path, 'stub_' + str(stub) + '_pid.npy')
+    if not (os.path.exists(qfile) and os.path.exists(pidfile)):
+        return None
+
+    Q = np.load(qfile, mmap_mode='r')
+    loc = pd.Index(np.load(pidfile)).get_indexer(np.asarray(pids))
+    found = loc >= 0
+    if found.mean() < min_match:
+        return None
+
+    Q_init = np.empty((loc.size, Q.shape[1]))
+    Q_init[found] = Q[loc[found]]
+    Q_init[~found] = np.asarray(Q).mean(axis=0)
+    return Q_init
+
+
+def qstore_save(qstore, targvars, sts, stub, pids, whs):
+    # save state weights as row shares (the Q matrix) with their pids
+    path = qstore_dir(qstore, targvars, sts)
+    whs = np.asarray(whs, dtype=float)
+    rowsums = whs.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Q = np.where(rowsums > 0, whs / rowsums, 1.0 / whs.shape[1])
+    np.save(os.path.join(path, 'stub_' + str(stub) + '_Q.npy'), Q)
+    np.save(os.path.join(path, 'stub_' + str(stub) + '_pid.npy'), np.asarray(pids))
+
+
+def to_shared(arr):
+    # copy an array into a new shared memory block; return the block and the
+    # (name, shape, dtype) spec a worker needs to attach to it
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def from_shared(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
 
@@ -9,6 +9,7 @@ Created on Sun Nov 22 05:46:17 2020
 import numpy as np
 import pandas as pd
 
+import functions_reweight_puf as rwp
 import puf_constants as pc
 
 
@@ -132,29 +133,33 @@ def get_onestate_wsums(pufmrg, state, sumvars, stubvar):
 
 
 def get_allstates_wsums(pufsub, sweights):
+    # weighted sums of every pufsub variable for every state group and
+    # ht2_stub, plus stub 0 for the grand total, as a long frame
     idvars = ['pid', 'filer', 'common_stub', 'ht2_stub']
     sumvars = [s for s in pufsub.columns if s not in idvars]
-    stubvar  = 'ht2_stub'
-
-    print('merging with weights...')
-    pufmrg = pd.merge(pufsub,
-                  sweights.drop(columns=['weight', 'geoweight_sum']),
-                  how='left', on=['pid', 'ht2_stub'])
-
-    print('looping through state groups to get weighted sums...')
-    # loop through the state groups and get a summary dataframe for each
+    stubvar = 'ht2_stub'
     state_groups = [s for s in sweights.columns if s not in ['pid', 'ht2_stub', 'weight', 'geoweight_sum']]
-    dflist = []
-    for stgroup in state_groups:
-        print('  ' + stgroup)
-        df = get_onestate_wsums(pufmrg, stgroup, sumvars, stubvar)
-        dflist.append(df)
-
-    allstates = pd.concat(dflist)
-    allstates_long = pd.melt(allstates,
-                             id_vars=['stgroup', 'ht2_stub'],
-                             value_vars=sumvars,
-                             var_name='pufvar', value_name='puf')
+
+    print('aligning state weights with records...')
+    # a record only gets state weights if pid AND ht2_stub match, as in the
+    # left merge this replaces; unmatched records get weight 0
+    wmat = rwp.align_weights(pufsub.pid, sweights.loc[:, ['pid', stubvar] + state_groups])
+    stubs = pufsub[stubvar].to_numpy()
+    wmat = wmat[:, 1:] * (wmat[:, [0]] == stubs.reshape(-1, 1))
+    xmat = pufsub.loc[:, sumvars].to_numpy(dtype=float)
+
+    print('getting weighted sums for ' + str(len(state_groups)) + ' state groups...')
+    cube = get_allstates_cube(xmat, wmat, stubs)
+
+    # stub 0 plus the stubs present in the data, long by variable, state, stub
+    present = np.concatenate(([0], np.unique(stubs)))
+    cube = cube[:, present, :]
+    nst, nstub, nvar = cube.shape
+    allstates_long = pd.DataFrame({
+        'stgroup': np.tile(np.repeat(state_groups, nstub), nvar),
+        'ht2_stub': np.tile(present, nst * nvar),
+        'pufvar': np.repeat(sumvars, nst * nstub),
+        'puf': cube.transpose(2, 0, 1).ravel()})
     allstates_long = pd.merge(allstates_long,
                               pc.irspuf_target_map.loc[:, ['pufvar', 'column_description']],
                               how='left', on='pufvar')
@@ -162,6 +167,25 @@ def get_allstates_wsums(pufsub, sweights):
     return allstates_long
 
 
+def get_allstates_cube(xmat, wmat, stubs):
+    # states x stubs x variables weighted sums, m x (nstubs + 1) x k with the grand
+    # total at stub 0; one dense W_s' X_s product per stub (codes from 1)
+    xmat = np.nan_to_num(np.asarray(xmat, dtype=float))
+    wmat = np.asarray(wmat, dtype=float)
+    stubs = np.asarray(stubs, dtype='int64')
+
+    order = np.argsort(stubs, kind='stable')
+    codes, starts = np.unique(stubs[order], return_index=True)
+    ends = np.append(starts[1:], order.size)
+
+    cube = np.zeros((wmat.shape[1], stubs.max() + 1, xmat.shape[1]))
+    for code, start, end in zip(codes, starts, ends):
+        rows = order[start:end]
+        cube[:, code, :] = wmat[rows].T @ xmat[rows]
+    cube[:, 0, :] = cube[:, 1:, :].sum(axis=1)
+    return cube
+
+
 def get_compfile(allstates_long, ht2_compare):
     ht2keep = ['stgroup', 'pufvar', 'ht2var', 'target', 'ht2description', 'ht2_stub']
     comp = pd.merge(allstates_long,
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the national stub reweighting solvers.
+
+A fixture is one stub's problem (wh, xmat, targets, as rwp.stub_problem
+builds them) saved as .npz, so runs can be repeated on the same problems.
+"""
+
+# %% imports
+import glob
+import itertools
+import json
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sps
+from scipy.optimize import lsq_linear
+from timeit import default_timer as timer
+
+import functions_reweight_puf as rwp
+
+import src.microweight as mw
+
+
+# %% constants
+QTILES = (0, .1, .25, .5, .75, .9, 1)
+
+
+# %% fixtures
+def save_stub_fixtures(pufsub, init_weights, targets, fixdir, drops=None):
+    # save each common_stub problem as fixdir/stub_<stub>.npz, return the paths
+    os.makedirs(fixdir, exist_ok=True)
+    init_weights = init_weights.iloc[:, [0, 1]].set_axis(['pid', 'weight'], axis=1)
+    pufsub = pd.merge(pufsub.drop(columns='weight', errors='ignore'),
+                      init_weights, on='pid', how='left')
+
+    target_names = targets.columns.tolist()
+    target_names.remove('common_stub')
+    paths = []
+    for stub, df in pufsub.groupby('common_stub'):
+        wh, xmat, targets_stub = rwp.stub_problem(df, stub, targets, drops)
+        drop_vars = [] if drops is None else drops[drops.common_stub == stub].pufvar.tolist()
+        path = os.path.join(fixdir, 'stub_' + str(stub).zfill(2) + '.npz')
+        save_fixture(path, wh, xmat, targets_stub,
+                     targvars=[s for s in target_names if s not in drop_vars],
+                     pid=df.pid.to_numpy(), name='stub_' + str(stub))
+        paths.append(path)
+    return paths
+
+
+def save_fixture(path, wh, xmat, targets, targvars=None, pid=None, name=None):
+    if targvars is None:
+        targvars = ['x' + str(j) for j in range(xmat.shape[1])]
+    if pid is None:
+        pid = np.arange(wh.size)
+    if name is None:
+        name = os.path.splitext(os.path.basename(path))[0]
+    np.savez_compressed(path, wh=wh, xmat=xmat, targets=targets,
+                        targvars=np.array(targvars), pid=pid, name=np.array(name))
+
+
+def load_fixture(path):
+    with np.load(path) as f:
+        fixture = {key: f[key] for key in f.files}
+    fixture['name'] = str(fixture['name'])
+    fixture['targvars'] = fixture['targvars'].tolist()
+    return fixture
+
+
+def load_fixtures(fixdir):
+    return [load_fixture(path) for path in sorted(glob.glob(os.path.join(fixdir, '*.npz')))]
+
+
+def synthetic_fixture(h, k, seed=0, zero_share=0.3, target_noise=0.05, name=None):
+    # a puf-like stub problem with h records and k variables; targets are off
+    # the weighted sums by up to target_noise, so g = 1 is not a solution
+    rng = np.random.default_rng(seed)
+    xmat = rng.lognormal(8, 1.5, (h, k)) * (rng.random((h, k)) > zero_share)
+    xmat[:, 0] = 1  # a count, like nret_all
+    wh = rng.lognormal(6, 0.8, h)
+    targets = (xmat * wh.reshape(-1, 1)).sum(axis=0) * rng.uniform(1 - target_noise, 1 + target_noise, k)
+    if name is None:
+        name = f'synthetic_h{h}_k{k}_seed{seed}'
+    return {'wh': wh, 'xmat': xmat, 'targets': targets,
+            'targvars': ['x' + str(j) for j in range(k)],
+            'pid': np.arange(h), 'name': name}
+
+
+# %% benchmark
+def options_grid(**options):
+    # every combination of the option values given as lists, e.g.,
+    # options_grid(solver=['lsq'], method=['bvls', 'trf'], xlb=[0.1, 0.01])
+    names = list(options)
+    values = [v if isinstance(v, (list, tuple)) else [v] for v in options.values()]
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+def run_benchmark(fixtures, grid, repeats=1, quiet=True):
+    # one row per fixture and option set (a dict with a solver key, see
+    # SOLVERS, plus that solver's options); keeps the fastest of repeats
+    rows = []
+    for fixture in fixtures:
+        for opts in grid:
+            opts = dict(opts)
+            solver = opts.pop('solver')
+            seconds = []
+            for rep in range(repeats):
+                a = timer()
+                g, iterations = SOLVERS[solver](fixture, **opts)
+                seconds.append(timer() - a)
+
+            cc = fixture['xmat'] * fixture['wh'].reshape(-1, 1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pdiff = (cc.T @ g - fixture['targets']) / fixture['targets'] * 100
+            row = {'fixture': fixture['name'],
+                   'h': fixture['xmat'].shape[0],
+                   'k': fixture['xmat'].shape[1],
+                   'solver': solver,
+                   'options': json.dumps(opts, default=str),
+                   'seconds': min(seconds),
+                   'iterations': iterations,
+                   'max_abs_pdiff': np.nanmax(np.abs(pdiff))}
+            row.update({'g_q' + str(int(q * 100)): val
+                        for q, val in zip(QTILES, np.quantile(g, QTILES))})
+            rows.append(row)
+            if not quiet:
+                iters = 'n/a' if np.isnan(iterations) else str(int(iterations))
+                print(f'{fixture["name"]:<25} {solver:<9} {row["options"]:<60} '
+                      f'{row["seconds"]:8.2f} seconds  {iters:>5} iterations  '
+                      f'max abs pdiff {row["max_abs_pdiff"]:8.3f}')
+    return pd.DataFrame(rows)
+
+
+def benchmark_grid():
+    # ipopt and lsq with the stub_solve settings, the sparse solvers over a
+    # few options
+    return (options_grid(solver='ipopt', crange=0.001, xlb=0.1, xub=100) +
+            options_grid(solver='lsq', xlb=0.1, xub=100, tol=1e-7, method='bvls', scaling=False, max_iter=50) +
+            options_grid(solver='ipopt_sparse', xlb=[0.1, 0.01], xub=100, crange=[0.001, 0.005]) +
+            options_grid(solver='lsq_sparse', xlb=[0.1, 0.01], xub=100, penalty=[0.01, 1.0]))
+
+
+# %% solvers
+# each takes a fixture and options and returns g and the number of iterations
+# (NaN where the solver does not report them); ipopt and lsq are microweight's
+# methods, as rwp.stub_solve runs them; ipopt_sparse is functions_reweight_ipopt
+def solve_mw(fixture, mwmethod, **opts):
+    # mwmethod is microweight's method; opts may have lsq_linear's own method
+    prob = mw.Microweight(wh=fixture['wh'], xmat=fixture['xmat'], targets=fixture['targets'])
+    rw = prob.reweight(method=mwmethod, options=opts)
+    return rw.g, mw_iterations(rw)
+
+
+def mw_iterations(rw):
+    # iterations from a microweight reweight result: lsq_linear's nit, or an
+    # iteration count in ipopt's info dict; cyipopt's info does not have one,
+    # so ipopt's iterations are NaN
+    result = getattr(rw, 'method_result', None)
+    if hasattr(result, 'nit'):
+        return result.nit
+    if isinstance(result, dict):
+        for key in ['iter_count', 'iterations', 'nit']:
+            if key in result:
+                return result[key]
+    return np.nan
+
+
+def solve_ipopt_sparse(fixture, **opts):
+    import functions_reweight_ipopt as rwi  # needs cyipopt, so only imported here
+    res = rwi.ipopt_reweight(fixture['wh'], fixture['xmat'], fixture['targets'], **opts)
+    return res.g, len(res.iterations)
+
+
+def solve_lsq_sparse(fixture, xlb=0.1, xub=100, penalty=1.0, tol=1e-7, max_iter=None):
+    # minimize sum of squared % target differences + penalty * sum((g - 1)^2);
+    # without the penalty the problem is underdetermined (far more records
+    # than targets) and g wanders from 1. the identity block is sparse, so
+    # this is trf only
+    cc = fixture['xmat'] * fixture['wh'].reshape(-1, 1)
+    targets = fixture['targets']
+    h = cc.shape[0]
+    scale = np.where(targets != 0, 100 / np.abs(targets), 1.0)
+    A = sps.vstack([sps.csr_matrix(cc.T * scale.reshape(-1, 1)),
+                    sps.identity(h, format='csr') * np.sqrt(penalty)], format='csr')
+    b = np.concatenate([targets * scale, np.full(h, np.sqrt(penalty))])
+    res = lsq_linear(A, b, bounds=(xlb, xub), method='trf', lsq_solver='lsmr',
+                     tol=tol, max_iter=max_iter)
+    return res.x, res.nit
+
+
+SOLVERS = {'ipopt': lambda fixture, **opts: solve_mw(fixture, 'ipopt', **opts),
+           'lsq': lambda fixture, **opts: solve_mw(fixture, 'lsq', **opts),
+           'ipopt_sparse': solve_ipopt_sparse,
+           'lsq_sparse': solve_lsq_sparse}
+
+
+# %% run the benchmark
+if __name__ == '__main__':
+    # the stub problems puf_runall.py saves to FIXDIR, or synthetic ones without
+    # the puf, over the options in benchmark_grid
+    from datetime import date
+
+    IGNOREDIR = r'C:\programs_python\puf_analysis\ignore/'
+    FIXDIR = IGNOREDIR + 'reweight_fixtures/'
+    TABDIR = IGNOREDIR + 'result_tables/'
+
+    fixtures = load_fixtures(FIXDIR)
+    # fixtures = [fixtures[i] for i in [1, 2]]  # e.g., just the hardest stubs
+    if not fixtures:
+        fixtures = [synthetic_fixture(h, 60, seed=h) for h in [5000, 20000, 50000]]
+
+    bench = run_benchmark(fixtures, benchmark_grid(), quiet=False)
+    print(bench.groupby(['solver', 'options'])[['seconds', 'iterations', 'max_abs_pdiff']].agg(['sum', 'max']))
+    unreported = bench.solver[bench.iterations.isna()].unique()
+    if len(unreported) > 0:
+        print('iterations are not reported by: ' + ', '.join(unreported))
+
+    date_id = date.today().strftime("%Y-%m-%d")
+    bench.to_csv(TABDIR + 'reweight_benchmark_' + date_id + '.csv', index=None)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+ipopt reweighting of a single national stub: minimize sum((x - 1)**2)
+subject to the targets +/- crange, with the constant jacobian built once.
+"""
+
+# %% imports
+import numpy as np
+import pandas as pd
+import scipy.sparse as sps
+from timeit import default_timer as timer
+from types import SimpleNamespace
+
+try:
+    import cyipopt as ipopt
+except ImportError:
+    import ipopt  # cyipopt before 1.0
+
+
+# %% callbacks
+def get_ccscale(cc, ccgoal=1, method='mean'):
+    # column scaling so that the mean (or median) constraint coefficient of
+    # each constraint is ccgoal; constraints with a zero mean or median are
+    # not scaled
+    if method == 'mean':
+        denom = cc.sum(axis=0) / cc.shape[0]
+    elif method == 'median':
+        denom = np.median(cc, axis=0)
+    else:
+        raise ValueError(f'ccscale method must be mean or median, not {method}')
+    with np.errstate(divide='ignore'):
+        ccscale = np.where(denom != 0, np.absolute(ccgoal / denom), 1.0)
+    return ccscale
+
+
+class ReweightCallbacks:
+    # ipopt problem object for one stub; ccscale is 'mean', 'median', or None
+    # constraints are linear, so the jacobian (a csr matrix) and the hessian
+    # are constant and ipopt gets the same arrays on every call
+
+    def __init__(self, wh, xmat, targets, crange=0.001, ccscale='mean', ccgoal=1,
+                 quiet=True):
+        cc = np.asarray(xmat, dtype=float) * np.asarray(wh, dtype=float).reshape(-1, 1)
+        if ccscale is None:
+            self.ccscale = np.ones(cc.shape[1])
+        else:
+            self.ccscale = get_ccscale(cc, ccgoal, ccscale)
+        # m x n, only the nonzero coefficients
+        jac = sps.csr_matrix((cc * self.ccscale).T)
+
+        self.n = cc.shape[0]
+        self.m = cc.shape[1]
+        self.quiet = quiet
+        self._jac = jac
+        self._jac_structure = (np.repeat(np.arange(self.m), np.diff(jac.indptr)),
+                               jac.indices.copy())
+        self._hess_structure = (np.arange(self.n), np.arange(self.n))
+        self._hess_values = np.full(self.n, 2.0)
+
+        self.targets = np.asarray(targets, dtype=float) * self.ccscale
+        self.cl = self.targets - np.abs(self.targets) * crange
+        self.cu = self.targets + np.abs(self.targets) * crange
+
+        self.iterations = []
+        self._time = timer()
+
+    def objective(self, x):
+        return np.sum(np.square(x - 1))
+
+    def gradient(self, x):
+        return 2 * x - 2
+
+    def constraints(self, x):
+        return self._jac @ x
+
+    def jacobian(self, x):
+        return self._jac.data
+
+    def jacobianstructure(self):
+        return self._jac_structure
+
+    def hessian(self, x, lagrange, obj_factor):
+        # constraints are linear, so only the objective contributes
+        return self._hess_values * obj_factor
+
+    def hessianstructure(self):
+        return self._hess_structure
+
+    def intermediate(self, alg_mod, iter_count, obj_value, inf_pr, inf_du, mu,
+                     d_norm, regularization_size, alpha_du, alpha_pr, ls_trials):
+        now = timer()
+        self.iterations.append({'iter': iter_count, 'obj': obj_value,
+                                'inf_pr': inf_pr, 'inf_du': inf_du,
+                                'ls_trials': ls_trials,
+                                'seconds': now - self._time})
+        self._time = now
+        if not self.quiet:
+            print(f'iter {iter_count:4d}  obj {obj_value:12.6g}  inf_pr {inf_pr:10.3g}  '
+                  f'inf_du {inf_du:10.3g}  {self.iterations[-1]["seconds"]:7.3f} seconds')
+        return True
+
+
+# %% solve
+def ipopt_reweight(wh, xmat, targets, xlb=0.1, xub=100, crange=0.001,
+                   ccscale='mean', ccgoal=1, max_iter=100, quiet=True,
+                   options=None):
+    # options are further ipopt options; returns g, pdiff, info, iterations
+    # (a dataframe, one row per iteration), and seconds
+    a = timer()
+    callbacks = ReweightCallbacks(wh, xmat, targets, crange=crange,
+                                  ccscale=ccscale, ccgoal=ccgoal, quiet=quiet)
+    Problem = getattr(ipopt, 'Problem', None) or ipopt.problem
+    nlp = Problem(n=callbacks.n, m=callbacks.m,
+                  problem_obj=callbacks,
+                  lb=np.full(callbacks.n, xlb),
+                  ub=np.full(callbacks.n, xub),
+                  cl=callbacks.cl,
+                  cu=callbacks.cu)
+
+    opts = {'print_level': 0 if quiet else 5,
+            'jac_c_constant': 'yes',
+            'jac_d_constant': 'yes',
+            'hessian_constant': 'yes',
+            'max_iter': max_iter,
+            'linear_solver': 'mumps'}
+    if options is not None:
+        opts.update(options)
+    add_option = getattr(nlp, 'add_option', None) or nlp.addOption
+    for option, value in opts.items():
+        add_option(option, value)
+
+    x, info = nlp.solve(np.ones(callbacks.n))
+
+    wsums = (np.asarray(xmat, dtype=float) * np.asarray(wh, dtype=float).reshape(-1, 1)).T @ x
+    targets = np.asarray(targets, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pdiff = (wsums - targets) / targets * 100
+    return SimpleNamespace(g=x, pdiff=pdiff, info=info,
+                           iterations=pd.DataFrame(callbacks.iterations),
+                           seconds=timer() - a)
@@ -1,8 +1,13 @@
 
 # %% imports
+import hashlib
+import json
+import os
 import numpy as np
 import pandas as pd
+import scipy.sparse as sps
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
 
 import puf_constants as pc
@@ -30,13 +35,15 @@ def comp_report(pufsub,
     compvars_names = compvars.columns.tolist()
     compvars_names.remove('common_stub')
 
-    print(f'Getting percent differences with initial weights...')
+    print(f'Getting percent differences with initial and new weights...')
+    # get both sets of differences in one batched call
+    weights = pd.merge(weights_init.loc[:, ['pid', 'weight']].rename(columns={'weight': 'init'}),
+                       weights_reweight.loc[:, ['pid', 'weight']].rename(columns={'weight': 'reweight'}),
+                       how='outer', on='pid')
+    allpdiffs = get_pctdiffs_multi(pufsub, weights, compvars)
     keep = ['common_stub', 'pufvar', 'pdiff']
-    ipdiffs = get_pctdiffs(pufsub, weights_init, compvars).loc[:, keep].rename(columns={'pdiff': 'ipdiff'})
-
-    print(f'Getting percent differences with new weights...')
-    # rwtsums = get_wtdsums(pufsub, target_names, weights_rwt)
-    pdiffs = get_pctdiffs(pufsub, weights_reweight, compvars)
+    ipdiffs = allpdiffs.query('weight_name == "init"').loc[:, keep].rename(columns={'pdiff': 'ipdiff'})
+    pdiffs = allpdiffs.query('weight_name == "reweight"').drop(columns='weight_name')
 
     print(f'Preparing report...')
     comp = pd.merge(pdiffs, ipdiffs, on=['common_stub', 'pufvar'])
@@ -117,6 +124,41 @@ def get_pctdiffs(pufsub, weightdf, targets):
     return dfmerge
 
 
+def get_pctdiffs_multi(pufsub, weights_wide, targets):
+    # percent differences from targets for many weight sets at once
+    # weights_wide has pid as its first column and one column per weight set,
+    # for example the nat_wide frame of national weights in puf_runall.py
+    # all weight sets are summed with one sparse product (see wtdsums_engine)
+    # returns a long frame keyed by weight_name, common_stub, pufvar
+    weights_wide = pu.idx_rename(weights_wide, col_indexes=[0], new_names=['pid'])
+    wnames = weights_wide.columns.tolist()[1:]
+
+    target_names = targets.columns.tolist()
+    target_names.remove('common_stub')
+
+    wmat = align_weights(pufsub.pid, weights_wide)
+    xmat = pufsub.loc[:, target_names].to_numpy(dtype=float)
+    stubs = pufsub.common_stub.to_numpy()
+    sums = wtdsums_engine(xmat, wmat, {'common_stub': stubs})['common_stub']
+
+    present = np.concatenate(([0], np.unique(stubs)))
+    idx = pd.MultiIndex.from_product([wnames, present, target_names],
+                                     names=['weight_name', 'common_stub', 'pufvar'])
+    sumslong = pd.DataFrame({'puf': sums[:, present, :].ravel()}, index=idx).reset_index()
+
+    targetslong = pd.melt(targets, id_vars='common_stub', var_name='pufvar', value_name='target')
+    dfmerge = pd.merge(sumslong, targetslong, on=['common_stub', 'pufvar'])
+    dfmerge['diff'] = dfmerge.puf - dfmerge.target
+    dfmerge['pdiff'] = dfmerge['diff'] / dfmerge.target * 100
+    dfmerge['abspdiff'] = np.abs(dfmerge.pdiff)
+
+    # keep weight sets in the order given, largest differences first within each
+    dfmerge['worder'] = dfmerge.weight_name.map({wname: i for i, wname in enumerate(wnames)})
+    dfmerge = dfmerge.sort_values(by=['worder', 'abspdiff'], ascending=[True, False])
+    dfmerge = dfmerge.drop(columns='worder')
+    return dfmerge
+
+
 def get_possible_targets(targets_fname):
     targets_possible = pd.read_csv(targets_fname)
 
@@ -139,47 +181,175 @@ def get_wtdsums(pufsub, sumvars, weightdf, stubvar='common_stub'):
     # create local weights df with proper names
     weightdf = pu.idx_rename(weightdf, col_indexes=[0, 1], new_names=['pid', 'weight'])
 
-    df = pufsub.copy().drop(columns='weight', errors='ignore')
-    varnames = df.columns.tolist()
-    varnames.remove(stubvar)
-    varnames.remove('pid')
-
-    df = pd.merge(df, weightdf.iloc[:, [0, 1]], how='left', on='pid')
-
-    df.update(df.loc[:, sumvars].multiply(df.weight, axis=0))
-    dfsums = df.groupby(stubvar)[sumvars].sum().reset_index()
-    grand_sums = dfsums[sumvars].sum().to_frame().transpose()
-    grand_sums[stubvar] = 0
-    dfsums = dfsums.append(grand_sums, ignore_index=True)
-    dfsums[stubvar] = dfsums[stubvar].fillna(0)
-    dfsums.sort_values(by=stubvar, axis=0, inplace=True)
-    dfsums = dfsums.set_index(stubvar, drop=False)
-    return dfsums
+    wmat = align_weights(pufsub.pid, weightdf.iloc[:, [0, 1]])
+    xmat = pufsub.loc[:, sumvars].to_numpy(dtype=float)
+    sums = wtdsums_engine(xmat, wmat, {stubvar: pufsub[stubvar].to_numpy()})
+    return wtdsums_frame(sums[stubvar][0], sumvars, stubvar, pufsub[stubvar])
 
 
 def get_wtdsums_geo(pufsub, sumvars, weightdf, stubvar='common_stub'):
-    # create local weights df with proper names
-    weightdf = pu.idx_rename(weightdf, col_indexes=[0, 1], new_names=['pid', 'weight'])
-
-    df = pufsub.copy().drop(columns='weight', errors='ignore')
-    varnames = df.columns.tolist()
-    varnames.remove(stubvar)
-    varnames.remove('pid')
-
-    df = pd.merge(df, weightdf.iloc[:, [0, 1]], how='left', on='pid')
-
-    df.update(df.loc[:, sumvars].multiply(df.weight, axis=0))
-    dfsums = df.groupby(stubvar)[sumvars].sum().reset_index()
-    grand_sums = dfsums[sumvars].sum().to_frame().transpose()
-    grand_sums[stubvar] = 0
-    dfsums = dfsums.append(grand_sums, ignore_index=True)
-    dfsums[stubvar] = dfsums[stubvar].fillna(0)
-    dfsums.sort_values(by=stubvar, axis=0, inplace=True)
+    return get_wtdsums(pufsub, sumvars, weightdf, stubvar=stubvar)
+
+
+def get_wtdsums_multi(pufsub, sumvars, weightdf, stubvars=('common_stub', 'ht2_stub')):
+    # weighted sums for every weight column in weightdf (pid first, then one
+    # column per weight set) and every stub variable, in a single pass
+    # returns a dict keyed by stubvar, each a dict keyed by weight name of
+    # frames laid out like get_wtdsums
+    weightdf = pu.idx_rename(weightdf, col_indexes=[0], new_names=['pid'])
+    wnames = weightdf.columns.tolist()[1:]
+
+    wmat = align_weights(pufsub.pid, weightdf)
+    xmat = pufsub.loc[:, sumvars].to_numpy(dtype=float)
+    stubs = {stubvar: pufsub[stubvar].to_numpy() for stubvar in stubvars}
+    sums = wtdsums_engine(xmat, wmat, stubs)
+
+    return {stubvar: {wname: wtdsums_frame(sums[stubvar][j], sumvars, stubvar, pufsub[stubvar])
+                      for j, wname in enumerate(wnames)}
+            for stubvar in stubvars}
+
+
+# %% incremental target differences
+class TargetTracker(object):
+    # weighted sums and % differences from targets, updated incrementally:
+    # update() adjusts the stub x variable sums using only the changed records
+    # tracker = TargetTracker(pufsub, weights_initial, ptargets)
+    # tracker.update(pids, new_weights)
+    # tracker.pdiffs().head(20)
+
+    def __init__(self, pufsub, weightdf, targets, stubvar='common_stub'):
+        weightdf = pu.idx_rename(weightdf, col_indexes=[0, 1], new_names=['pid', 'weight'])
+
+        target_names = targets.columns.tolist()
+        target_names.remove(stubvar)
+        self.stubvar = stubvar
+        self.target_names = target_names
+
+        self._pididx = pd.Index(pufsub.pid)
+        self._stubs = pufsub[stubvar].to_numpy(dtype='int64')
+        self._xmat = np.nan_to_num(pufsub.loc[:, target_names].to_numpy(dtype=float))
+        self.weights = align_weights(pufsub.pid, weightdf.iloc[:, [0, 1]])[:, 0]
+
+        # positions of the targets in the stub x variable sums array
+        targetslong = pd.melt(targets, id_vars=stubvar, var_name='pufvar', value_name='target')
+        targetslong = targetslong[targetslong[stubvar].isin(np.concatenate(([0], self._stubs)))]
+        self._tstub = targetslong[stubvar].to_numpy(dtype='int64')
+        self._tvar = pd.Index(target_names).get_indexer(targetslong.pufvar)
+        self._targets = targetslong.target.to_numpy(dtype=float)
+
+        self.recompute()
+
+    def recompute(self):
+        # recompute all sums, e.g., to clear accumulated rounding
+        sums = wtdsums_engine(self._xmat, self.weights, {self.stubvar: self._stubs})
+        self.sums = sums[self.stubvar][0]
+
+    def update(self, pids, new_weights, old_weights=None):
+        # change the weights of the records in pids and adjust the sums; old_weights
+        # defaults to the tracker's weights. cost is len(pids) x number of targets
+        rows = self._pididx.get_indexer(np.asarray(pids))
+        if (rows < 0).any():
+            raise ValueError('pids not found in the puf subset')
+        new_weights = np.asarray(new_weights, dtype=float)
+        if old_weights is None:
+            old_weights = self.weights[rows]
+        delta = new_weights - np.asarray(old_weights, dtype=float)
+
+        changes = self._xmat[rows] * delta.reshape(-1, 1)
+        np.add.at(self.sums, self._stubs[rows], changes)
+        self.sums[0] += changes.sum(axis=0)
+        self.weights[rows] = new_weights
+
+    def pdiffs(self):
+        # % differences from targets laid out like get_pctdiffs
+        puf = self.sums[self._tstub, self._tvar]
+        df = pd.DataFrame({self.stubvar: self._tstub,
+                           'pufvar': np.asarray(self.target_names)[self._tvar],
+                           'puf': puf,
+                           'target': self._targets})
+        df['diff'] = df.puf - df.target
+        df['pdiff'] = df['diff'] / df.target * 100
+        df['abspdiff'] = np.abs(df.pdiff)
+        df = df.sort_values(by='abspdiff', ascending=False)
+        return df
+
+
+# %% weighted sums engine
+# the functions below do the work for the get_wtdsums family: weights are
+# aligned to the records by pid once, and all weight sets and stub groupings
+# are summed with a single sparse-by-dense product, so pufsub is never
+# copied or merged
+
+def align_weights(pids, weightdf):
+    # return an n x m float array of the weight columns of weightdf (all
+    # columns after pid) in the order of pids; pids not found in weightdf (or
+    # with a NaN weight) get weight 0. the old merge + df.update path skipped
+    # the NaN weights, so those records kept their unweighted values in the sums
+    loc = pd.Index(weightdf.iloc[:, 0]).get_indexer(np.asarray(pids))
+    wvals = weightdf.iloc[:, 1:].to_numpy(dtype=float)
+    wmat = np.zeros((loc.size, wvals.shape[1]))
+    found = loc >= 0
+    wmat[found] = wvals[loc[found]]
+    return np.nan_to_num(wmat, copy=False)
+
+
+def wtdsums_engine(xmat, wmat, stubs):
+    # weighted sums of the xmat columns (n x k) for each weight set in wmat (n x m)
+    # by each stub grouping in stubs (stubvar: n-vector of codes from 1); returns
+    # stubvar: m x (nstubs + 1) x k, with the grand total at stub 0 (m x 1 x k
+    # zeros when there are no records). one sparse
+    # product with xmat covers every weight set and stub
+    xmat = np.nan_to_num(np.asarray(xmat, dtype=float))
+    wmat = np.asarray(wmat, dtype=float)
+    if wmat.ndim == 1:
+        wmat = wmat.reshape(-1, 1)
+    n, m = wmat.shape
+    if n == 0:
+        # no records: only the grand total row, all zeros
+        return {stubvar: np.zeros((m, 1, xmat.shape[1])) for stubvar in stubs}
+
+    rows = []
+    sizes = {}
+    offset = 0
+    for stubvar, codes in stubs.items():
+        codes = np.asarray(codes, dtype='int64')
+        if codes.min() < 1:
+            raise ValueError(f'{stubvar} codes must start at 1')
+        nrows = codes.max() + 1  # row 0 of each weight set holds the grand total
+        sizes[stubvar] = (offset, nrows)
+        # row for record i, weight j is offset + j * nrows + stub
+        rows.append(offset + np.arange(m) * nrows + codes.reshape(-1, 1))
+        offset += m * nrows
+
+    rows = np.concatenate(rows, axis=1).ravel()
+    cols = np.repeat(np.arange(n), rows.size // n)
+    data = np.tile(wmat, (1, len(stubs))).ravel()
+    onehot = sps.csr_matrix((data, (rows, cols)), shape=(offset, n))
+
+    allsums = onehot @ xmat
+
+    result = {}
+    for stubvar, (start, nrows) in sizes.items():
+        sums = allsums[start:start + m * nrows].reshape(m, nrows, -1)
+        sums[:, 0, :] = sums[:, 1:, :].sum(axis=1)
+        result[stubvar] = sums
+    return result
+
+
+def wtdsums_frame(sums, sumvars, stubvar, stubs):
+    # lay out a (nstubs + 1) x k array from wtdsums_engine the way get_wtdsums
+    # always has: stub 0 (grand total) plus the stubs present in the data,
+    # with stubvar as both a column and the index
+    present = np.concatenate(([0], np.unique(stubs)))
+    dfsums = pd.DataFrame(sums[present], columns=sumvars)
+    dfsums.insert(0, stubvar, present)
     dfsums = dfsums.set_index(stubvar, drop=False)
     return dfsums
 
 
 def merge_weights(weight_list, dir):
+    # functions_weights.WeightRegistry lines up any number of weight files on
+    # pid without merges
     wtpaths = [dir + s + '.csv' for s in weight_list]
     dflist = [pd.read_csv(file) for file in wtpaths]
     df_merged = reduce(lambda left, right: pd.merge(left, right, on=['pid'],
@@ -208,7 +378,7 @@ def prep_puf(puf, targets):
         labels=range(1, 19),
         right=False)
     # avoid categorical variable, it causes problems!
-    puf['common_stub'] = puf.common_stub.astype('int64')
+    puf['common_stub'] = puf.common_stub.astype('int8')
 
     puf['ht2_stub'] = pd.cut(
         puf['c00100'],
@@ -216,7 +386,7 @@ def prep_puf(puf, targets):
         labels=range(1, 11),
         right=False)
     # avoid categorical variable, it causes problems!
-    puf['ht2_stub'] = puf.ht2_stub.astype('int64')
+    puf['ht2_stub'] = puf.ht2_stub.astype('int8')
 
     puf['nret_all'] = 1
 
@@ -245,10 +415,71 @@ def prep_puf(puf, targets):
     keep_vars = idvars + numvars + target_names
     keep_vars = ulist(keep_vars)  # keeps unique names in case there is overlap with idvars
 
-    return puf.loc[puf['filer'], keep_vars]
+    # compact dtypes, see pu.PREP_DTYPES
+    return pu.enforce_prep_dtypes(puf.loc[puf['filer'], keep_vars])
 
 
-def puf_reweight(pufsub, init_weights, targets, method='lsq', drops=None):
+def prep_puf_cached(puf_path, targets, cachedir):
+    # prep_puf with an on-disk cache of the result
+    # the cached pufsub is stored as parquet with the compact dtypes of
+    # pu.PREP_DTYPES, named by a hash of the contents of the source parquet
+    # file, the target list, and the dtype schema, so a new or changed puf
+    # file, target list, or schema gets its own cache entry
+    os.makedirs(cachedir, exist_ok=True)
+    key = pufsub_cache_key(puf_path, targets, cachedir)
+    fname = os.path.join(cachedir, 'pufsub_' + key + '.parquet')
+    if os.path.exists(fname):
+        print(f'loading cached pufsub {fname}...')
+        return pd.read_parquet(fname, engine='pyarrow')
+
+    print('preparing pufsub and saving to cache...')
+    puf = pd.read_parquet(puf_path, engine='pyarrow')
+    pufsub = prep_puf(puf, targets)
+    pufsub.to_parquet(fname, engine='pyarrow')
+    return pufsub
+
+
+def pufsub_cache_key(puf_path, targets, cachedir):
+    # hash of the source file contents, the target names in order, and the dtype schema
+    target_names = targets.columns.tolist()
+    target_names.remove('common_stub')
+
+    key = hashlib.sha256()
+    key.update(file_hash(puf_path, cachedir).encode())
+    key.update(','.join(target_names).encode())
+    key.update(json.dumps([pu.PREP_DTYPES, pu.FLOAT64_VARS]).encode())
+    return key.hexdigest()[:16]
+
+
+def file_hash(path, cachedir):
+    # sha256 of a file's contents
+    # hashing a large file takes a while, so hashes are remembered in
+    # cachedir/file_hashes.json for as long as the file's size and
+    # modification time are unchanged
+    os.makedirs(cachedir, exist_ok=True)
+    hashfile = os.path.join(cachedir, 'file_hashes.json')
+    hashes = {}
+    if os.path.exists(hashfile):
+        with open(hashfile) as f:
+            hashes = json.load(f)
+
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    fullpath = os.path.abspath(path)
+    if fullpath in hashes and hashes[fullpath]['stamp'] == stamp:
+        return hashes[fullpath]['sha256']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    hashes[fullpath] = {'stamp': stamp, 'sha256': sha.hexdigest()}
+    with open(hashfile, 'w') as f:
+        json.dump(hashes, f, indent=2)
+    return sha.hexdigest()
+
+
+def puf_reweight(pufsub, init_weights, targets, method='lsq', drops=None, workers=None):
     # create local copy of init_weights with columns pid, weight
     init_weights = pu.idx_rename(init_weights, col_indexes=[0, 1], new_names=['pid', 'weight'])
 
@@ -258,7 +489,40 @@ def puf_reweight(pufsub, init_weights, targets, method='lsq', drops=None):
 
     grouped = pufsub.groupby('common_stub')
 
-    new_weights = grouped.apply(stub_opt, targets, method=method, drops=drops)  # method lsq or ipopt
+    if workers is not None and workers > 1:
+        return puf_reweight_parallel(grouped, targets, method, drops, workers)
+
+    new_weights = grouped.apply(stub_opt, targets, method=method, drops=drops)  # method lsq, ipopt, or ipopt_sparse
+    return new_weights
+
+
+def puf_reweight_parallel(grouped, targets, method, drops, workers):
+    # solve the independent stub problems in a pool of worker processes
+    # only the wh, xmat, and targets arrays for each stub are sent to the
+    # workers; the solved ratios are applied to the stub records here so that
+    # the result is laid out exactly as the serial grouped.apply result
+    # on Windows, a script that calls this must guard its top-level code with
+    # if __name__ == '__main__': (not needed when running cells interactively)
+    problems = {stub: stub_problem(df, stub, targets, drops) for stub, df in grouped}
+
+    # biggest problems first so the slowest stubs don't start last
+    order = sorted(problems, key=lambda stub: problems[stub][1].size, reverse=True)
+
+    print(f'Solving {len(order)} stubs with {workers} workers...')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {stub: executor.submit(stub_solve, *problems[stub], method) for stub in order}
+        gvals = {stub: future.result() for stub, future in futures.items()}
+
+    dflist = {}
+    for stub, df in grouped:
+        df = df[['pid', 'weight']].copy()
+        df['reweight'] = df.weight * gvals[stub]
+        dflist[stub] = df
+
+    new_weights = pd.concat(dflist, names=['common_stub', None])
+    # the concat keys come back int64; keep common_stub's dtype, as apply does
+    stubs = new_weights.index.levels[0].astype(grouped.obj['common_stub'].dtype)
+    new_weights.index = new_weights.index.set_levels(stubs, level=0)
     return new_weights
 
 
@@ -292,6 +556,16 @@ def stub_opt(df, targets, method, drops=None):
     print(f'\nIncome stub {df.name:3d}')
     stub = df.name
 
+    wh, xmat, targets_stub = stub_problem(df, stub, targets, drops)
+    g = stub_solve(wh, xmat, targets_stub, method)
+
+    df = df[['pid', 'weight']].copy()
+    df['reweight'] = df.weight * g
+    return df
+
+
+def stub_problem(df, stub, targets, drops=None):
+    # get the arrays that define the reweighting problem for a single stub
     target_names = targets.columns.tolist()
     target_names.remove('common_stub')
 
@@ -306,11 +580,26 @@ def stub_opt(df, targets, method, drops=None):
     # targets_use = targets_use[0:27]
     # targets_use[23]
 
-    df = df[['pid', 'weight'] + targets_use]
     wh = np.asarray(df.weight)
     targvals = targets.loc[[stub], targets_use]
     xmat = np.asarray(df[targets_use], dtype=float)
     targets_stub = np.asarray(targvals, dtype=float).flatten()
+    return wh, xmat, targets_stub
+
+
+def stub_solve(wh, xmat, targets_stub, method):
+    # solve a single stub problem and return the ratios of new to initial weights
+    # this is what runs in the worker processes, so it only takes arrays
+    # lsq and ipopt are microweight's methods; ipopt_sparse uses the callbacks
+    # in functions_reweight_ipopt, which build the constant jacobian once (its
+    # constraint scaling differs, so its weights are close to but not the same
+    # as ipopt's)
+    if method == 'ipopt_sparse':
+        import functions_reweight_ipopt as rwi  # needs cyipopt, so only imported here
+        rw = rwi.ipopt_reweight(wh, xmat, targets_stub, xlb=0.1, xub=100,
+                                crange=0.001, quiet=False)
+        print(f'{len(rw.iterations)} iterations, {rw.seconds:.1f} seconds')
+        return rw.g
 
     prob = mw.Microweight(wh=wh, xmat=xmat, targets=targets_stub)
     # prob.pdiff_init
@@ -329,9 +618,7 @@ def stub_opt(df, targets, method, drops=None):
     rw = prob.reweight(method=method, options=opts)
     # np.quantile(rw.g, qtiles)
     # rw.pdiff
-
-    df['reweight'] = df.weight * rw.g
-    return df[['pid', 'weight', 'reweight']]
+    return rw.g
 
 
 
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic puf-like files for load testing at any record count, calibrated by
+common_stub to the public IRS targets (data/targets2017_possible.csv).
+synthetic_puf has the raw puf.csv schema, synthetic_tcout the PUF_REGROWN
+layout. Records match the IRS distributions by stub, not record by record.
+Chunks have independent seeds, so n, seed, and chunksize fix the file.
+"""
+
+# %% imports
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import puf_constants as pc
+import puf_utilities as pu
+
+
+# %% constants
+SIGMA = 1.0  # lognormal sigma for nonzero amounts
+WEIGHT_SIGMA = 0.3  # lognormal sigma for record weights around the stub weight
+NEG_AGI_SHARE = 0.1  # share of stub 1 records with negative AGI
+
+# raw puf variable: the target it is calibrated to
+AMOUNT_VARS = {'e00200': 'e00200', 'e00300': 'e00300', 'e00600': 'e00600',
+               'e01500': 'e01500', 'e02400': 'e02400'}
+SIGNED_VARS = {'e00900': 'e00900', 'p23250': 'c01000', 'e26270': 'e26270'}
+# itemized deductions are nested: a record with a less common deduction
+# has the more common ones
+ITEMIZED_VARS = {'e18400': 'c18300', 'e19200': 'c19200', 'e19800': 'c19700',
+                 'e17500': 'c17000'}
+
+# mean age of heads without social security, by MARS
+AGE_MEAN = {1: 38, 2: 48, 3: 45, 4: 40}
+# mean number of dependents by MARS; heads of household have at least one
+KIDS_MEAN = {1: 0.1, 2: 0.9, 3: 0.3, 4: 0.6}
+
+
+# %% calibration
+def synthetic_profile(targets_fname=None):
+    # per common_stub calibration: agi bounds, share of returns (pstub), MARS
+    # shares, and for each _nnz target variable v the nonzero share (v_p) and
+    # mean nonzero amount (v_mean), by sign for signed variables
+    if targets_fname is None:
+        targets_fname = pc.DATADIR + 'targets2017_possible.csv'
+    targets = pd.read_csv(targets_fname)
+    wide = targets.pivot(index='common_stub', columns='pufvar', values='irs')
+    wide = wide.loc[wide.index > 0]
+
+    prof = pd.DataFrame(index=wide.index)
+    prof['lower'] = pc.COMMON_STUBS[:-1]
+    prof['upper'] = pc.COMMON_STUBS[1:]
+    prof['nret'] = wide.nret_all
+    prof['pstub'] = wide.nret_all / wide.nret_all.sum()
+    prof['agi_mean'] = wide.c00100 / wide.nret_all
+
+    mars = wide[['mars1', 'mars2', 'mars3', 'mars4']].fillna(0)
+    mars = mars.divide(mars.sum(axis=1), axis=0)
+    for m in range(1, 5):
+        prof['pmars' + str(m)] = mars['mars' + str(m)]
+
+    def add(name, amount, nnz):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prof[name + '_p'] = (nnz / wide.nret_all).clip(0, 1).fillna(0)
+            prof[name + '_mean'] = (amount / nnz).abs().fillna(0)
+
+    for var in list(AMOUNT_VARS.values()) + list(ITEMIZED_VARS.values()) \
+            + ['c02500', 'c04800', 'c05800', 'taxac_irs']:
+        add(var, wide[var], wide[var + '_nnz'])
+    for var in SIGNED_VARS.values():
+        add(var + 'pos', wide[var + 'pos'], wide[var + 'pos_nnz'])
+        add(var + 'neg', wide[var + 'neg'], wide[var + 'neg_nnz'])
+    # rents, royalties, and other Schedule E income not in e26270: there
+    # are no counts, so assume e26270's nonzero shares
+    add('rentpos', (wide.e02000pos - wide.e26270pos).clip(lower=0), wide.e26270pos_nnz)
+    add('rentneg', (wide.e02000neg - wide.e26270neg).clip(upper=0), wide.e26270neg_nnz)
+    return prof
+
+
+# %% draws
+def lognormal(rng, mean, size):
+    # lognormal amounts with the given means (arrays of size)
+    mu = np.log(np.maximum(mean, 1.0)) - SIGMA**2 / 2
+    return rng.lognormal(mu, SIGMA, size) * (mean > 0)
+
+
+def draw_amount(rng, prof, stub, name, u=None):
+    # nonzero with the stub's share (when u < share, if a uniform u is
+    # given, to nest variables), lognormal around the stub's mean
+    n = stub.size
+    p = prof[name + '_p'].to_numpy()[stub - 1]
+    mean = prof[name + '_mean'].to_numpy()[stub - 1]
+    if u is None:
+        u = rng.random(n)
+    return lognormal(rng, mean, n) * (u < p)
+
+
+def draw_signed(rng, prof, stub, name):
+    # a variable with separate positive and negative targets: at most one
+    # of the two is nonzero
+    n = stub.size
+    u = rng.random(n)
+    ppos = prof[name + 'pos_p'].to_numpy()[stub - 1]
+    pneg = prof[name + 'neg_p'].to_numpy()[stub - 1]
+    pos = lognormal(rng, prof[name + 'pos_mean'].to_numpy()[stub - 1], n)
+    neg = lognormal(rng, prof[name + 'neg_mean'].to_numpy()[stub - 1], n)
+    return np.where(u < ppos, pos, np.where(u < ppos + pneg, -neg, 0.0))
+
+
+def draw_agi(rng, prof, stub):
+    # uniform within bounded stubs; in stub 1, NEG_AGI_SHARE of records have
+    # lognormal losses that bring the stub mean to the IRS mean; in the top
+    # stub, Pareto with the IRS mean
+    n = stub.size
+    lower = prof.lower.to_numpy()[stub - 1]
+    upper = prof.upper.to_numpy()[stub - 1]
+    agi = rng.uniform(np.maximum(lower, 0), upper)
+
+    first = prof.index[0]
+    bottom = stub == first
+    pos_mean = prof.upper[first] / 2
+    neg_mean = (pos_mean * (1 - NEG_AGI_SHARE) - prof.agi_mean[first]) / NEG_AGI_SHARE
+    neg = bottom & (rng.random(n) < NEG_AGI_SHARE)
+    agi[neg] = -lognormal(rng, np.full(neg.sum(), neg_mean), neg.sum())
+
+    last = prof.index[-1]
+    top = stub == last
+    lo = prof.lower[last]
+    alpha = prof.agi_mean[last] / (prof.agi_mean[last] - lo)
+    agi[top] = lo * (1 + rng.pareto(alpha, top.sum()))
+    return agi
+
+
+def draw_records(n, rng, prof, nrecs=None):
+    # draw n records: raw puf variables, common_stub, agi, and tax-calculator
+    # variables; nrecs (default n) is the file's record count, for the weights
+    if nrecs is None:
+        nrecs = n
+    r = {}
+    stub = rng.choice(prof.index.to_numpy(), size=n, p=prof.pstub.to_numpy())
+    r['common_stub'] = stub
+    r['c00100'] = draw_agi(rng, prof, stub)
+
+    # MARS within stub, by inverse cdf
+    cum = prof[['pmars1', 'pmars2', 'pmars3', 'pmars4']].cumsum(axis=1).to_numpy()[stub - 1]
+    mars = 1 + (rng.random((n, 1)) > cum).sum(axis=1)
+    r['MARS'] = np.minimum(mars, 4)
+    married = r['MARS'] == 2
+
+    for var, tvar in AMOUNT_VARS.items():
+        r[var] = draw_amount(rng, prof, stub, tvar)
+    for var, tvar in SIGNED_VARS.items():
+        r[var] = draw_signed(rng, prof, stub, tvar)
+    r['e02000'] = r['e26270'] + draw_signed(rng, prof, stub, 'rent')
+    uitem = rng.random(n)
+    for var, tvar in ITEMIZED_VARS.items():
+        r[var] = draw_amount(rng, prof, stub, tvar, u=uitem)
+
+    # spouse shares of wages and business income
+    pshare = np.where(married, rng.uniform(0.5, 1, n), 1.0)
+    for var in ['e00200', 'e00900']:
+        r[var + 'p'] = r[var] * pshare
+        r[var + 's'] = r[var] - r[var + 'p']
+
+    # ages: social security recipients 62 and up
+    socsec = r['e02400'] > 0
+    age_mean = pd.Series(AGE_MEAN).to_numpy()[r['MARS'] - 1]
+    age = np.clip(rng.normal(age_mean, 12), 18, 61)
+    age = np.where(socsec, np.minimum(62 + rng.exponential(8, n), 90), age)
+    r['age_head'] = age.astype(np.int64)
+    r['age_spouse'] = np.where(married,
+                               np.clip(age + rng.normal(0, 3, n), 18, 90),
+                               0).astype(np.int64)
+
+    # dependents
+    kids = rng.poisson(pd.Series(KIDS_MEAN).to_numpy()[r['MARS'] - 1])
+    kids = np.where(r['MARS'] == 4, kids + 1, kids)
+    r['nu18'] = kids
+    r['n24'] = kids
+    r['XTOT'] = 1 + married + kids
+    r['EIC'] = np.where((r['c00100'] < 50e3) & (r['e00200'] > 0), np.minimum(kids, 3), 0)
+
+    # tax-calculator variables
+    # p23250 is drawn to the c01000 targets, which already reflect the
+    # capital loss limit
+    r['c01000'] = r['p23250']
+    r['c23650'] = r['p23250']
+    ssratio = np.minimum(0.85, prof.c02500_mean.to_numpy() / np.maximum(prof.e02400_mean.to_numpy(), 1.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ssp = np.nan_to_num(prof.c02500_p.to_numpy() / prof.e02400_p.to_numpy()).clip(0, 1)
+    r['c02500'] = r['e02400'] * ssratio[stub - 1] * (rng.random(n) < ssp[stub - 1])
+    for var, tvar in ITEMIZED_VARS.items():
+        r[tvar] = r[var]
+    # taxable income, tax, and tax after credits are nested
+    utax = rng.random(n)
+    for var in ['c04800', 'c05800', 'taxac_irs']:
+        r[var] = draw_amount(rng, prof, stub, var, u=utax)
+    r['c07100'] = np.minimum(r['c05800'], 2000 * kids)
+
+    # net investment income tax over the 2017 thresholds
+    invinc = r['e00300'] + r['e00600'] + np.maximum(r['c01000'], 0) + np.maximum(r['e02000'], 0)
+    threshold = np.select([married, r['MARS'] == 3], [250e3, 125e3], 200e3)
+    r['niit'] = 0.038 * np.maximum(np.minimum(invinc, r['c00100'] - threshold), 0)
+    # refundable credits for some low-income wage earners
+    lowwage = (r['c00100'] < 50e3) & (r['e00200'] > 0) & (rng.random(n) < 0.4)
+    r['refund'] = np.where(lowwage, rng.uniform(0, 1000 + 2000 * np.minimum(kids, 3)), 0.0)
+    # so that prep_puf's taxac_irs (c09200 - niit - refund) is the draw
+    r['c09200'] = r['taxac_irs'] + r['niit'] + r['refund']
+    r['iitax'] = r['c09200'] - r['refund']
+
+    # weights: stub returns over expected stub records
+    stub_weight = (prof.nret / (prof.pstub * nrecs)).to_numpy()[stub - 1]
+    r['s006'] = stub_weight * rng.lognormal(-WEIGHT_SIGMA**2 / 2, WEIGHT_SIGMA, n)
+    return r
+
+
+# %% frames
+def chunk_sizes(n, chunksize):
+    return [min(chunksize, n - start) for start in range(0, n, chunksize)]
+
+
+def synthetic_chunks(n, kind='tcout', seed=0, chunksize=1_000_000, prof=None):
+    # generator of the dataframes, one per chunk
+    if prof is None:
+        prof = synthetic_profile()
+    sizes = chunk_sizes(n, chunksize)
+    streams = np.random.SeedSequence(seed).spawn(len(sizes))
+    start = 0
+    for size, stream in zip(sizes, streams):
+        r = draw_records(size, np.random.default_rng(stream), prof, nrecs=n)
+        frame = puf_frame if kind == 'puf' else tcout_frame
+        yield frame(r, start)
+        start += size
+
+
+def puf_frame(r, start=0):
+    # the raw puf.csv columns; variables that are not drawn are zero
+    n = r['MARS'].size
+    df = pd.DataFrame({var: r[var] if var in r else np.zeros(n, dtype=np.int64)
+                       for var in pc.pufvars.pufvar})
+    df['RECID'] = start + np.arange(1, n + 1)
+    df['FLPDYR'] = 2011  # the puf's data year; amounts are at 2017 levels
+    df['data_source'] = 1
+    df['agi_bin'] = r['common_stub']
+    df['s006'] = r['s006'] * 100  # puf.csv weights are in hundredths
+    return df
+
+
+def tcout_frame(r, start=0):
+    # tax-calculator output columns for the reweight profile, plus pid and filer
+    n = r['MARS'].size
+    df = pd.DataFrame({var: r[var] if var in r else np.zeros(n)
+                       for var in pc.TC_PROFILES['reweight']})
+    df['RECID'] = start + np.arange(1, n + 1)
+    df['pid'] = start + np.arange(n)
+    df['filer'] = pu.filers(df)
+    return df
+
+
+def synthetic_puf(n, seed=0, chunksize=1_000_000, prof=None):
+    return pd.concat(synthetic_chunks(n, 'puf', seed, chunksize, prof), ignore_index=True)
+
+
+def synthetic_tcout(n, seed=0, chunksize=1_000_000, prof=None):
+    return pd.concat(synthetic_chunks(n, 'tcout', seed, chunksize, prof), ignore_index=True)
+
+
+def synthetic_weights(tcout, shortname='weights_synthetic'):
+    # initial weights in the repo's common format: pid, weight, shortname
+    return pd.DataFrame({'pid': tcout.pid, 'weight': tcout.s006, 'shortname': shortname})
+
+
+def tc_weights(puf, years=range(2011, 2031)):
+    # a weights file for tc.Records from a synthetic raw puf: the same
+    # weight, in hundredths, in every year
+    return pd.DataFrame({'WT' + str(year): puf.s006.round().astype(np.int64)
+                         for year in years})
+
+
+def write_synthetic(path, n, kind='tcout', seed=0, chunksize=1_000_000, prof=None):
+    # write n records (kind 'tcout' or 'puf') a chunk at a time, as parquet row
+    # groups or appended csv; returns path
+    writer = None
+    for i, df in enumerate(synthetic_chunks(n, kind, seed, chunksize, prof)):
+        if path.endswith('.csv'):
+            df.to_csv(path, index=None, mode='w' if i == 0 else 'a', header=i == 0)
+            continue
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(path, table.schema)
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+    return path
+
+
+# %% write the load-test files
+if __name__ == '__main__':
+    # ten times the puf's records, in the PUF_REGROWN layout with initial
+    # weights, and in the raw puf.csv layout run through tax-calculator (2017
+    # amounts, so no growth); see the synthetic puf cell of puf_runall.py
+    import functions_advance_puf as adv  # needs taxcalc
+
+    IGNOREDIR = r'C:\programs_python\puf_analysis\ignore/'
+    PUFDIR = IGNOREDIR + 'puf_versions/'
+    TCOUTDIR = PUFDIR + 'taxcalc_output/'
+    WEIGHTDIR = PUFDIR + 'weights/'
+    GF_ONES = pc.DATADIR + 'growfactors_ones.csv'
+
+    NSYNTH = 10 * 248591
+    PUF_SYNTHETIC = TCOUTDIR + 'puf2017_synthetic.parquet'
+
+    write_synthetic(PUF_SYNTHETIC, NSYNTH, seed=0)
+    weights_synthetic = synthetic_weights(pd.read_parquet(PUF_SYNTHETIC, columns=['pid', 's006']))
+    weights_synthetic.to_csv(WEIGHTDIR + 'weights_synthetic.csv', index=None)
+
+    puf_synth = synthetic_puf(NSYNTH, seed=0)
+    tc_weights(puf_synth).to_csv(PUFDIR + 'weights_synthetic_tc.csv', index=None)
+    adv.advance_puf_extrapolated(puf_synth, 2017,
+                                 gfones=GF_ONES,
+                                 weights=PUFDIR + 'weights_synthetic_tc.csv',
+                                 savepath=TCOUTDIR + 'puf2017_synthetic_tc.parquet')
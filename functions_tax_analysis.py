@@ -0,0 +1,595 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for running Tax-Calculator reforms on the weighted puf and
+preparing their output for analysis.
+
+@author: donbo
+"""
+
+# %% imports
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import taxcalc as tc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from timeit import default_timer as timer
+
+import functions_ht2_analysis as fha
+import functions_reweight_puf as rwp
+import functions_weights as fw
+import puf_constants as pc
+import puf_utilities as pu
+
+
+# %% tax-calculator output
+def prep_tcout(tcout, pidfiler, profile='analysis'):
+    # tax-calculator output with pid, filer, and ht2_stub added; pidfiler is
+    # a frame with the pid and filer of each record, in Records order;
+    # profile is the output profile (see pu.tc_dataframe)
+    df = pu.tc_dataframe(tcout, profile)
+    df['pid'] = pidfiler.pid.to_numpy()
+    df['filer'] = pidfiler.filer.to_numpy()
+
+    df['ht2_stub'] = pd.cut(
+        df['c00100'],
+        pc.HT2_AGI_STUBS,
+        labels=range(1, 11),
+        right=False)
+    # avoid categorical variable, it causes problems!
+    df['ht2_stub'] = df.ht2_stub.astype('int64')
+
+    df = pd.merge(df,
+                  pc.ht2stubs.rename(columns={'ht2stub': 'ht2_stub'}),
+                  how='left', on='ht2_stub')
+    return df
+
+
+# %% batched reforms
+# each reform is run against a base in a worker process; the Records object and
+# the base output frame are handed to each worker once when the pool starts
+# (with fork, where available, the workers share the parent's copies and
+# nothing is pickled)
+_worker = {}
+
+
+def run_reform_batch(reform_names, base_name, reforms, recs, pidfiler, outdir,
+                     workers=4, profile='analysis', cache=None, recs_key=None):
+    # run reforms, each by itself against reforms[base_name], in parallel; output
+    # goes to a ReformStore in outdir, the base in full and each reform as
+    # <reform>_vs_<base>; with a ReformCache, cached runs are loaded, not rerun
+    # returns one row per reform: iitax totals ($ billions), seconds, from cache,
+    # records and variables changed, and the output file
+    a = timer()
+    df_base, wsum_base, _ = cached_reform_frame([reforms[base_name]], recs, pidfiler,
+                                                cache, recs_key, profile, base_name)
+    store = ReformStore(outdir)
+    store.write(base_name, df_base)
+    base_seconds = timer() - a
+    print(f'{base_name:<30} {wsum_base:>9,.0f}  base iitax total in $ billions ({base_seconds:.1f} seconds)')
+
+    # reforms in the cache are written from it; the rest go to the workers,
+    # which also write their frames to the cache for the parent to register
+    keys = {}
+    done = {}
+    if cache is not None:
+        for name in reform_names:
+            keys[name] = cache.key([reforms[base_name], reforms[name]], recs_key,
+                                   recs.current_year, profile)
+            a = timer()
+            cached = cache.load(keys[name])
+            if cached is not None:
+                df, wsum = cached
+                entry = store.write(name + '_vs_' + base_name, df, base_name, df_base)
+                done[name] = (wsum, timer() - a, entry)
+
+    ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else None
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                             initializer=_init_reform_worker,
+                             initargs=(recs, pidfiler, df_base)) as executor:
+        futures = {name: executor.submit(_reform_worker, name, base_name,
+                                         reforms[base_name], reforms[name],
+                                         store.path(name + '_vs_' + base_name),
+                                         profile,
+                                         None if cache is None else cache.path(keys[name]))
+                   for name in reform_names if name not in done}
+        for name in reform_names:
+            cached = name in done
+            if cached:
+                wsum, seconds, entry = done[name]
+            else:
+                wsum, seconds, entry = futures[name].result()
+                store.register(name + '_vs_' + base_name, entry)
+                if cache is not None:
+                    cache.register(keys[name], wsum, name + '_vs_' + base_name)
+            print(f'{name:<30} vs. {base_name} {wsum:>9,.0f}  {wsum_base:>9,.0f}  {wsum - wsum_base:>9,.1f}  ({seconds:.1f} seconds){"  (cached)" if cached else ""}')
+            rows.append({'reform': name, 'base': base_name,
+                         'iitax': wsum, 'iitax_base': wsum_base,
+                         'iitax_change': wsum - wsum_base,
+                         'seconds': seconds,
+                         'cached': cached,
+                         'changed_rows': entry['changed_rows'],
+                         'changed_columns': len(entry['changed_columns']),
+                         'output': store.path(name + '_vs_' + base_name)})
+
+    timings = pd.DataFrame(rows)
+    return timings
+
+
+def reform_iitax(base, reform, recs):
+    # weighted iitax total, $ billions, for base plus optional reform
+    calc = reform_calc(base, reform, recs)
+    return calc.weighted_total('iitax') / 1e9
+
+
+def reform_calc(base, reform, recs):
+    pol = tc.Policy()
+    pol.implement_reform(base)
+    if reform is not None:
+        pol.implement_reform(reform)
+    calc = tc.Calculator(policy=pol, records=recs)
+    calc.calc_all()
+    return calc
+
+
+def _init_reform_worker(recs, pidfiler, df_base):
+    _worker['recs'] = recs
+    _worker['pidfiler'] = pidfiler
+    _worker['df_base'] = df_base
+
+
+def _reform_worker(reform_name, base_name, base, reform, output_name, profile,
+                   cache_path=None):
+    # the worker writes its delta file (and cache file); the parent adds them
+    # to the store and cache indexes
+    a = timer()
+    calc = reform_calc(base, reform, _worker['recs'])
+    wsum = calc.weighted_total('iitax') / 1e9
+    df = prep_tcout(calc, _worker['pidfiler'], profile)
+    if cache_path is not None:
+        df.to_parquet(cache_path, engine='pyarrow', index=False)
+    entry = write_delta(df, _worker['df_base'], output_name)
+    entry['parent'] = base_name
+    return wsum, timer() - a, entry
+
+
+# %% reform result cache
+class ReformCache:
+    # tax-calculator output frames on disk, keyed by a hash of the merged policy,
+    # records, year, profile, and taxcalc version; parquet files plus index.json,
+    # least recently used entries removed past max_bytes
+
+    def __init__(self, cachedir, max_bytes=10e9):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        os.makedirs(cachedir, exist_ok=True)
+        self.index_path = os.path.join(cachedir, 'index.json')
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    def __contains__(self, key):
+        return key in self.index and os.path.exists(self.path(key))
+
+    def __repr__(self):
+        return (f'ReformCache({self.cachedir!r}, {len(self.index)} entries, '
+                f'{self.nbytes / 1e9:.2f} of {self.max_bytes / 1e9:.2f} GB)')
+
+    @property
+    def nbytes(self):
+        return sum(entry['bytes'] for entry in self.index.values())
+
+    def key(self, reform_list, records_key, year, profile='analysis'):
+        spec = {'policy': merge_reforms(reform_list),
+                'records': records_key,
+                'year': int(year),
+                'profile': pc.TC_PROFILES[profile],
+                'taxcalc': tc.__version__}
+        return hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+    def path(self, key):
+        return os.path.join(self.cachedir, 'tc_' + key + '.parquet')
+
+    def load(self, key):
+        # (frame, iitax total in $ billions) for key, or None if not cached
+        if key not in self:
+            return None
+        df = pd.read_parquet(self.path(key), engine='pyarrow')
+        self.index[key]['last_used'] = datetime.now().isoformat(timespec='microseconds')
+        self._save_index()
+        return df, self.index[key]['wsum']
+
+    def save(self, key, df, wsum, label=None):
+        df.to_parquet(self.path(key), engine='pyarrow', index=False)
+        self.register(key, wsum, label)
+
+    def register(self, key, wsum, label=None):
+        # add a written file to the index (workers write files, the parent
+        # registers them), then evict down to max_bytes
+        now = datetime.now().isoformat(timespec='microseconds')
+        self.index[key] = {'bytes': os.path.getsize(self.path(key)),
+                           'wsum': wsum,
+                           'label': label,
+                           'created': now,
+                           'last_used': now}
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        # remove least recently used entries until the cache fits max_bytes
+        # (never keep, the entry just added)
+        for key in sorted(self.index, key=lambda k: self.index[k]['last_used']):
+            if self.nbytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+            del self.index[key]
+        self._save_index()
+
+    def _save_index(self):
+        with open(self.index_path, 'w') as f:
+            json.dump(self.index, f, indent=1)
+
+
+def merge_reforms(reform_list):
+    # the parameter values set by implementing reforms in order, as one dict; a
+    # later reform replaces earlier values from its first year on, as
+    # implement_reform does, so equal policies merge to equal dicts
+    merged = {}
+    for reform in reform_list:
+        for param, values in reform.items():
+            if isinstance(values, dict) and isinstance(merged.get(param, {}), dict):
+                values = {str(year): value for year, value in values.items()}
+                first = min(int(year) for year in values)
+                kept = {year: value for year, value in merged.get(param, {}).items()
+                        if int(year) < first}
+                kept.update(values)
+                merged[param] = kept
+            else:
+                # values in another form are kept in the order implemented
+                merged[param] = [merged.get(param), values]
+    return merged
+
+
+def records_key(data, weights=None, start_year=None):
+    # hash of the data (and weights) a Records object is built from
+    sha = hashlib.sha256()
+    for df in [data, weights]:
+        if df is not None:
+            sha.update(json.dumps(list(map(str, df.columns))).encode())
+            sha.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    sha.update(str(start_year).encode())
+    return sha.hexdigest()[:20]
+
+
+def cached_reform_frame(reform_list, recs, pidfiler, cache=None, recs_key=None,
+                        profile='analysis', label=None):
+    # output frame, iitax total ($ billions), and whether they came from cache,
+    # for reform_list implemented in order
+    if cache is not None:
+        key = cache.key(reform_list, recs_key, recs.current_year, profile)
+        cached = cache.load(key)
+        if cached is not None:
+            return cached + (True,)
+    pol = tc.Policy()
+    for reform in reform_list:
+        pol.implement_reform(reform)
+    calc = tc.Calculator(policy=pol, records=recs)
+    calc.calc_all()
+    wsum = calc.weighted_total('iitax') / 1e9
+    df = prep_tcout(calc, pidfiler, profile)
+    if cache is not None:
+        cache.save(key, df, wsum, label)
+    return df, wsum, False
+
+
+# %% reform output store
+class ReformStore:
+    # reform output frames saved as differences: a frame written with a parent
+    # is saved as a delta, only the changed records (row, pid) and variables
+    # (null where unchanged); frame() rebuilds it from its root and the deltas
+
+    def __init__(self, storedir):
+        self.storedir = storedir
+        os.makedirs(storedir, exist_ok=True)
+        self.index_path = os.path.join(storedir, 'index.json')
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __repr__(self):
+        return f'ReformStore({self.storedir!r}, {len(self.index)} frames)'
+
+    @property
+    def names(self):
+        return list(self.index)
+
+    def path(self, name):
+        return os.path.join(self.storedir, name + '.parquet')
+
+    def write(self, name, df, parent=None, parent_df=None):
+        # in full if parent is None, else as the difference from parent (parent_df
+        # is rebuilt from the store if not given)
+        if parent is None:
+            df.to_parquet(self.path(name), engine='pyarrow', index=False)
+            entry = {'parent': None,
+                     'nrows': len(df),
+                     'columns': list(df.columns),
+                     'changed_rows': len(df),
+                     'changed_columns': [s for s in df.columns if s != 'pid']}
+        else:
+            if parent_df is None:
+                parent_df = self.frame(parent)
+            entry = write_delta(df, parent_df, self.path(name))
+            entry['parent'] = parent
+        self.register(name, entry)
+        return entry
+
+    def register(self, name, entry):
+        # add a written file to the index
+        entry['created'] = datetime.now().isoformat(timespec='seconds')
+        self.index[name] = entry
+        with open(self.index_path, 'w') as f:
+            json.dump(self.index, f, indent=1)
+
+    def chain(self, name):
+        # the full frame that name is built from, then the deltas down to name
+        chain = [name]
+        while self.index[chain[0]]['parent'] is not None:
+            chain.insert(0, self.index[chain[0]]['parent'])
+        return chain
+
+    def columns(self, name):
+        return self.index[self.chain(name)[0]]['columns']
+
+    def frame(self, name, cols=None):
+        # pid plus cols (default all) of the frame saved as name
+        chain = self.chain(name)
+        if cols is None:
+            cols = self.columns(name)
+        else:
+            cols = ['pid'] + [s for s in cols if s != 'pid']
+        df = pd.read_parquet(self.path(chain[0]), engine='pyarrow', columns=cols)
+        for step in chain[1:]:
+            retyped = {col: dtype for col, dtype in self.index[step].get('dtypes', {}).items()
+                       if col in df.columns}
+            df = df.astype(retyped)
+            for col, (rows, values) in self.delta(step, cols).items():
+                colvals = df[col].to_numpy(copy=True)
+                colvals[rows] = values
+                df[col] = colvals
+        return df
+
+    def delta(self, name, cols=None):
+        # {variable: (rows, values)} for the variables name changes from its
+        # parent, with rows as positions in the frame
+        changed = [s for s in self.index[name]['changed_columns']
+                   if cols is None or s in cols]
+        table = pq.read_table(self.path(name), columns=['row'] + changed)
+        rows = table['row'].to_numpy()
+        delta = {}
+        for col in changed:
+            arr = table[col].combine_chunks()
+            valid = arr.is_valid().to_numpy(zero_copy_only=False)
+            delta[col] = (rows[valid], arr.drop_null().to_numpy(zero_copy_only=False))
+        return delta
+
+    def changes(self, name):
+        # the delta file as a frame: row, pid, and changed variables (NaN or
+        # None where a variable did not change for a record)
+        return pd.read_parquet(self.path(name), engine='pyarrow')
+
+
+def write_delta(df, parent_df, path):
+    # write the records and variables of df that differ from parent_df (same
+    # columns and pids, in order); returns the index entry, less its parent,
+    # with the dtypes of the variables whose dtype differs from parent_df
+    if list(df.columns) != list(parent_df.columns):
+        raise ValueError('frame and parent frame must have the same columns')
+    if not np.array_equal(df.pid.to_numpy(), parent_df.pid.to_numpy()):
+        raise ValueError('frame and parent frame must have the same pids, in the same order')
+
+    masks = {}
+    for col in df.columns.drop('pid'):
+        values = df[col].to_numpy()
+        parent_values = parent_df[col].to_numpy()
+        changed = values != parent_values
+        if values.dtype.kind == 'f':
+            changed &= ~(np.isnan(values) & np.isnan(parent_values))
+        if changed.any():
+            masks[col] = changed
+    if masks:
+        rows = np.flatnonzero(np.logical_or.reduce(list(masks.values())))
+    else:
+        rows = np.array([], dtype='int64')
+
+    arrays = {'row': pa.array(rows),
+              'pid': pa.array(df.pid.to_numpy()[rows])}
+    for col, changed in masks.items():
+        arrays[col] = pa.array(df[col].to_numpy()[rows], mask=~changed[rows])
+    pq.write_table(pa.table(arrays), path)
+    return {'nrows': len(df),
+            'changed_rows': len(rows),
+            'changed_columns': list(masks),
+            'dtypes': {col: str(df[col].dtype) for col in df.columns
+                       if df[col].dtype != parent_df[col].dtype}}
+
+
+# %% reform stacks
+class ReformStack:
+    # stacks of reforms, each step adding a reform to the policy before it
+    # steps are kept by prefix (the tuple of reform names through the step), so
+    # stacks with a shared prefix compute it once; only the max_frames most recent
+    # output frames stay in memory, and with a ReformCache steps are also on disk
+
+    def __init__(self, reforms, recs, pidfiler, outdir, profile='analysis',
+                 max_frames=4, cache=None, recs_key=None):
+        self.reforms = reforms
+        self.recs = recs
+        self.pidfiler = pidfiler
+        self.outdir = outdir
+        self.profile = profile
+        self.max_frames = max_frames
+        self.cache = cache
+        self.recs_key = recs_key
+        self.steps = {}  # prefix -> iitax total in $ billions
+        self._frames = {}  # prefix -> output frame from prep_tcout
+        self._first = {}  # one-step prefix -> output frame, never evicted
+
+    def run(self, order, name):
+        # run the stack, write its steps to outdir/name/ as <order>_<reform>, and
+        # return iitax totals and changes ($ billions) by step, with seconds in this
+        # run and the frame's source: computed, disk (the cache), or memory
+        store = ReformStore(os.path.join(self.outdir, name))
+
+        rows = []
+        pending = []
+        wsum_prior = 0
+        step_prior = None
+        df_prior = None
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            for i, reform_name in enumerate(order):
+                prefix = tuple(order[:i + 1])
+                a = timer()
+                df, source = self._step(prefix)
+                seconds = timer() - a
+                wsum = self.steps[prefix]
+                wsum_change = wsum - wsum_prior
+                print(f'{reform_name:<30} {wsum:>9,.0f}  {wsum_change:>9,.1f}  iitax total and change in $ billions  ({source})')
+
+                # the prior step's frame is held here, so the delta is written
+                # from it even if it has been evicted from memory
+                step_name = str(i) + '_' + reform_name
+                pending.append(writer.submit(store.write, step_name, df,
+                                             step_prior, df_prior))
+
+                rows.append({'order': i, 'reform': reform_name, 'iitax': wsum,
+                             'iitax_change': wsum_change, 'seconds': seconds,
+                             'source': source, 'output': store.path(step_name)})
+                wsum_prior = wsum
+                step_prior = step_name
+                df_prior = df
+            for future in pending:
+                future.result()
+
+        return pd.DataFrame(rows)
+
+    def _step(self, prefix):
+        # output frame after the reforms in prefix and where it came from,
+        # computing (or loading from cache) and keeping the step
+        if prefix in self._frames:
+            self._frames[prefix] = self._frames.pop(prefix)  # most recently used
+            return self._frames[prefix], 'memory'
+
+        if prefix in self._first:
+            return self._keep(prefix, self._first[prefix]), 'memory'
+
+        df, wsum, cached = cached_reform_frame([self.reforms[name] for name in prefix],
+                                               self.recs, self.pidfiler,
+                                               self.cache, self.recs_key,
+                                               self.profile, ' + '.join(prefix))
+        if len(prefix) == 1:
+            self._first[prefix] = df
+        self.steps[prefix] = wsum
+        return self._keep(prefix, df), 'disk' if cached else 'computed'
+
+    def _keep(self, prefix, df):
+        self._frames[prefix] = df
+        while len(self._frames) > self.max_frames:
+            self._frames.pop(next(iter(self._frames)))
+        return df
+
+
+# %% distributional tables
+def dist_table(store, names, varnames, weights=None, areas=None, batch_size=65536):
+    # weighted sums by reform, area, ht2 stub, and variable for frames of a store
+    # that share a root ('nret' counts records); weights is a state weight set
+    # (WeightMatrix or allweights-style frame; missing pids get 0) and areas its
+    # areas plus 'US' (see area_weights); if None, 'US' with s006. the root is read batch_size
+    # records at a time, with each frame's deltas applied, and stubs follow each
+    # frame's own agi. returns reform, area, ht2_stub (0 is all), ht2range,
+    # variable, wsum
+    chains = {name: store.chain(name) for name in names}
+    roots = {chain[0] for chain in chains.values()}
+    if len(roots) > 1:
+        raise ValueError('frames must be built from the same root frame, not ' + ', '.join(roots))
+    root = roots.pop()
+
+    sumvars = [s for s in varnames if s != 'nret']
+    readvars = ['ht2_stub'] + sumvars + (['s006'] if weights is None else [])
+    readvars = list(dict.fromkeys(readvars))
+    steps = dict.fromkeys(step for chain in chains.values() for step in chain[1:])
+    deltas = {step: store.delta(step, readvars) for step in steps}
+
+    pf = pq.ParquetFile(store.path(root))
+    if weights is None:
+        areas = ['US']
+    else:
+        pids = pf.read(columns=['pid'])['pid'].to_numpy()
+        wmat, areas = area_weights(pids, weights, areas)
+
+    nstubs = len(pc.HT2_AGI_STUBS)  # 10 stubs plus stub 0, the total
+    tables = np.zeros((len(names), len(areas), nstubs, len(varnames)))
+    start = 0
+    for batch in pf.iter_batches(batch_size=batch_size, columns=readvars):
+        end = start + batch.num_rows
+        base = {col: batch[col].to_numpy(zero_copy_only=False) for col in readvars}
+        for i, name in enumerate(names):
+            cols = dict(base)
+            for step in chains[name][1:]:
+                for col, (rows, values) in deltas[step].items():
+                    lo, hi = np.searchsorted(rows, [start, end])
+                    if hi > lo:
+                        if cols[col] is base[col]:
+                            # a copy, in the delta's dtype if it changed
+                            cols[col] = base[col].astype(np.result_type(base[col], values))
+                        cols[col][rows[lo:hi] - start] = values[lo:hi]
+            xmat = np.column_stack([np.ones(end - start) if s == 'nret' else cols[s]
+                                    for s in varnames])
+            wbatch = cols['s006'].reshape(-1, 1) if weights is None else wmat[start:end]
+            cube = fha.get_allstates_cube(xmat, wbatch, cols['ht2_stub'])
+            tables[i, :, :cube.shape[1], :] += cube
+        start = end
+
+    nr, na, ns, nv = tables.shape
+    df = pd.DataFrame({'reform': np.repeat(names, na * ns * nv),
+                       'area': np.tile(np.repeat(areas, ns * nv), nr),
+                       'ht2_stub': np.tile(np.repeat(np.arange(ns), nv), nr * na),
+                       'variable': np.tile(varnames, nr * na * ns),
+                       'wsum': tables.ravel()})
+    df = pd.merge(df,
+                  pc.ht2stubs.rename(columns={'ht2stub': 'ht2_stub'}),
+                  how='left', on='ht2_stub')
+    return df[['reform', 'area', 'ht2_stub', 'ht2range', 'variable', 'wsum']]
+
+
+def area_weights(pids, weights, areas=None):
+    # n x len(areas) weights in the order of pids, and the areas (see
+    # dist_table); every column of weights but pid, ht2_stub, weight,
+    # geoweight_sum, and shortname is an area (a state, or a group such as
+    # 'other'), and 'US' is the sum over all of them
+    if isinstance(weights, fw.WeightMatrix):
+        weights = weights.frame()
+    allareas = [s for s in weights.columns
+                if s not in ['pid', 'ht2_stub', 'weight', 'geoweight_sum', 'shortname']]
+    if areas is None:
+        areas = allareas + ['US']
+    wareas = rwp.align_weights(pids, weights.loc[:, ['pid'] + allareas])
+    wmat = np.column_stack([wareas.sum(axis=1) if area == 'US'
+                            else wareas[:, allareas.index(area)]
+                            for area in areas])
+    return wmat, areas
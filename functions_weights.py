@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Binary weight store: <base>.npy (n x k, column order, memory-mapped on
+load), <base>_pid.npy (row pids), and <base>.json (columns and provenance).
+"""
+
+# %% imports
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+
+# %% save and load
+def save_weights(df, base, shortname=None, provenance=None, dtype='float64'):
+    # save a weights frame (pid plus weight columns); a shortname column goes to
+    # the sidecar, integer columns are stored as floats and restored by frame()
+    if shortname is None and 'shortname' in df.columns:
+        shortname = df['shortname'].iloc[0]
+    cols = [s for s in df.columns if s not in ['pid', 'shortname']]
+    int_cols = [s for s in cols if pd.api.types.is_integer_dtype(df[s])]
+
+    mat = np.asfortranarray(df[cols].to_numpy(dtype=dtype))
+    np.save(base + '.npy', mat)
+    np.save(base + '_pid.npy', df['pid'].to_numpy())
+
+    meta = {'columns': cols,
+            'dtype': np.dtype(dtype).str,
+            'int_columns': int_cols,
+            'shortname': shortname,
+            'nrows': len(df),
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'provenance': provenance}
+    with open(base + '.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+    return WeightMatrix(base)
+
+
+def load_weights(base, mmap=True):
+    return WeightMatrix(base, mmap=mmap)
+
+
+def csv_to_weights(csvpath, base=None, provenance=None, dtype='float64'):
+    # convert an existing weights csv (pid plus weights) to the binary store,
+    # next to the csv unless base is given
+    if base is None:
+        base = os.path.splitext(csvpath)[0]
+    if provenance is None:
+        provenance = {'source': os.path.basename(csvpath)}
+    return save_weights(pd.read_csv(csvpath), base, provenance=provenance, dtype=dtype)
+
+
+def weights_exist(base):
+    return all(os.path.exists(base + ext) for ext in ['.npy', '_pid.npy', '.json'])
+
+
+class WeightMatrix:
+    # a memory-mapped weight set; col() is a zero-copy view of a column
+
+    def __init__(self, base, mmap=True):
+        self.base = base
+        with open(base + '.json') as f:
+            self.meta = json.load(f)
+        self.columns = self.meta['columns']
+        self.shortname = self.meta['shortname']
+        self.pid = np.load(base + '_pid.npy')
+        self.values = np.load(base + '.npy', mmap_mode='r' if mmap else None)
+        self._colidx = {name: j for j, name in enumerate(self.columns)}
+
+    def __len__(self):
+        return self.pid.size
+
+    def __repr__(self):
+        return (f'WeightMatrix({self.base!r}, shortname={self.shortname!r}, '
+                f'{len(self)} rows x {len(self.columns)} columns)')
+
+    def col(self, name):
+        return self.values[:, self._colidx[name]]
+
+    def frame(self, cols=None):
+        # pid plus cols (default all), with integer columns restored
+        if cols is None:
+            cols = self.columns
+        df = pd.DataFrame({'pid': self.pid})
+        for name in cols:
+            values = self.col(name)
+            if name in self.meta['int_columns']:
+                values = values.astype('int64')
+            df[name] = values
+        return df
+
+
+# %% derived weight sets
+def scale_weights(base, newbase, factor, cols=None, provenance=None):
+    # save a copy with cols (default: all but integer columns) multiplied by
+    # factor, e.g., wtgrowfactor; a column at a time from the memory map
+    wm = WeightMatrix(base)
+    if cols is None:
+        cols = [s for s in wm.columns if s not in wm.meta['int_columns']]
+
+    out = np.lib.format.open_memmap(newbase + '.npy', mode='w+',
+                                    dtype=wm.values.dtype,
+                                    shape=wm.values.shape,
+                                    fortran_order=True)
+    for j, name in enumerate(wm.columns):
+        out[:, j] = wm.values[:, j] * factor if name in cols else wm.values[:, j]
+    out.flush()
+    del out
+    np.save(newbase + '_pid.npy', wm.pid)
+
+    meta = dict(wm.meta)
+    meta['created'] = datetime.now().isoformat(timespec='seconds')
+    meta['provenance'] = {'scaled_from': os.path.basename(base),
+                          'factor': float(factor),
+                          'scaled_columns': cols,
+                          'notes': provenance}
+    with open(newbase + '.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+    return WeightMatrix(newbase)
+
+
+# %% weight registry
+WEIGHT_FILE_PATTERN = r'^(?P<all>all)?weights(?P<year>\d{4})_(?P<stage>.+)$'
+
+
+class WeightRegistry:
+    # the weights<year>_<stage> and allweights<year>_<stage> sets in weightdir, csv
+    # or binary (preferred), indexed without reading; a set is read on first use
+    # into one pid-aligned matrix, so comparisons need no merges
+
+    def __init__(self, weightdir):
+        self.weightdir = weightdir
+        self.index = self.scan()
+        self._pid = pd.Index([], dtype='int64')
+        self._mat = np.empty((0, 0), order='F')
+        self._ncols = 0
+        self._cols = {}  # name -> {column: matrix column position}
+        self._int_cols = set()  # (name, column) pairs to return as integers
+
+    def scan(self):
+        rows = []
+        for fname in sorted(os.listdir(self.weightdir)):
+            stem, ext = os.path.splitext(fname)
+            match = re.match(WEIGHT_FILE_PATTERN, stem)
+            if match is None or ext not in ['.csv', '.json']:
+                continue
+            path = os.path.join(self.weightdir, fname)
+            if ext == '.json':
+                with open(path) as f:
+                    meta = json.load(f)
+                fmt, columns, shortname = 'store', meta['columns'], meta['shortname']
+            else:
+                head = pd.read_csv(path, nrows=1)
+                fmt = 'csv'
+                columns = [s for s in head.columns if s not in ['pid', 'shortname']]
+                shortname = head['shortname'].iloc[0] if 'shortname' in head.columns else None
+            rows.append({'name': stem,
+                         'shortname': stem if shortname is None else shortname,
+                         'year': int(match.group('year')),
+                         'stage': match.group('stage'),
+                         'states': match.group('all') is not None,
+                         'format': fmt,
+                         'columns': columns,
+                         'path': os.path.join(self.weightdir, stem)})
+        index = pd.DataFrame(rows, columns=['name', 'shortname', 'year', 'stage', 'states',
+                                            'format', 'columns', 'path'])
+        # prefer the binary store when a set is saved both ways
+        index = index.sort_values(['name', 'format'], ascending=[True, False])
+        return index.drop_duplicates('name').set_index('name', drop=False)
+
+    def select(self, year=None, stage=None, states=None):
+        # index rows for a year, stage, and/or national (states=False) or
+        # state (states=True) weight sets
+        m = np.ones(len(self.index), dtype=bool)
+        if year is not None:
+            m &= self.index.year.eq(year).to_numpy()
+        if stage is not None:
+            m &= self.index.stage.eq(stage).to_numpy()
+        if states is not None:
+            m &= self.index.states.eq(states).to_numpy()
+        return self.index[m]
+
+    def name(self, key):
+        # a weight set may be given by name or by shortname
+        if key in self.index.index:
+            return key
+        names = self.index.index[self.index.shortname == key]
+        if len(names) != 1:
+            raise KeyError(f'{key} is not the name or unique shortname of a weight set')
+        return names[0]
+
+    @property
+    def pid(self):
+        return self._pid.to_numpy()
+
+    @property
+    def loaded(self):
+        return list(self._cols)
+
+    def values(self, key, cols=None):
+        # n x len(cols) matrix of a weight set's columns, rows in pid order,
+        # NaN for pids that are not in the set
+        name = self.name(key)
+        if name not in self._cols:
+            self._load(name)
+        if cols is None:
+            cols = list(self._cols[name])
+        return self._mat[:, [self._cols[name][s] for s in cols]]
+
+    def wide(self, keys=None):
+        # pid plus the weight column of each national weight set (default:
+        # all of them), named by shortname
+        if keys is None:
+            keys = self.select(states=False).name.tolist()
+        names = [self.name(key) for key in keys]
+        # load every set first, since a set loaded later may add pids (rows)
+        for name in names:
+            if name not in self._cols:
+                self._load(name)
+        mat = np.column_stack([self.values(name, ['weight']) for name in names])
+        df = pd.DataFrame(mat, columns=self.index.loc[names, 'shortname'].tolist())
+        df.insert(0, 'pid', self.pid)
+        return df.sort_values(by='pid', ignore_index=True)
+
+    def long(self, keys=None):
+        # pid, shortname, weight for national weight sets stacked, with only
+        # the records in each set
+        wide = self.wide(keys)
+        shortnames = wide.columns[1:]
+        vals = wide[shortnames].to_numpy()
+        rows, cols = np.nonzero(~np.isnan(vals))
+        return pd.DataFrame({'pid': wide.pid.to_numpy()[rows],
+                             'shortname': shortnames[cols],
+                             'weight': vals[rows, cols]})
+
+    def frame(self, key, cols=None):
+        # pid plus a weight set's columns, e.g., all the state weights of an
+        # allweights set, for records in the set
+        name = self.name(key)
+        if cols is None:
+            self.values(name)
+            cols = list(self._cols[name])
+        mat = self.values(name, cols)
+        keep = ~np.isnan(mat).all(axis=1)
+        df = pd.DataFrame(mat[keep], columns=cols)
+        for col in cols:
+            if (name, col) in self._int_cols:
+                df[col] = df[col].astype('int64')
+        df.insert(0, 'pid', self.pid[keep])
+        return df.sort_values(by='pid', ignore_index=True)
+
+    def _load(self, name):
+        entry = self.index.loc[name]
+        if entry.format == 'store':
+            wm = WeightMatrix(entry.path)
+            pids, cols = wm.pid, wm.columns
+            values = np.asarray(wm.values, dtype=float)
+            int_cols = wm.meta['int_columns']
+        else:
+            df = pd.read_csv(entry.path + '.csv').drop(columns='shortname', errors='ignore')
+            pids = df.pid.to_numpy()
+            cols = [s for s in df.columns if s != 'pid']
+            int_cols = [s for s in cols if pd.api.types.is_integer_dtype(df[s])]
+            values = df[cols].to_numpy(dtype=float)
+
+        # add rows for pids not seen before, then columns for this set
+        new = pd.Index(pids).difference(self._pid)
+        if len(new) > 0:
+            self._pid = self._pid.append(new)
+            self._grow(len(self._pid), self._mat.shape[1])
+        if self._ncols + len(cols) > self._mat.shape[1]:
+            self._grow(len(self._pid), max(2 * self._mat.shape[1], self._ncols + len(cols)))
+
+        loc = self._pid.get_indexer(pids)
+        self._cols[name] = {}
+        for j, col in enumerate(cols):
+            self._mat[loc, self._ncols] = values[:, j]
+            self._cols[name][col] = self._ncols
+            self._ncols += 1
+        self._int_cols.update((name, col) for col in int_cols)
+
+    def _grow(self, nrows, ncols):
+        mat = np.full((nrows, ncols), np.nan, order='F')
+        mat[:self._mat.shape[0], :self._mat.shape[1]] = self._mat
+        self._mat = mat
@@ -87,7 +87,7 @@ pol = tc.Policy()
 calc = tc.Calculator(policy=pol, records=recs)
 calc.advance_to_year(2017)
 calc.calc_all()
-puf2017_default = calc.dataframe(variable_list=[], all_vars=True)
+puf2017_default = pu.tc_dataframe(calc, 'full')
 puf2017_default['pid'] = np.arange(len(puf2017_default))
 
 puf2017_default.to_parquet(PUFOUTDIR + 'puf2017_default' + '.parquet', engine='pyarrow')
@@ -116,7 +116,7 @@ pol = tc.Policy()
 calc_extrap = tc.Calculator(policy=pol, records=recs_extrap)
 calc_extrap.advance_to_year(2017)
 calc_extrap.calc_all()
-puf2017_regrown = calc_extrap.dataframe(variable_list=[], all_vars=True)
+puf2017_regrown = pu.tc_dataframe(calc_extrap, 'full')  # full: read back in as Records data
 puf2017_regrown['pid'] = np.arange(len(puf2017_regrown))
 
 puf2017_regrown.to_parquet(PUFOUTDIR + 'puf2017_regrown' + '.parquet', engine='pyarrow')
@@ -139,7 +139,7 @@ pol = tc.Policy()
 calc = tc.Calculator(policy=pol, records=recs)
 calc.advance_to_year(2018)
 calc.calc_all()
-puf2018 = calc.dataframe(variable_list=[], all_vars=True)
+puf2018 = pu.tc_dataframe(calc, 'full')
 puf2018['pid'] = np.arange(len(puf2018))
 
 puf2018.to_parquet(PUFOUTDIR + 'puf2018' + '.parquet', engine='pyarrow')
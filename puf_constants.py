@@ -6,6 +6,7 @@ Created on Thu Oct 15 04:29:41 2020
 """
 
 # %% imports
+import os
 import pandas as pd
 import json
 
@@ -16,7 +17,7 @@ WEBDIR = 'https://www.irs.gov/pub/irs-soi/'
 HT2_2017 = "17in55cmagi.csv"
 HT2_2018 = "18in55cmagi.csv"
 
-DATADIR = r'C:\programs_python\puf_analysis\data/'
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data') + '/'  # this repo's data folder
 TARGET_MAP = DATADIR + 'target_mappings.csv'
 
 
@@ -79,6 +80,52 @@ ht2puf_fullmap = json.load(open(DATADIR + 'ht2puf_fullmap.json'))
 
 pufvars = pd.read_csv(DATADIR + 'pufvars.csv')
 
+# filing thresholds by year, MARS, and number of people aged 65+ (head, plus
+# spouse if MARS 2); add a year by adding rows, see puf_utilities.filers
+FILING_THRESHOLDS = pd.read_csv(DATADIR + 'filing_thresholds.csv')
+
+
+# %% tax-calculator output profiles
+# variables to keep from calc.dataframe for each use of tax-calculator output;
+# None means all variables (all_vars=True), which any file that is read back in
+# as tc.Records data (e.g., puf2017_regrown, puf2018) must have.
+# see puf_utilities.tc_dataframe
+
+# record identifiers, weight, and what puf_utilities.filers needs
+TC_ID_VARS = ['RECID', 'MARS', 'XTOT', 'age_head', 'age_spouse', 's006']
+TC_FILER_VARS = ['c00100', 'c02900', 'c23650', 'c01000', 'e01200', 'e00900',
+                 'e02000', 'e02100', 'iitax', 'c07100', 'refund', 'e00200']
+
+# tax-calculator variables behind the national and ht2 targets: each target
+# name in the two target maps, less a trailing _nnz and then a trailing pos
+# or neg when what is left is itself a target name (c01000pos_nnz -> c01000),
+# less the targets prep_puf constructs, plus what taxac_irs is constructed from
+TARGET_NAMES = list(dict.fromkeys(list(pufirs_fullmap.keys()) + list(ht2puf_fullmap.values())))
+PREP_CONSTRUCTED_VARS = ['nret_all', 'mars1', 'mars2', 'mars3', 'mars4', 'mars5', 'taxac_irs']
+
+
+def target_base(name, names=TARGET_NAMES):
+    if name.endswith('_nnz') and name[:-4] in names:
+        name = name[:-4]
+    if name.endswith(('pos', 'neg')) and name[:-3] in names:
+        name = name[:-3]
+    return name
+
+
+TC_TARGET_VARS = [s for s in dict.fromkeys(target_base(s) for s in TARGET_NAMES)
+                  if s not in PREP_CONSTRUCTED_VARS] + ['c09200', 'niit']
+
+# tax components for reform analysis
+TC_TAX_VARS = ['iitax', 'payrolltax', 'combined', 'taxbc', 'c04470', 'standard',
+               'c04600', 'qbided', 'c04800', 'c05800', 'c07100', 'c09200',
+               'c09600', 'c62100', 'eitc', 'niit', 'othertaxes', 'refund']
+
+TC_PROFILES = {
+    'reweight': list(dict.fromkeys(TC_ID_VARS + TC_FILER_VARS + TC_TARGET_VARS)),
+    'analysis': list(dict.fromkeys(TC_ID_VARS + TC_FILER_VARS + TC_TARGET_VARS + TC_TAX_VARS)),
+    'full': None}
+
+
 # %% target varnames (puf names and HT2 names and my names)
 targvars_all = ['nret_all', 'nret_mars1', 'nret_mars2', 'c00100', 'e00300', 'e00600']
 
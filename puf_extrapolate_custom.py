@@ -10,7 +10,232 @@ Created on Mon Nov  2 07:27:39 2020
 
 """
 
+import os
 import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# %% declarative growfactor map
+# variable: growfactor name, as applied by extrapolate_custom
+GF_MAP = {
+    # MAIN INCOME COMPONENTS
+    'e00200': 'AWAGE',
+    'e00200p': 'AWAGE',
+    'e00200s': 'AWAGE',
+    'pencon_p': 'AWAGE',
+    'pencon_s': 'AWAGE',
+    'e00300': 'AINTS',
+    'e00400': 'AINTS',
+    'e00600': 'ADIVS_ADJ',  # djb changed from ADIVS
+    'e00650': 'ADIVS_ADJ',  # djb changed from ADIVS
+    'e00700': 'ATXPY',
+    'e00800': 'ATXPY',
+    'e01100': 'ACGNS',
+    'e01200': 'ACGNS',
+    'e01400': 'ATXPY',
+    'e01500': 'ATXPY',
+    'e01700': 'ATXPY',
+    'e02100': 'ASCHF',
+    'e02100p': 'ASCHF',
+    'e02100s': 'ASCHF',
+    'e02300': 'AUCOMP',
+    'e02400': 'ASOCSEC',
+    'e03150': 'ATXPY',
+    'e03210': 'ATXPY',
+    'e03220': 'ATXPY',
+    'e03230': 'ATXPY',
+    'e03270': 'ACPIM',
+    'e03240': 'ATXPY',
+    'e03290': 'ACPIM',
+    'e03300': 'ATXPY',
+    'e03400': 'ATXPY',
+    'e03500': 'ATXPY',
+    'e07240': 'ATXPY',
+    'e07260': 'ATXPY',
+    'e07300': 'ABOOK',
+    'e07400': 'ABOOK',
+    'p08000': 'ATXPY',
+    'e09700': 'ATXPY',
+    'e09800': 'ATXPY',
+    'e09900': 'ATXPY',
+    'e11200': 'ATXPY',
+    # ITEMIZED DEDUCTIONS
+    'e17500': 'ACPIM',
+    'e18400': 'ASALT',  # changed from ATXPY
+    'e18500': 'ASALT',  # changed from ATXPY
+    'e19200': 'AIPD',
+    'e19800': 'ACHARITY',  # changed from ATXPY
+    'e20100': 'ACHARITY',  # changed from ATXPY
+    'e20400': 'ATXPY',
+    'g20500': 'ATXPY',
+    # CAPITAL GAINS
+    'p22250': 'ACGNS',
+    'p23250': 'ACGNS',
+    'e24515': 'ACGNS',
+    'e24518': 'ACGNS',
+    # SCHEDULE E
+    'e26270': 'ASCHEI_ADJ',  # djb
+    'e27200': 'ASCHEI_ADJ',  # djb
+    'k1bx14p': 'ASCHEI_ADJ',  # djb
+    'k1bx14s': 'ASCHEI_ADJ',  # djb
+    # MISCELLANOUS SCHEDULES
+    'e07600': 'ATXPY',
+    'e32800': 'ATXPY',
+    'e58990': 'ATXPY',
+    'e62900': 'ATXPY',
+    'e87530': 'ATXPY',
+    'e87521': 'ATXPY',
+    'cmbtp': 'ATXPY',
+    }
+
+# variables whose growfactor depends on sign: variable: (factor if >= 0, factor if < 0)
+GF_SIGNED_MAP = {
+    'e00900s': ('ASCHCI_ADJ', 'ASCHCL_ADJ'),  # djb
+    'e00900p': ('ASCHCI_ADJ', 'ASCHCL_ADJ'),  # djb
+    'e02000': ('ASCHEI_ADJ', 'ASCHEL_ADJ'),  # djb
+    }
+
+# variables recomputed from already-grown components: variable: components to add
+GF_SUM_MAP = {
+    'e00900': ['e00900p', 'e00900s'],
+    }
+
+
+def cumulative_growfactors(gf_custom, year):
+    """Return a Series of cumulative growfactors from 2011 to year, by growfactor name."""
+    gfv = gf_custom.drop(columns='YEAR')
+    return gfv.cumprod().iloc[year - 2011]
+
+
+def factor_vectors(gf_custom, year):
+    """Build the factor vectors used by extrapolate_chunk for one year.
+
+    Returns a dict with the variable names and factors for GF_MAP and the
+    positive and negative factors for GF_SIGNED_MAP.
+    """
+    cumgf = cumulative_growfactors(gf_custom, year)
+    svars = list(GF_SIGNED_MAP)
+    return {'vars': list(GF_MAP),
+            'factors': cumgf[list(GF_MAP.values())].to_numpy(dtype=float),
+            'svars': svars,
+            'pos': cumgf[[GF_SIGNED_MAP[var][0] for var in svars]].to_numpy(dtype=float),
+            'neg': cumgf[[GF_SIGNED_MAP[var][1] for var in svars]].to_numpy(dtype=float)}
+
+
+def extrapolate_chunk(df, fvec):
+    """Grow the variables of df (a puf chunk we own) in place using factor_vectors output."""
+    df[fvec['vars']] = df[fvec['vars']].to_numpy(dtype=float) * fvec['factors']
+
+    x = df[fvec['svars']].to_numpy(dtype=float)
+    df[fvec['svars']] = np.where(x >= 0, x * fvec['pos'], x * fvec['neg'])
+
+    for var, components in GF_SUM_MAP.items():
+        df[var] = df[components].to_numpy(dtype=float).sum(axis=1)
+    return df
+
+
+def extrapolate_custom_stream(source, gf_custom, year, savepath, chunksize=50000):
+    """Extrapolate a puf file to year in chunks and write it to a parquet file.
+
+    source is a csv or parquet file; only one chunk is held in memory at a
+    time, so files much larger than puf.csv (e.g., synthetic expansions) can
+    be grown. The factors are built once for the year.
+    """
+    fvec = factor_vectors(gf_custom, year)
+
+    writers = {}
+    nrecs = 0
+    try:
+        for chunk in read_chunks(source, chunksize):
+            chunk = extrapolate_chunk(chunk, fvec)
+            write_chunk(writers, year, chunk, savepath)
+            nrecs += len(chunk)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    print(f'extrapolated {nrecs:,} records to {year}, saved to {savepath}')
+    return None
+
+
+def extrapolate_custom_years(source, gf_custom, years, savedir, chunksize=50000):
+    """Extrapolate a puf file to several years in one pass over the file.
+
+    Writes two parquet datasets in savedir, keyed by the row number of the
+    source record (column row):
+        savedir/shared/part-0.parquet            columns not changed by growfactors, once
+        savedir/years/year=YYYY/part-0.parquet   the grown columns for each year
+
+    savedir/years is a hive-partitioned dataset (e.g., pyarrow.dataset with
+    partitioning='hive') with one partition per year. The shared columns are
+    outside it, so readers join them to a year's grown columns on row; see
+    read_extrapolated_year. The cumulative factors for all years are built at
+    once and each chunk of the source is read once.
+    """
+    years = list(years)
+    fmat = {year: factor_vectors(gf_custom, year) for year in years}
+    growvars = list(GF_MAP) + list(GF_SIGNED_MAP) + list(GF_SUM_MAP)
+
+    shareddir = os.path.join(savedir, 'shared')
+    os.makedirs(shareddir, exist_ok=True)
+    writers = {}
+    nrecs = 0
+    try:
+        for chunk in read_chunks(source, chunksize):
+            rows = np.arange(nrecs, nrecs + len(chunk))
+            shared = chunk.drop(columns=growvars)
+            shared.insert(0, 'row', rows)
+            grown = chunk[growvars]
+            write_chunk(writers, 'shared', shared, os.path.join(shareddir, 'part-0.parquet'))
+            for year in years:
+                ychunk = extrapolate_chunk(grown.copy(), fmat[year])
+                ychunk.insert(0, 'row', rows)
+                ydir = os.path.join(savedir, 'years', 'year=' + str(year))
+                os.makedirs(ydir, exist_ok=True)
+                write_chunk(writers, year, ychunk, os.path.join(ydir, 'part-0.parquet'))
+            nrecs += len(chunk)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    print(f'extrapolated {nrecs:,} records to {years}, saved to {savedir}')
+    return None
+
+
+def read_extrapolated_year(savedir, year):
+    """Return the full extrapolated puf for year from an extrapolate_custom_years dataset.
+
+    The shared and grown columns are joined on row, and the records are in
+    source order.
+    """
+    shared = pd.read_parquet(os.path.join(savedir, 'shared'), engine='pyarrow')
+    grown = pd.read_parquet(os.path.join(savedir, 'years', 'year=' + str(year)),
+                            engine='pyarrow')
+    puf = pd.merge(shared, grown, on='row', how='inner', validate='one_to_one')
+    return puf.sort_values('row').drop(columns='row').reset_index(drop=True)
+
+
+def write_chunk(writers, key, df, path):
+    # append a chunk to the parquet file for key, opening it on first use
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if key not in writers:
+        writers[key] = pq.ParquetWriter(path, table.schema)
+    writers[key].write_table(table.cast(writers[key].schema))
+
+
+def read_chunks(source, chunksize):
+    # yield dataframe chunks of a csv or parquet file
+    if source.endswith('.parquet'):
+        pfile = pq.ParquetFile(source)
+        for batch in pfile.iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        # grown amounts are read as float so every chunk has the same schema
+        # for them; other columns are cast to the first chunk's schema when written
+        growvars = list(GF_MAP) + list(GF_SIGNED_MAP) + list(GF_SUM_MAP)
+        for chunk in pd.read_csv(source, chunksize=chunksize,
+                                 dtype={var: 'float64' for var in growvars}):
+            yield chunk
 
 
 def extrapolate_custom(puf, gf_custom, year=2017):
@@ -43,115 +268,15 @@ def extrapolate_custom(puf, gf_custom, year=2017):
 
     # apply values to Records variables
 
-    pufx = puf.copy()
-
-    # construct cumulative growfactors
-    gfv = gf_custom.copy()
-    vars = gfv.columns.tolist()
-    vars.remove('YEAR')
-    gfv[vars] = gfv[vars].cumprod()
-
-    # MAIN INCOME COMPONENTS
-    pufx.e00200 *= gfv.at[year - 2011, 'AWAGE']
-    pufx.e00200p *= gfv.at[year - 2011, 'AWAGE']
-    pufx.e00200s *= gfv.at[year - 2011, 'AWAGE']
-    pufx.pencon_p *= gfv.at[year - 2011, 'AWAGE']
-    pufx.pencon_s *= gfv.at[year - 2011, 'AWAGE']
-    pufx.e00300 *= gfv.at[year - 2011, 'AINTS']
-    pufx.e00400 *= gfv.at[year - 2011, 'AINTS']
-    pufx.e00600 *= gfv.at[year - 2011, 'ADIVS_ADJ']  # djb changed from ADIVS
-    pufx.e00650 *= gfv.at[year - 2011, 'ADIVS_ADJ']  # djb changed from ADIVS
-    pufx.e00700 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e00800 *= gfv.at[year - 2011, 'ATXPY']
-
-    pufx.e00900s = np.where(pufx.e00900s >= 0,
-                            pufx.e00900s * gfv.at[year - 2011, 'ASCHCI_ADJ'],  # djb
-                            pufx.e00900s * gfv.at[year - 2011, 'ASCHCL_ADJ'])  # djb
-    pufx.e00900p = np.where(pufx.e00900p >= 0,
-                            pufx.e00900p * gfv.at[year - 2011, 'ASCHCI_ADJ'],  # djb
-                            pufx.e00900p * gfv.at[year - 2011, 'ASCHCL_ADJ'])  # djb
-    pufx.e00900 = pufx.e00900p + pufx.e00900s
-
-    # original lines below generated slice warnings; I removed [:]
-    # pufx.e00900s[:] = np.where(pufx.e00900s >= 0,
-    #                         pufx.e00900s * gfv.at[year - 2011, 'ASCHCI'],
-    #                         pufx.e00900s * gfv.at[year - 2011, 'ASCHCL'])
-    # pufx.e00900p[:] = np.where(pufx.e00900p >= 0,
-    #                         pufx.e00900p * gfv.at[year - 2011, 'ASCHCI'],
-    #                         pufx.e00900p * gfv.at[year - 2011, 'ASCHCL'])
-    # pufx.e00900[:] = pufx.e00900p + pufx.e00900s
-
-    pufx.e01100 *= gfv.at[year - 2011, 'ACGNS']
-    pufx.e01200 *= gfv.at[year - 2011, 'ACGNS']
-    pufx.e01400 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e01500 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e01700 *= gfv.at[year - 2011, 'ATXPY']
-
-    pufx.e02000 = np.where(pufx.e02000 >= 0,
-                           pufx.e02000 * gfv.at[year - 2011, 'ASCHEI_ADJ'],  # djb
-                           pufx.e02000 * gfv.at[year - 2011, 'ASCHEL_ADJ'])  # djb
-
-    # original lines below generated slice warning; I removed [:]
-    # pufx.e02000[:] = np.where(pufx.e02000 >= 0,
-    #                           pufx.e02000 * gfv.at[year - 2011, 'ASCHEI'],
-    #                           pufx.e02000 * gfv.at[year - 2011, 'ASCHEL'])
-
+    # the variables and their growfactors are declared in GF_MAP,
+    # GF_SIGNED_MAP, and GF_SUM_MAP above; see extrapolate_custom_stream
+    # for files too large to copy in memory
 
-    pufx.e02100 *= gfv.at[year - 2011, 'ASCHF']
-    pufx.e02100p *= gfv.at[year - 2011, 'ASCHF']
-    pufx.e02100s *= gfv.at[year - 2011, 'ASCHF']
-    pufx.e02300 *= gfv.at[year - 2011, 'AUCOMP']
-    pufx.e02400 *= gfv.at[year - 2011, 'ASOCSEC']
-    pufx.e03150 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e03210 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e03220 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e03230 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e03270 *= gfv.at[year - 2011, 'ACPIM']
-    pufx.e03240 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e03290 *= gfv.at[year - 2011, 'ACPIM']
-    pufx.e03300 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e03400 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e03500 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e07240 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e07260 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e07300 *= gfv.at[year - 2011, 'ABOOK']
-    pufx.e07400 *= gfv.at[year - 2011, 'ABOOK']
-    pufx.p08000 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e09700 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e09800 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e09900 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e11200 *= gfv.at[year - 2011, 'ATXPY']
-
-    # ITEMIZED DEDUCTIONS
-    pufx.e17500 *= gfv.at[year - 2011, 'ACPIM']
-    pufx.e18400 *= gfv.at[year - 2011, 'ASALT']  # changed from ATXPY
-    pufx.e18500 *= gfv.at[year - 2011, 'ASALT']  # changed from ATXPY
-    pufx.e19200 *= gfv.at[year - 2011, 'AIPD']
-    pufx.e19800 *= gfv.at[year - 2011, 'ACHARITY']  # changed from ATXPY
-    pufx.e20100 *= gfv.at[year - 2011, 'ACHARITY']  # changed from ATXPY
-    pufx.e20400 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.g20500 *= gfv.at[year - 2011, 'ATXPY']
-
-    # CAPITAL GAINS
-    pufx.p22250 *= gfv.at[year - 2011, 'ACGNS']
-    pufx.p23250 *= gfv.at[year - 2011, 'ACGNS']
-    pufx.e24515 *= gfv.at[year - 2011, 'ACGNS']
-    pufx.e24518 *= gfv.at[year - 2011, 'ACGNS']
-
-    # SCHEDULE E
-    pufx.e26270 *= gfv.at[year - 2011, 'ASCHEI_ADJ']  # djb
-    pufx.e27200 *= gfv.at[year - 2011, 'ASCHEI_ADJ']  # djb
-    pufx.k1bx14p *= gfv.at[year - 2011, 'ASCHEI_ADJ']  # djb
-    pufx.k1bx14s *= gfv.at[year - 2011, 'ASCHEI_ADJ']  # djb
+    pufx = puf.copy()
 
-    # MISCELLANOUS SCHEDULES
-    pufx.e07600 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e32800 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e58990 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e62900 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e87530 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.e87521 *= gfv.at[year - 2011, 'ATXPY']
-    pufx.cmbtp *= gfv.at[year - 2011, 'ATXPY']
+    # construct cumulative growfactors for the year, one factor per variable
+    fvec = factor_vectors(gf_custom, year)
+    pufx = extrapolate_chunk(pufx, fvec)
 
     # BENEFITS djb I had to comment these out as they are only available in cps
     # pufx.other_ben *= gfv.at[year - 2011, 'ABENOTHER']
@@ -37,6 +37,7 @@ import pandas as pd
 import numpy as np
 import src.microweight as mw
 import src.make_test_problems as mtp
+import functions_geoweight_objective as gwo
 
 import scipy as sp
 from scipy.optimize import fmin_slsqp  # no longer needed
@@ -204,6 +205,9 @@ def hfun(x, xmat, targets, objscale, diff_weights):
     return grad.flatten()
 
 
+# exact gradient, hessian-vector product, and hessian for f (no autograd, no
+# finite differences): gwo.gradient, gwo.hessp, gwo.hess_lower, etc.
+# note that gfun above leaves out objscale, which gwo.gradient includes
 # minimize(f, x0, jac=jac, hessp=hessp, method='trust-ncg'...)
 # also see this: https://justindomke.wordpress.com/2009/01/17/hessian-vector-products/
 # approximation:  H(x)v ~ [g(x+rv) - g(x - rv)] / 2r
@@ -1079,9 +1083,9 @@ res2 = minimize(f, x0,
                method='trust-constr',
                bounds=bnds,
                constraints=linconineq,  # lincon linconineq linconineq_feas
-               jac=gfun, # egfn, # gfun, # egfn
+               jac=gwo.gradient, # gfun, egfn
                # hess='2-point',  # 2-point 3-point cs
-               hessp = f_hvp_wrap,
+               hessp=gwo.hessp,  # f_hvp_wrap
                args=(xmat, targets, 1, diff_weights),
                options={'maxiter': 50, 'verbose': 2,
                         'gtol': 1e-4, 'xtol': 1e-4,
@@ -1149,6 +1153,8 @@ res.x.max()
 # %% ipopt
 import src.reweight as rw
 
+# see functions_reweight_ipopt.ReweightCallbacks for the version used in
+# national reweighting (precomputed jacobian, ccscale built in, timings)
 class cbacks(object):
     """
     Must have:
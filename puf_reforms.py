@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Reforms for puf_tax_analysis.py and puf_tax_analysis_batch.py, as dicts, and
+reforms, a dict of all of them by name.
+"""
+
+# %% imports
+import taxcalc as tc
+
+
+# %% locations
+REFDIR = r'C:\programs_python\puf_analysis\reforms/'
+
+
+# %% define: reforms versus 2017 law going forward toward 2018 law -- file names or dicts
+# Note: # tc.Policy().read_json_reform(qbid_limit) -- creates a dict out of
+# a json file, converting false or "false" to False -- so I can create dicts directly
+salt2018 = {"ID_AllTaxes_c": {"2018": [10000.0, 10000.0, 5000.0, 10000.0, 10000.0]}}
+
+sd2018 = {"STD": {"2018": [12000, 24000, 12000, 18000, 24000]}}
+
+persx2018 = {"II_em": {"2018": 0}}
+
+# combine all rates
+rates2018 = {"II_rt1": {"2018": 0.10},
+             "II_rt2": {"2018": 0.12},
+             "II_rt3": {"2018": 0.22},
+             "II_rt4": {"2018": 0.24},
+             "II_rt5": {"2018": 0.32},
+             "II_rt6": {"2018": 0.35},
+             "II_rt7": {"2018": 0.37},
+             "II_brk1": {"2018": [9525, 19050, 9525, 13600, 19050]},
+             "II_brk2": {"2018": [38700, 77400, 38700, 51800, 77400]},
+             "II_brk3": {"2018": [82500, 165000, 82500, 82500, 165000]},
+             "II_brk4": {"2018": [157500, 315000, 157500, 157500, 315000]},
+             "II_brk5": {"2018": [200000, 400000, 200000, 200000, 400000]},
+             "II_brk6": {"2018": [500000, 600000, 300000, 500000, 600000]}}
+
+ptrates2018 = {"PT_rt1": {"2018": 0.10},
+               "PT_rt2": {"2018": 0.12},
+               "PT_rt3": {"2018": 0.22},
+               "PT_rt4": {"2018": 0.24},
+               "PT_rt5": {"2018": 0.32},
+               "PT_rt6": {"2018": 0.35},
+               "PT_rt7": {"2018": 0.37},
+               "PT_brk1": {"2018": [9525, 19050, 9525, 13600, 19050]},
+               "PT_brk2": {"2018": [38700, 77400, 38700, 51800, 77400]},
+               "PT_brk3": {"2018": [82500, 165000, 82500, 82500, 165000]},
+               "PT_brk4": {"2018": [157500, 315000, 157500, 157500, 315000]},
+               "PT_brk5": {"2018": [200000, 400000, 200000, 200000, 400000]},
+               "PT_brk6": {"2018": [500000, 600000, 300000, 500000, 600000]}}
+
+allrates2018 = {**rates2018, **ptrates2018}
+
+qbid2018 = {"PT_qbid_rt": {"2018": 0.2},
+            "PT_qbid_taxinc_thd": {"2018": [157500, 315000, 157500, 157500, 315000]},
+            "PT_qbid_taxinc_gap": {"2018": [50000, 100000, 50000, 50000, 100000]},
+            "PT_qbid_w2_wages_rt": {"2018": 0.5},
+            "PT_qbid_alt_w2_wages_rt": {"2018": 0.25},
+            "PT_qbid_alt_property_rt": {"2018": 0.025}}
+qbid_limitfalse = {"PT_qbid_limit_switch": {"2018": False}}
+qbid2018_limitfalse = {**qbid2018, **qbid_limitfalse}
+
+passthrough_qbidxlimit2018 = {**ptrates2018, **qbid2018_limitfalse}
+
+amt2018 = {"AMT_em": {"2018": [70300, 109400, 54700, 70300, 109400]},
+           "AMT_em_ps": {"2018": [500000, 1000000, 500000, 500000, 1000000]},
+           "AMT_em_pe": {"2018": 718800}}
+
+# caution: this next reform is based on carefully deleting provisions already estimated
+# above. needs to be checked/reviewed
+other_2018vs2017 = tc.Policy.read_json_reform(REFDIR + 'other_2018vs2017.json')
+
+
+# %% define: reforms versus 2018 law, going back toward 2017 law -- file names or dicts
+# run against 2018 law, these take away a reform
+
+salt2017 = {"ID_AllTaxes_c": {"2018": [9e99, 9e99, 9e99, 9e99, 9e99]}}
+
+# std deduction - will it be sufficient to use 2017 and let tc move it to 2018? I think so
+# that was the way it works against 2017 law when adding it
+sd2017 = {"STD": {"2017": [6350, 12700, 6350, 9350, 12700]}} # use 2017 and index to 2018
+# or the following?? the former was all that was in TCJA.json
+# sd2017 = {"STD": {"2017": [6350, 12700, 6350, 9350, 12700]},
+#           "STD_Dep": {"2017": 1050},
+#           "STD_Aged": {"2017": [1550, 1250, 1250, 1550, 1550]}}
+
+persx2017 = {"II_em": {"2017": 4050}}  # use 2017 and index to 2018
+# what about:
+    #     "II_em_ps": {"2017": [261500, 313800, 156900, 287650, 313800]},
+
+# set amt values at 2017 levels so they will be indexed
+amt2017 = {"AMT_em": {"2017": [54300.0, 84500.0, 42250.0, 54300.0, 84500.0]},
+           "AMT_em_ps": {"2017": [120700.0, 160900.0, 80450.0, 120700.0, 160900.0]},
+           "AMT_em_pe": {"2017": 249450.0}}
+
+
+# %% define full reforms -- file names or dicts
+law2017 = tc.Policy.read_json_reform(REFDIR + '2017_law.json')
+law2018 = tc.Policy.read_json_reform(REFDIR + 'TCJA.json')
+law2018xQlimit = {**law2018, **qbid_limitfalse}  # TCJA but with qbid limit set to false
+
+
+# %% all reforms by name
+reform_names = ['salt2018', 'sd2018', 'persx2018', 'allrates2018', 'qbid2018_limitfalse',
+                'passthrough_qbidxlimit2018', 'amt2018', 'other_2018vs2017',
+                'salt2017', 'sd2017', 'persx2017', 'amt2017',
+                'law2017', 'law2018', 'law2018xQlimit']
+reforms = {name: eval(name) for name in reform_names}
@@ -60,8 +60,11 @@ from datetime import date
 
 import functions_advance_puf as adv  # this is the lastest taxcalc from GH master as of 12/13/2020
 import functions_reweight_puf as rwp
+import functions_reweight_benchmark as rwb
 import functions_geoweight_puf as gwp
 import functions_ht2_analysis as fht
+import functions_weights as fw
+import puf_extrapolate_custom as xc
 
 import puf_constants as pc
 import puf_utilities as pu
@@ -92,6 +95,10 @@ TABDIR = IGNOREDIR + 'result_tables/'
 
 TEMPDIR = IGNOREDIR + 'intermediate_results/'
 
+CACHEDIR = IGNOREDIR + 'cache/'  # created if needed
+FIXDIR = IGNOREDIR + 'reweight_fixtures/'
+QSTOREDIR = IGNOREDIR + 'qstore/'  # geoweight Q warm starts, see gwp.qstore_load
+
 
 # %% paths to specific already existing files
 LATEST_OFFICIAL_PUF = DIR_FOR_OFFICIAL_PUF + 'puf.csv'
@@ -112,6 +119,7 @@ HT2_SHARES = DATADIR + 'ht2_shares.csv'
 # %% names of files to create
 PUF_DEFAULT = TCOUTDIR + 'puf2017_default.parquet'
 PUF_REGROWN = TCOUTDIR + 'puf2017_regrown.parquet'
+PUF_SYNTHETIC = TCOUTDIR + 'puf2017_synthetic.parquet'
 
 
 # %% constants
@@ -143,7 +151,9 @@ pufvars = puf.columns.tolist()
 pd.DataFrame (pufvars, columns=['pufvar']).to_csv(DATADIR + 'pufvars.csv', index=None)
 
 # just need to create the advanced puf files once
-adv.advance_puf(puf, 2017, PUF_DEFAULT)
+# PUF_DEFAULT is only compared with the targets, so it keeps the reweight profile;
+# PUF_REGROWN is read back in as tc.Records data below, so it keeps everything
+adv.advance_puf(puf, 2017, PUF_DEFAULT, profile='reweight')
 
 adv.advance_puf_custom(puf, 2017,
                        gfcustom=GF_CUSTOM,
@@ -152,6 +162,28 @@ adv.advance_puf_custom(puf, 2017,
                        savepath=PUF_REGROWN)
 
 
+# %% ALTERNATIVE: regrow several years in one pass over puf.csv
+# the extrapolated years share one copy of the unchanged columns; each year
+# then only needs its own tax-calculator run
+XDIR = PUFDIR + 'puf_extrapolated/'
+gf_custom = pd.read_csv(GF_CUSTOM)
+xc.extrapolate_custom_years(LATEST_OFFICIAL_PUF, gf_custom, [2017, 2018], XDIR)
+
+for year in [2017, 2018]:
+    adv.advance_puf_extrapolated(xc.read_extrapolated_year(XDIR, year), year,
+                                 gfones=GF_ONES,
+                                 weights=WEIGHTS_OFFICIAL,
+                                 savepath=TCOUTDIR + 'puf' + str(year) + '_regrown.parquet')
+
+
+# %% ALTERNATIVE: synthetic puf for load testing away from the puf
+# a file laid out like PUF_REGROWN with puf-like distributions, at any size;
+# python functions_synthetic_puf.py writes PUF_SYNTHETIC (10x the puf's
+# records) and weights_synthetic.csv. to load test, use them in place of
+# PUF_REGROWN and weights_initial below
+# weights_synthetic = pd.read_csv(WEIGHTDIR + 'weights_synthetic.csv')
+
+
 # %% ONETIME advance regrown 2017 file to 2018: default growfactors, no weights or ratios, then calculate 2018 law
 # note that this will NOT have weights that we want. We will correct that AFTER we have weights for 2017 that we want
 
@@ -169,7 +201,7 @@ pol = tc.Policy()
 calc = tc.Calculator(policy=pol, records=recs)
 calc.advance_to_year(2018)
 calc.calc_all()
-puf2018 = calc.dataframe(variable_list=[], all_vars=True)
+puf2018 = pu.tc_dataframe(calc, 'full')  # full: becomes Records data in puf_tax_analysis
 puf2018.c00100.describe()
 puf2018['pid'] = np.arange(len(puf2018))
 puf2018['filer'] = pu.filers(puf2018, year=2018)  # overwrite the 2017 filers info
@@ -207,6 +239,12 @@ pufrg.filer.sum()
 
 pufsub = rwp.prep_puf(pufrg, ptargets)
 pufsub.info()
+
+# or, much faster after the first run: load the prepared file from the cache,
+# which is keyed by the contents of PUF_REGROWN and the target list
+pufsub = rwp.prep_puf_cached(PUF_REGROWN, ptargets, CACHEDIR)
+pufsub.info()
+pu.memreport(pufsub, 'pufsub')  # memory by dtype vs. storing everything as float64
 pu.uvals(pufsub.columns)
 
 
@@ -275,7 +313,7 @@ drops_ipopt  # dataframe of the IRS variable-stub combinations we will NOT targe
 
 
 # %% reweight the puf file
-method = 'ipopt'  # ipopt or lsq
+method = 'ipopt'  # ipopt or lsq (or ipopt_sparse, see rwp.stub_solve)
 drops = drops_ipopt  # use ipopt or lsq
 
 # method = 'lsq'  # ipopt or lsq
@@ -283,8 +321,11 @@ drops = drops_ipopt  # use ipopt or lsq
 
 # temp = pufsub.query('common_stub==2')  # this stub is the hardest for both solvers
 
+# workers > 1 solves the stubs in parallel processes, biggest stubs first; None solves them serially
+workers = 6
+
 a = timer()
-new_weights = rwp.puf_reweight(pufsub, weights_initial, ptargets, method=method, drops=drops)
+new_weights = rwp.puf_reweight(pufsub, weights_initial, ptargets, method=method, drops=drops, workers=workers)
 b = timer()
 b - a
 # new_weights.sum()
@@ -297,6 +338,12 @@ wfname = WEIGHTDIR + 'weights2017_reweight1.csv'
 weights_save.to_csv(wfname, index=None)
 
 
+# %% ONETIME save each stub's reweighting problem for functions_reweight_benchmark
+# the benchmark itself (a grid of solvers and options) runs as a script:
+# python functions_reweight_benchmark.py
+rwb.save_stub_fixtures(pufsub, weights_initial, ptargets, FIXDIR, drops=drops_ipopt)
+
+
 # %% check pdiffs
 # pd.set_option('display.max_columns', 7)
 pdiff_rwt = rwp.get_pctdiffs(pufsub, new_weights[['pid', 'reweight']], ptargets)
@@ -306,6 +353,18 @@ pdiff_rwt.query('abspdiff > 10')
 pu.uvals(pdiff_rwt.pufvar)
 
 
+# %% incremental target differences while tuning one stub at a time
+# the tracker holds stub x variable sums; updating the weights of a subset of
+# records costs only those records, so drop-list experiments are near-instant
+tracker = rwp.TargetTracker(pufsub, weights_initial, ptargets)
+tracker.pdiffs().head(10)
+
+stub = 2
+stubwts = new_weights.query('common_stub == @stub')
+tracker.update(stubwts.pid, stubwts.reweight)
+tracker.pdiffs().query('common_stub == @stub').head(20)
+
+
 # %% create report on results from the reweighting
 # CAUTION: a weights df must always contain only 2 variables, the first will be assumed to be
 # pid, the second will be the weight of interest
@@ -610,7 +669,7 @@ reweight_method = 'ipopt'  # ipopt or lsq
 drops = drops_ipopt
 
 a = timer()
-new_weights = rwp.puf_reweight(pufsub, weights_init, ptargets, method=reweight_method, drops=drops)
+new_weights = rwp.puf_reweight(pufsub, weights_init, ptargets, method=reweight_method, drops=drops, workers=workers)
 b = timer()
 b - a
 
@@ -727,6 +786,8 @@ targvars2 = ['nret_all', 'mars1', 'c00100', 'e00200']
 
 
 # %% Use independent weights as starting point
+# not needed if the runs use options['qstore']: the store then holds the shares
+# from the most recent run with the same targvars and state groups
 wfname = WEIGHTDIR + 'allweights2017_geo_unrestricted.csv'
 qshares = pd.read_csv(wfname)
 qshares.info()
@@ -764,6 +825,7 @@ geomethod = 'qmatrix-ipopt'
 options = {'qmax_iter': 50,
            'quiet': True,
            'qshares': qshares,  # qshares or None
+           'qstore': QSTOREDIR,  # warm start from and save to the Q store when qshares is None
            'xlb': 0.1,
            'xub': 100,
            'crange': .0001
@@ -803,6 +865,62 @@ final_geo_weights.sum()
 final_geo_name = WEIGHTDIR + 'allweights2017_geo_restricted.csv'
 final_geo_name
 final_geo_weights.to_csv(final_geo_name, index=None)
+# binary store (memory-mapped on load), used by the steps below
+fw.save_weights(final_geo_weights, WEIGHTDIR + 'allweights2017_geo_restricted',
+                provenance={'geomethod': geomethod, 'targvars': targvars})
+
+
+# %% ALTERNATIVE to the final loop: solve the ht2 stubs in parallel
+# each stub's xmat, weights, and initial Q go into shared memory and the stubs
+# are solved in a process pool; stub_stats has time, status, and the largest
+# target % difference for each stub
+a = timer()
+final_geo_weights, stub_stats = gwp.get_geo_weights_parallel(
+    pufsub,
+    weightdf=final_national_weights,
+    targvars=targvars,
+    ht2wide=ht2wide,
+    dropsdf_wide=dropsdf_wide,
+    independent=False,
+    geomethod=geomethod,
+    options=options,
+    workers=5,
+    intermediate_path=TEMPDIR)
+b = timer()
+(b - a) / 60
+stub_stats
+
+final_geo_weights.to_csv(final_geo_name, index=None)
+fw.save_weights(final_geo_weights, WEIGHTDIR + 'allweights2017_geo_restricted',
+                provenance={'geomethod': geomethod, 'targvars': targvars})
+
+
+# %% ALTERNATIVE: geoweight all 53 areas instead of compstates + 'other'
+# first rerun the target cells above with every area as its own state group:
+#   ht2_collapsed = gwp.collapse_ht2(HT2_SHARES, 'all')
+# so that ht2wide and dropsdf_wide have a row for each area in pc.STATES_DCPROA
+# qshares from a compstates run do not have these columns, so start from the
+# default nret_all shares; every stub's Q is a dense float64 records x 53 array,
+# both while stubs wait in shared memory and in the worker that solves it, so
+# set workers so that that many stubs fit in memory at once
+options_all = {key: value for key, value in options.items() if key != 'qshares'}
+a = timer()
+allstates_geo_weights, stub_stats = gwp.get_geo_weights_parallel(
+    pufsub,
+    weightdf=final_national_weights,
+    targvars=targvars,
+    ht2wide=ht2wide,
+    dropsdf_wide=dropsdf_wide,
+    independent=False,
+    geomethod=geomethod,
+    options=options_all,
+    workers=5,
+    intermediate_path=TEMPDIR)
+b = timer()
+(b - a) / 60
+stub_stats
+
+allstates_geo_weights.to_csv(WEIGHTDIR + 'allweights2017_geo_allstates.csv', index=None)
 
 
 # %% create report on results with the state weights
@@ -810,7 +928,8 @@ date_id = date.today().strftime("%Y-%m-%d")
 
 ht2_compare = pd.read_csv(IGNOREDIR + 'ht2targets_temp.csv')  # temporary
 pu.uvals(ht2_compare.pufvar)
-sweights = pd.read_csv(WEIGHTDIR + 'allweights2017_geo_restricted.csv')
+# sweights = pd.read_csv(WEIGHTDIR + 'allweights2017_geo_restricted.csv')
+sweights = fw.load_weights(WEIGHTDIR + 'allweights2017_geo_restricted').frame()
 
 asl = fht.get_allstates_wsums(pufsub, sweights)
 pu.uvals(asl.pufvar)
@@ -853,8 +972,14 @@ def f(fnames, dir):
     weights_stacked = pd.concat(pdlist)
     return weights_stacked
 
-national_weights = f(weight_filenames, WEIGHTDIR)
-national_weights.to_csv(WEIGHTDIR + 'national_weights_stacked.csv', index=None)
+# the registry indexes every weight file in WEIGHTDIR and reads a set only when
+# it is first used, into one pid-aligned matrix; wide and long views come from it
+registry = fw.WeightRegistry(WEIGHTDIR)
+registry.index[['shortname', 'year', 'stage', 'states', 'format']]
+
+# national_weights = f(weight_filenames, WEIGHTDIR)
+national_weights = registry.long(weight_filenames)  # pid, shortname, weight
+# national_weights.to_csv(WEIGHTDIR + 'national_weights_stacked.csv', index=None)
 
 # weight_df = rwp.merge_weights(weight_filenames, PUFDIR)  # they all must be in the same directory
 
@@ -862,13 +987,20 @@ national_weights.to_csv(WEIGHTDIR + 'national_weights_stacked.csv', index=None)
 # weight_df.sum()
 
 # take a look
-nat_wide = national_weights.drop(columns='file_source').pivot(index=['pid'], columns='shortname', values='weight').reset_index()
+# nat_wide = national_weights.drop(columns='file_source').pivot(index=['pid'], columns='shortname', values='weight').reset_index()
+nat_wide = registry.wide(weight_filenames)
 col_order = ['pid', 'weights2017_default', 'reweight1', 'geoweight_sum', 'georeweight1']
 nat_wide = nat_wide[col_order]
 nat_wide.sort_values(by='pid', inplace=True)
 nat_wide.to_csv(WEIGHTDIR + 'national_weights_wide.csv', index=None)
 
 
+# %% compare all national weight sets to targets in one batched call
+pdiffs_all = rwp.get_pctdiffs_multi(pufsub, nat_wide, ptargets)
+pdiffs_all.groupby('weight_name').abspdiff.describe()
+pdiffs_all.query('common_stub == 0 and pufvar == "c00100"')
+
+
 # %% get weights for 2018 and save puf2018_weighted
  # Create a base 2018 puf as follows:
  #     - start with the previously created puf for 2018, which is simply the
@@ -886,13 +1018,14 @@ wtgrowfactor = dw2018 / dw2017
 # get best national weights
 # 'weights_georwt1_qmatrix-ipopt_ipopt'
 
-sweights2017 = pd.read_csv(WEIGHTDIR + 'allweights2017_geo_restricted.csv')
+# sweights2017 = pd.read_csv(WEIGHTDIR + 'allweights2017_geo_restricted.csv')
+sweights2017 = fw.load_weights(WEIGHTDIR + 'allweights2017_geo_restricted')
 
 puf2018 = pd.read_parquet(TCOUTDIR + 'puf2018.parquet', engine='pyarrow')
 
 puf2018_weighted = puf2018.copy().rename(columns={'s006': 's006_default'})
 puf2018_weighted = pd.merge(puf2018_weighted,
-                            sweights2017.loc[:, ['pid', 'weight']],
+                            sweights2017.frame(['weight']),
                             how='left',
                             on='pid')
 puf2018_weighted['weight2018_2017filers'] = puf2018_weighted.weight * wtgrowfactor
@@ -909,11 +1042,14 @@ puf2018_weighted.to_parquet(TCOUTDIR + 'puf2018_weighted' + '.parquet', engine='
 # finally, create state weights for 2018 using the shares we have for 2017
 # we know this isn't really right, but shouldn't be too bad (for now) for a single year
 # this should be as simple as multiplying all weights by wtgrowfactor
-wtvars = [s for s in sweights2017.columns if s not in ['pid', 'ht2_stub']]
-sweights2018 = sweights2017.copy()
-sweights2018[wtvars] = sweights2018[wtvars] * wtgrowfactor
-
-sweights2018.to_csv(WEIGHTDIR + 'allweights2018_geo2017_grown.csv', index=None)
+# scale_weights multiplies every column but ht2_stub, a column at a time
+sweights2018 = fw.scale_weights(WEIGHTDIR + 'allweights2017_geo_restricted',
+                                WEIGHTDIR + 'allweights2018_geo2017_grown',
+                                wtgrowfactor,
+                                provenance='2017 state weights grown by growth in default national weights')
+
+# csv copy for anything that still reads it
+sweights2018.frame().to_csv(WEIGHTDIR + 'allweights2018_geo2017_grown.csv', index=None)
 
 
 
@@ -49,6 +49,8 @@ import pandas as pd
 import numpy as np
 from datetime import date
 
+import functions_tax_analysis as fta
+import functions_weights as fw
 import puf_constants as pc
 import puf_utilities as pu
 
@@ -76,93 +78,11 @@ TABDIR = IGNOREDIR + 'result_tables/'
 LATEST_OFFICIAL_PUF = DIR_FOR_OFFICIAL_PUF + 'puf.csv'  # August 20, 2020 puf.csv
 
 
-# %% define: reforms versus 2017 law going forward toward 2018 law -- file names or dicts
-# Note: # tc.Policy().read_json_reform(qbid_limit) -- creates a dict out of
-# a json file, converting false or "false" to False -- so I can create dicts directly
-salt2018 = {"ID_AllTaxes_c": {"2018": [10000.0, 10000.0, 5000.0, 10000.0, 10000.0]}}
-
-sd2018 = {"STD": {"2018": [12000, 24000, 12000, 18000, 24000]}}
-
-persx2018 = {"II_em": {"2018": 0}}
-
-# combine all rates
-rates2018 = {"II_rt1": {"2018": 0.10},
-             "II_rt2": {"2018": 0.12},
-             "II_rt3": {"2018": 0.22},
-             "II_rt4": {"2018": 0.24},
-             "II_rt5": {"2018": 0.32},
-             "II_rt6": {"2018": 0.35},
-             "II_rt7": {"2018": 0.37},
-             "II_brk1": {"2018": [9525, 19050, 9525, 13600, 19050]},
-             "II_brk2": {"2018": [38700, 77400, 38700, 51800, 77400]},
-             "II_brk3": {"2018": [82500, 165000, 82500, 82500, 165000]},
-             "II_brk4": {"2018": [157500, 315000, 157500, 157500, 315000]},
-             "II_brk5": {"2018": [200000, 400000, 200000, 200000, 400000]},
-             "II_brk6": {"2018": [500000, 600000, 300000, 500000, 600000]}}
-
-ptrates2018 = {"PT_rt1": {"2018": 0.10},
-               "PT_rt2": {"2018": 0.12},
-               "PT_rt3": {"2018": 0.22},
-               "PT_rt4": {"2018": 0.24},
-               "PT_rt5": {"2018": 0.32},
-               "PT_rt6": {"2018": 0.35},
-               "PT_rt7": {"2018": 0.37},
-               "PT_brk1": {"2018": [9525, 19050, 9525, 13600, 19050]},
-               "PT_brk2": {"2018": [38700, 77400, 38700, 51800, 77400]},
-               "PT_brk3": {"2018": [82500, 165000, 82500, 82500, 165000]},
-               "PT_brk4": {"2018": [157500, 315000, 157500, 157500, 315000]},
-               "PT_brk5": {"2018": [200000, 400000, 200000, 200000, 400000]},
-               "PT_brk6": {"2018": [500000, 600000, 300000, 500000, 600000]}}
-
-allrates2018 = {**rates2018, **ptrates2018}
-
-qbid2018 = {"PT_qbid_rt": {"2018": 0.2},
-            "PT_qbid_taxinc_thd": {"2018": [157500, 315000, 157500, 157500, 315000]},
-            "PT_qbid_taxinc_gap": {"2018": [50000, 100000, 50000, 50000, 100000]},
-            "PT_qbid_w2_wages_rt": {"2018": 0.5},
-            "PT_qbid_alt_w2_wages_rt": {"2018": 0.25},
-            "PT_qbid_alt_property_rt": {"2018": 0.025}}
-qbid_limitfalse = {"PT_qbid_limit_switch": {"2018": False}}
-qbid2018_limitfalse = {**qbid2018, **qbid_limitfalse}
-
-passthrough_qbidxlimit2018 = {**ptrates2018, **qbid2018_limitfalse}
-
-amt2018 = {"AMT_em": {"2018": [70300, 109400, 54700, 70300, 109400]},
-           "AMT_em_ps": {"2018": [500000, 1000000, 500000, 500000, 1000000]},
-           "AMT_em_pe": {"2018": 718800}}
-
-# caution: this next reform is based on carefully deleting provisions already estimated
-# above. needs to be checked/reviewed
-other_2018vs2017 = tc.Policy.read_json_reform(REFDIR + 'other_2018vs2017.json')
-
-
-# %% define: reforms versus 2018 law, going back toward 2017 law -- file names or dicts
-# run against 2018 law, these take away a reform
-
-salt2017 = {"ID_AllTaxes_c": {"2018": [9e99, 9e99, 9e99, 9e99, 9e99]}}
-
-# std deduction - will it be sufficient to use 2017 and let tc move it to 2018? I think so
-# that was the way it works against 2017 law when adding it
-sd2017 = {"STD": {"2017": [6350, 12700, 6350, 9350, 12700]}} # use 2017 and index to 2018
-# or the following?? the former was all that was in TCJA.json
-# sd2017 = {"STD": {"2017": [6350, 12700, 6350, 9350, 12700]},
-#           "STD_Dep": {"2017": 1050},
-#           "STD_Aged": {"2017": [1550, 1250, 1250, 1550, 1550]}}
-
-persx2017 = {"II_em": {"2017": 4050}}  # use 2017 and index to 2018
-# what about:
-    #     "II_em_ps": {"2017": [261500, 313800, 156900, 287650, 313800]},
-
-# set amt values at 2017 levels so they will be indexed
-amt2017 = {"AMT_em": {"2017": [54300.0, 84500.0, 42250.0, 54300.0, 84500.0]},
-           "AMT_em_ps": {"2017": [120700.0, 160900.0, 80450.0, 120700.0, 160900.0]},
-           "AMT_em_pe": {"2017": 249450.0}}
-
-
-# %% define full reforms -- file names or dicts
-law2017 = tc.Policy.read_json_reform(REFDIR + '2017_law.json')
-law2018 = tc.Policy.read_json_reform(REFDIR + 'TCJA.json')
-law2018xQlimit = {**law2018, **qbid_limitfalse}  # TCJA but with qbid limit set to false
+# %% reforms -- defined in puf_reforms.py; the cells below refer to them by name
+from puf_reforms import (salt2018, sd2018, persx2018, allrates2018, qbid2018_limitfalse,
+                         passthrough_qbidxlimit2018, amt2018, other_2018vs2017,
+                         salt2017, sd2017, persx2017, amt2017,
+                         law2017, law2018, law2018xQlimit)
 
 
 # %% selected parameter descriptions
@@ -383,7 +303,7 @@ pol = tc.Policy()
 calc = tc.Calculator(policy=pol, records=recs)
 calc.advance_to_year(2018)
 calc.calc_all()
-pufdf = calc.dataframe(variable_list=[], all_vars=True)
+pufdf = pu.tc_dataframe(calc, 'full')  # full: a saved puf file, may be read back as Records data
 pufdf['pid'] = np.arange(len(pufdf))
 pufdf['filer'] = pu.filers(pufdf, year=2018)
 pufdf.to_parquet(PUF2017LAW_2018LEVELS_DEFAULT, engine='pyarrow')
@@ -396,6 +316,8 @@ pufdf.to_parquet(PUF2017LAW_2018LEVELS_DEFAULT, engine='pyarrow')
 def add_reform(reform_name):
     global order  # we will modify this
     global wsum_prior
+    global step_prior
+    global df_prior
 
     pol.implement_reform(eval(reform_name))
     calc = tc.Calculator(policy=pol, records=recs)
@@ -405,33 +327,23 @@ def add_reform(reform_name):
     print(f'{reform_name:<30} {wsum:>9,.0f}  {wsum_change:>9,.1f}  iitax total and change in $ billions')
 
     # note that prep_tcout needs pidfiler and puf_constants in global env
+    # the first step is saved in full, later steps as changes from the step
+    # before, in the store for STACKDIR (store must exist in global env)
     df = prep_tcout(calc, reform_name, order)
-    output_name = STACKDIR + str(order) + '_' + reform_name + '.parquet'
-    df.to_parquet(output_name, engine='pyarrow')
+    step_name = str(order) + '_' + reform_name
+    store.write(step_name, df, step_prior, df_prior)
 
     order = order + 1
     wsum_prior = wsum
+    step_prior = step_name
+    df_prior = df
     return None
 
 
-def prep_tcout(tcout, reform_name=None, order=None):
+def prep_tcout(tcout, reform_name=None, order=None, profile='analysis'):
     # note: pidfiler must exist in the global environment
-    df = tcout.dataframe(variable_list=[], all_vars=True)
-    df['pid'] = pidfiler.pid
-    df['filer'] = pidfiler.filer
-
-    df['ht2_stub'] = pd.cut(
-        df['c00100'],
-        pc.HT2_AGI_STUBS,
-        labels=range(1, 11),
-        right=False)
-    # avoid categorical variable, it causes problems!
-    df['ht2_stub'] = df.ht2_stub.astype('int64')
-
-    df = pd.merge(df,
-                  pc.ht2stubs.rename(columns={'ht2stub': 'ht2_stub'}),
-                  how='left', on='ht2_stub')
-    return df
+    # profile 'analysis' keeps the variables the tax analysis uses, see pu.tc_dataframe
+    return fta.prep_tcout(tcout, pidfiler, profile)
 
 
 def solo_reform(reform_name, base_name, calc_base):
@@ -446,9 +358,10 @@ def solo_reform(reform_name, base_name, calc_base):
     print(f'{reform_name:<30} vs. {base_name} {wsum:>9,.0f}  {wsum_base:>9,.0f}  {wsum_change:>9,.1f}  iitax total and change in $ billions')
 
     # note that prep_tcout needs pidfiler and puf_constants in global env
+    # saved as changes from the base frame, which store and df_base (the
+    # output for calc_base) must hold, in global env
     df = prep_tcout(calc)
-    output_name = STACKDIR + reform_name + '_vs_' + base_name + '.parquet'
-    df.to_parquet(output_name, engine='pyarrow')
+    store.write(reform_name + '_vs_' + base_name, df, base_name, df_base)
     return None
 
 
@@ -467,7 +380,7 @@ calc_clp.advance_to_year(2018)
 calc_clp.calc_all()
 calc_clp.weighted_total('iitax') / 1e9  # 1719.791464209197
 # add pid and filer indicator
-pufdf = calc_clp.dataframe(variable_list=[], all_vars=True)
+pufdf = pu.tc_dataframe(calc_clp, 'full')  # full: a saved puf file, may be read back as Records data
 pufdf['pid'] = np.arange(len(pufdf))
 pufdf['filer'] = pu.filers(pufdf, year=2018)
 pufdf.to_parquet(PUF2017LAW_2018LEVELS_DEFAULT, engine='pyarrow')
@@ -481,7 +394,7 @@ calc_ref.advance_to_year(2018)
 calc_ref.calc_all()
 calc_ref.weighted_total('iitax') / 1e9  # 1521.8399218240877
 # note: IRS number is ~1,538.749 table 1.1 Total income tax
-pufdf = calc_ref.dataframe(variable_list=[], all_vars=True)
+pufdf = pu.tc_dataframe(calc_ref, 'full')  # full: a saved puf file, may be read back as Records data
 pufdf['pid'] = np.arange(len(pufdf))
 pufdf['filer'] = pu.filers(pufdf, year=2018)
 pufdf.to_parquet(PUFTCJA_2018LEVELS_DEFAULT, engine='pyarrow')
@@ -501,7 +414,7 @@ calc_ref.weighted_total('iitax') / 1e9
 (calc_clp.weighted_total('iitax') - calc_ref.weighted_total('iitax')) / 1e9  # 197.95154238510938
 
 
-df = calc_clp.dataframe(variable_list=[], all_vars=True)
+df = pu.tc_dataframe(calc_clp, 'analysis')
 df['filer'] = pu.filers(df, year=2018)
 (df.iitax * df.s006).sum() / 1e9
 (df.c00100 * df.s006).sum() / 1e9 #  11966
@@ -517,7 +430,8 @@ puf2018.c00100.describe()
 
 pidfiler = puf2018[['pid', 'filer']]
 
-sweights2018 = pd.read_csv(WEIGHTDIR + 'allweights2018_geo2017_grown.csv')
+# sweights2018 = pd.read_csv(WEIGHTDIR + 'allweights2018_geo2017_grown.csv')
+sweights2018 = fw.load_weights(WEIGHTDIR + 'allweights2018_geo2017_grown').frame()
 # check the weights
 # puf2018.loc[puf2018.pid==11, ['pid', 's006']]
 puf2018[['pid', 's006']].head(20)
@@ -572,7 +486,10 @@ calc_base = tc.Calculator(policy=pol_base, records=recs)
 calc_base.calc_all()
 
 # solo_reform(reform_name, base_name, calc_base)
-STACKDIR = TCOUTDIR + 'solo_vs_2017law/'  # define where to send the output - must be an existing dir
+STACKDIR = TCOUTDIR + 'solo_vs_2017law/'  # define where to send the output
+store = fta.ReformStore(STACKDIR)
+df_base = prep_tcout(calc_base)
+store.write('law2017', df_base)  # the base, in full
 solo_reform('law2017', 'law2017', calc_base)
 solo_reform('allrates2018', 'law2017', calc_base)
 solo_reform('sd2018', 'law2017', calc_base)
@@ -596,7 +513,10 @@ calc_base.calc_all()
 calc_base.weighted_total('iitax') / 1e9  # 1466.4086894196798 -- good
 
 # solo_reform(reform_name, base_name, calc_base)
-STACKDIR = TCOUTDIR + 'solo_vs_2018law/'  # define where to send the output - must be an existing dir
+STACKDIR = TCOUTDIR + 'solo_vs_2018law/'  # define where to send the output
+store = fta.ReformStore(STACKDIR)
+df_base = prep_tcout(calc_base)
+store.write('law2018xQlimit', df_base)  # the base, in full
 solo_reform('law2017', 'law2018xQlimit', calc_base)  # a full trip backward
 solo_reform('sd2017', 'law2018xQlimit', calc_base)
 solo_reform('salt2017', 'law2018xQlimit', calc_base)
@@ -607,6 +527,7 @@ solo_reform('law2018xQlimit', 'law2018xQlimit', calc_base)  # trip to nowhere -
 
 # %% check: total tax comparison
 # temp = pd.read_parquet(TCOUTDIR + 'unstacked/law2018xQlimit_vs_law2017.parquet', engine='pyarrow')
+# temp = fta.ReformStore(TCOUTDIR + 'solo_vs_2017law/').frame('law2018xQlimit_vs_law2017')
 # temp['taxcomp'] = np.where((temp.c09200 - temp.refund) < 0, 0, temp.c09200 - temp.refund)
 
 # irstottax = 1538749447 / 1e6
@@ -632,8 +553,11 @@ solo_reform('law2018xQlimit', 'law2018xQlimit', calc_base)  # trip to nowhere -
 # %% calc: jct stacking order of reforms
 order = 0
 wsum_prior = 0
+step_prior = None
+df_prior = None
 pol = tc.Policy()
-STACKDIR = TCOUTDIR + 'stack_jct/'  # define where to send the output - must be an existing dir
+STACKDIR = TCOUTDIR + 'stack_jct/'  # define where to send the output
+store = fta.ReformStore(STACKDIR)
 
 add_reform('law2017')
 add_reform('allrates2018')
@@ -649,8 +573,11 @@ order
 # %% calc: salt first stacking order of reforms
 order = 0
 wsum_prior = 0
+step_prior = None
+df_prior = None
 pol = tc.Policy()
-STACKDIR = TCOUTDIR + 'stack_saltfirst/'  # define where to send the output - must be an existing dir
+STACKDIR = TCOUTDIR + 'stack_saltfirst/'  # define where to send the output
+store = fta.ReformStore(STACKDIR)
 
 add_reform('law2017')
 add_reform('salt2018')
@@ -663,3 +590,18 @@ add_reform('law2018')
 order
 
 
+# %% tables: weighted sums by reform, state, and ht2 stub
+# the stores are written by the calc cells above or by puf_tax_analysis_batch.py;
+# one pass over each store's base frame; sweights2018 are the state weights
+# from above and nret is the weighted number of returns
+tabvars = ['nret', 'c00100', 'c04470', 'c04800', 'c05800', 'c09600', 'iitax']
+
+store = fta.ReformStore(TCOUTDIR + 'solo_vs_2017law/')
+dist2017 = fta.dist_table(store, store.names, tabvars, weights=sweights2018)
+
+store = fta.ReformStore(TCOUTDIR + 'stack_jct/')
+dist_jct = fta.dist_table(store, store.names, tabvars, weights=sweights2018)
+
+# e.g., iitax in $ billions by stub and reform for New York
+temp = dist2017.query('area == "NY" & variable == "iitax"')
+temp.pivot(index=['ht2_stub', 'ht2range'], columns='reform', values='wsum') / 1e9
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+The reforms of puf_tax_analysis.py run in parallel and cached (see
+functions_tax_analysis), in place of its solo_reform and add_reform cells.
+Output goes to the same ReformStores, so the tables cell of
+puf_tax_analysis.py reads either.
+
+On Windows, run this as a script or a cell at a time; the process pool needs
+the if __name__ == '__main__': guard when run as a script.
+"""
+
+# %% imports
+import taxcalc as tc
+import pandas as pd
+
+import functions_tax_analysis as fta
+from puf_reforms import reforms
+
+
+# %%  locations
+IGNOREDIR = r'C:\programs_python\puf_analysis\ignore/'
+PUFDIR = IGNOREDIR + 'puf_versions/'
+TCOUTDIR = PUFDIR + 'taxcalc_output/'
+
+
+if __name__ == '__main__':
+    # %% calc: get puf regrown reweighted data and create recs, as in puf_tax_analysis.py
+    puf2018 = pd.read_parquet(TCOUTDIR + 'puf2018_weighted.parquet', engine='pyarrow')
+    pidfiler = puf2018[['pid', 'filer']]
+
+    weights_us = puf2018[['pid', 's006']].rename(columns={'s006': 'WT2018'})
+    weights_us['WT2018'] = weights_us.WT2018 * 100
+
+    recs = tc.Records(data=puf2018,
+                      start_year=2018,
+                      weights=weights_us,
+                      adjust_ratios=None)
+
+    # runs on these records are cached across sessions (see fta.ReformCache) and
+    # rerun only when a reform, puf2018, or weights_us changes
+    recs_key = fta.records_key(puf2018, weights_us, 2018)
+    cache = fta.ReformCache(TCOUTDIR + 'reform_cache/', max_bytes=20e9)
+
+
+    # %% calc: each batch of reforms in isolation, in parallel
+    # each worker gets recs, pidfiler, and the base output once, computes its
+    # reforms, and saves the changes from the base to the same store solo_reform
+    # would; timings has iitax totals, seconds, and changes by reform
+    vs2017 = ['law2017', 'allrates2018', 'sd2018', 'persx2018', 'qbid2018_limitfalse',
+              'salt2018', 'amt2018', 'other_2018vs2017', 'law2018xQlimit', 'law2018']
+    timings2017 = fta.run_reform_batch(vs2017, 'law2017', reforms, recs, pidfiler,
+                                       TCOUTDIR + 'solo_vs_2017law/', workers=5,
+                                       cache=cache, recs_key=recs_key)
+    print(timings2017)
+
+    vs2018 = ['law2017', 'sd2017', 'salt2017', 'persx2017', 'amt2017', 'law2018xQlimit']
+    timings2018 = fta.run_reform_batch(vs2018, 'law2018xQlimit', reforms, recs, pidfiler,
+                                       TCOUTDIR + 'solo_vs_2018law/', workers=5,
+                                       cache=cache, recs_key=recs_key)
+    print(timings2018)
+
+
+    # %% calc: both stacking orders of reforms with ReformStack
+    # the stacks share their law2017 step, which is computed once; step 0 of each
+    # stack is saved as a full frame and each later step as the changes from the
+    # step before, in the same stores the add_reform cells write
+    stack = fta.ReformStack(reforms, recs, pidfiler, TCOUTDIR,
+                            cache=cache, recs_key=recs_key)
+    stack_jct = stack.run(['law2017', 'allrates2018', 'sd2018', 'persx2018',
+                           'qbid2018_limitfalse', 'salt2018', 'amt2018', 'law2018'],
+                          'stack_jct')
+    stack_saltfirst = stack.run(['law2017', 'salt2018', 'sd2018', 'persx2018',
+                                 'qbid2018_limitfalse', 'amt2018', 'allrates2018', 'law2018'],
+                                'stack_saltfirst')
+    print(stack_jct)
+    print(stack_saltfirst)
+    # e.g., the jct stack through sd2018
+    # df = fta.ReformStore(TCOUTDIR + 'stack_jct/').frame('2_sd2018')
@@ -6,6 +6,7 @@ Created on Tue Nov  3 13:38:57 2020
 """
 
 # %% imports
+import numpy as np
 import pandas as pd
 import sys
 import puf_constants as pc
@@ -116,19 +117,26 @@ def wp(data, wt, percentiles):
 
 # %% function to create mask identifying filers
 
-def filers(puf, year=2017):
+def filers(puf, year=2017, thresholds=None):
     """Return boolean array identifying tax filers.
 
     Parameters
     ----------
-    puf : TYPE
-        DESCRIPTION.
-    year : TYPE
-        DESCRIPTION.
+    puf : DataFrame, dict of arrays, or pyarrow Table
+        Needs MARS, age_head, age_spouse, iitax, refund, and the income
+        variables used below. Columns are pulled as numpy arrays, nothing
+        else is materialized.
+    year : int
+        Year of the filing rules, looked up in thresholds.
+    thresholds : DataFrame, optional
+        Filing threshold table with columns year, MARS, nage65,
+        gross_income, wage_threshold. Defaults to
+        pc.FILING_THRESHOLDS (data/filing_thresholds.csv).
 
     Returns
     -------
-    None.
+    Boolean Series indexed like puf when puf is a DataFrame, else a
+    boolean numpy array.
 
     # IRS rules for filers: https://www.irs.gov/pub/irs-prior/p17--2017.pdf
 
@@ -144,55 +152,22 @@ def filers(puf, year=2017):
     define gross income as above the line income plus any losses deducted in
     arriving at that, plus any income excluded in arriving at that
     """
-    if year == 2017:
-        s_inc_lt65 = 10400
-        s_inc_ge65 = 11950
+    def col(name):
+        return np.asarray(puf[name])
 
-        mfj_inc_bothlt65 = 20800
-        mfj_inc_onege65 = 22050
-        mfj_inc_bothge65 = 23300
-
-        mfs_inc = 4050
-
-        hoh_inc_lt65 = 13400
-        hoh_inc_ge65 = 14950
-
-        qw_inc_lt65 = 16750
-        qw_inc_ge65 = 18000
-
-        wage_threshold = 1000
-
-    elif year == 2018:
-        s_inc_lt65 = 12000
-        s_inc_ge65 = 13600
-
-        mfj_inc_bothlt65 = 24000
-        mfj_inc_onege65 = 25300
-        mfj_inc_bothge65 = 26600
-
-        mfs_inc = 5
-
-        hoh_inc_lt65 = 18000
-        hoh_inc_ge65 = 19600
-
-        qw_inc_lt65 = 24000
-        qw_inc_ge65 = 25300
-
-        wage_threshold = 1000
+    thresh, wage_threshold = filing_threshold_array(year, thresholds)
 
     # above the line income is agi plus above line adjustments getting to agi
-    above_line_income = puf.c00100 + puf.c02900
+    above_line_income = col('c00100') + col('c02900')
 
     # add back any losses that were used to reduce above the line income
     # these are negative so we will subtract them from above the line income
-    capital_losses = puf.c23650.lt(0) * puf.c23650 \
-        + puf.c01000.lt(0) * puf.c01000
-    other_losses = puf.e01200.lt(0) * puf.e01200
-    business_losses = puf.e00900.lt(0) * puf.e00900
-    rent_losses = puf.e02000.lt(0) * puf.e02000
-    farm_losses = puf.e02100.lt(0) * puf.e02100
-    above_line_losses = capital_losses + other_losses + business_losses \
-        + rent_losses + farm_losses
+    above_line_losses = np.minimum(col('c23650'), 0) \
+        + np.minimum(col('c01000'), 0) \
+        + np.minimum(col('e01200'), 0) \
+        + np.minimum(col('e00900'), 0) \
+        + np.minimum(col('e02000'), 0) \
+        + np.minimum(col('e02100'), 0)
 
     # add back any untaxed income that was excluded in calculating
     # above the line income and that is not considered "exempt"
@@ -210,7 +185,7 @@ def filers(puf, year=2017):
     gross_income = above_line_income - above_line_losses + above_line_untaxed
 
     # to be on the safe side, don't let gross_income be negative
-    gross_income = gross_income * gross_income.ge(0)
+    gross_income = np.maximum(gross_income, 0)
 
     # define filer masks; the approach is to define two groups of households:
     #   (1) households that are required to file based on marital status,
@@ -220,76 +195,59 @@ def filers(puf, year=2017):
     #       wage income, or are seeking a credit, or have a complex return
     #       (they have negative AGI)
 
-    # single
-    m_single_lt65 = puf.MARS.eq(1) \
-        & puf.age_head.lt(65) \
-        & gross_income.ge(s_inc_lt65)
-
-    m_single_ge65 = puf.MARS.eq(1) \
-        & puf.age_head.ge(65) \
-        & gross_income.ge(s_inc_ge65)
-
-    m_single = m_single_lt65 | m_single_ge65
-
-    # married joint
-    m_mfj_bothlt65 = puf.MARS.eq(2) \
-        & puf.age_head.lt(65) \
-        & puf.age_spouse.lt(65) \
-        & gross_income.ge(mfj_inc_bothlt65)
-
-    m_mfj_onege65 = puf.MARS.eq(2) \
-        & (puf.age_head.ge(65) | puf.age_spouse.ge(65)) \
-        & ~(puf.age_head.ge(65) & puf.age_spouse.ge(65)) \
-        & gross_income.ge(mfj_inc_onege65)
-
-    m_mfj_bothge65 = puf.MARS.eq(2) \
-        & puf.age_head.ge(65) \
-        & puf.age_spouse.ge(65) \
-        & gross_income.ge(mfj_inc_bothge65)
-
-    m_mfj = m_mfj_bothlt65 | m_mfj_onege65 | m_mfj_bothge65
-
-    # married separate
-    m_mfs = puf.MARS.eq(3) & gross_income.ge(mfs_inc)
-
-    # head of household
-    m_hoh_lt65 = puf.MARS.eq(4) \
-        & puf.age_head.lt(65) \
-        & gross_income.ge(hoh_inc_lt65)
-
-    m_hoh_ge65 = puf.MARS.eq(4) \
-        & puf.age_head.ge(65) \
-        & gross_income.ge(hoh_inc_ge65)
-
-    m_hoh = m_hoh_lt65 | m_hoh_ge65
-
-    # qualifying widow(er)
-    m_qw_lt65 = puf.MARS.eq(5) \
-        & puf.age_head.lt(65) \
-        & gross_income.ge(qw_inc_lt65)
-
-    m_qw_ge65 = puf.MARS.eq(5) \
-        & puf.age_head.ge(65) \
-        & gross_income.ge(qw_inc_ge65)
-
-    m_qw = m_qw_lt65 | m_qw_ge65
-
-    m_required = m_single | m_mfj | m_mfs | m_hoh | m_qw
+    # required: look up each return's threshold by MARS and the number of
+    # people aged 65+ (the spouse only counts for married joint)
+    mars = col('MARS')
+    nage65 = (col('age_head') >= 65).astype(np.int8) \
+        + ((mars == 2) & (col('age_spouse') >= 65)).astype(np.int8)
+    mars_ok = (mars >= 1) & (mars < thresh.shape[0])
+    m_required = mars_ok \
+        & (gross_income >= thresh[np.where(mars_ok, mars, 0), nage65])
 
     # returns that surely will or must file even if
     # marital-status/age/gross_income requirement is not met
-    m_negagi = puf.c00100.lt(0)  # negative agi
-    m_iitax = puf.iitax.ne(0)
-    m_credits = puf.c07100.ne(0) | puf.refund.ne(0)
-    m_wages = puf.e00200.ge(wage_threshold)
+    m_negagi = col('c00100') < 0  # negative agi
+    m_iitax = col('iitax') != 0
+    m_credits = (col('c07100') != 0) | (col('refund') != 0)
+    m_wages = col('e00200') >= wage_threshold
 
-    m_likely = m_negagi | m_iitax | m_credits | m_wages
+    m_filer = m_required | m_negagi | m_iitax | m_credits | m_wages
 
-    m_filer = m_required | m_likely
+    if isinstance(puf, pd.DataFrame):
+        m_filer = pd.Series(m_filer, index=puf.index)
 
     return m_filer
 
 
+def filing_threshold_array(year, thresholds=None):
+    """Return (thresh, wage_threshold) for a year.
+
+    thresh is a float array indexed [MARS, nage65]; row 0 and any MARS or
+    age cell missing from the table are inf, so those returns are never
+    required to file on gross income alone.
+    """
+    if thresholds is None:
+        thresholds = pc.FILING_THRESHOLDS
+    yt = thresholds[thresholds['year'] == year]
+    if len(yt) == 0:
+        raise ValueError(f'no filing thresholds for year {year}')
+    thresh = np.full((yt['MARS'].max() + 1, 3), np.inf)
+    thresh[yt['MARS'].to_numpy(), yt['nage65'].to_numpy()] = yt['gross_income'].to_numpy()
+    return thresh, yt['wage_threshold'].iloc[0]
+
+
+# %% tax-calculator output
+def tc_dataframe(calc, profile='full'):
+    # calc.dataframe with the variables of an output profile in
+    # pc.TC_PROFILES: 'reweight' and 'analysis' keep only what those steps
+    # use; 'full' keeps everything (all_vars=True), as is needed for files
+    # that become tc.Records data
+    varlist = pc.TC_PROFILES[profile]
+    if varlist is None:
+        return calc.dataframe(variable_list=[], all_vars=True)
+    return calc.dataframe(variable_list=varlist)
+
+
 # %% prepare puf for comparison
 def prep_puf(puf, pufvars_to_nnz=None):
     puf['common_stub'] = pd.cut(
@@ -323,13 +281,103 @@ def prep_puf(puf, pufvars_to_nnz=None):
     puf['e26270pos'] = puf.e26270 * puf.e26270.gt(0)
     puf['e26270neg'] = puf.e26270 * puf.e26270.lt(0)
 
+    newvars = ['common_stub', 'ht2_stub', 'filer', 'nret_all',
+               'mars1', 'mars2', 'mars3', 'mars4', 'mars5',
+               'c01000pos', 'c01000neg', 'e26270pos', 'e26270neg']
+
     if pufvars_to_nnz is not None:
         for var in pufvars_to_nnz:
             puf[var + '_nnz'] = puf[var].ne(0) * 1
+            newvars.append(var + '_nnz')
+
+    # only the columns created here follow the prepared-subset schema; the
+    # rest of the file is left as it came from tax-calculator
+    enforce_prep_dtypes(puf, newvars)
 
     return puf
 
 
+# %% dtype schema for prepared puf subsets
+# prepared subsets (rwp.prep_puf and prep_puf below) hold many indicator
+# columns and many amounts for ~233k filers, and we want several years and
+# weight sets in memory at once, so columns are stored as:
+#   ids: pid int64, filer bool
+#   stubs: int8
+#   indicators (nret_all, mars1-mars5, *_nnz): uint8
+#   amounts: float32, except FLOAT64_VARS
+# float32 keeps about 7 significant digits per record, which is far finer
+# than any target tolerance once records are summed in float64 (get_wtdsums
+# converts to float64 before summing). Precision matters for weights and for
+# agi, which defines the stubs and may be re-cut later, so those stay float64.
+PREP_DTYPES = {'pid': 'int64',
+               'filer': 'bool',
+               'common_stub': 'int8',
+               'ht2_stub': 'int8',
+               'nret_all': 'uint8',
+               'mars1': 'uint8',
+               'mars2': 'uint8',
+               'mars3': 'uint8',
+               'mars4': 'uint8',
+               'mars5': 'uint8'}
+
+FLOAT64_VARS = ['c00100', 's006', 'weight']
+
+
+def prep_dtype(col):
+    """Return the schema dtype for a column of a prepared puf subset."""
+    if col in PREP_DTYPES:
+        return PREP_DTYPES[col]
+    if col.endswith('_nnz'):
+        return 'uint8'
+    if col in FLOAT64_VARS:
+        return 'float64'
+    return 'float32'
+
+
+def enforce_prep_dtypes(df, cols=None):
+    """Cast columns of a prepared puf subset to the schema dtypes, in place.
+
+    cols limits the cast to those columns (default all columns); columns that
+    are not numeric, bool, or categorical with numeric labels (the pd.cut
+    stubs) are left alone. Returns df.
+    """
+    if cols is None:
+        cols = df.columns.tolist()
+    for col in cols:
+        x = df[col]
+        if isinstance(x.dtype, pd.CategoricalDtype):
+            numeric = pd.api.types.is_numeric_dtype(x.cat.categories)
+        else:
+            numeric = pd.api.types.is_numeric_dtype(x) or pd.api.types.is_bool_dtype(x)
+        if numeric:
+            dtype = prep_dtype(col)
+            if x.dtype != dtype:
+                df[col] = x.astype(dtype)
+    return df
+
+
+def memreport(df, name=None):
+    """Memory used by a dataframe, by dtype, compared with all-float64 storage.
+
+    Example:  pu.memreport(pufsub, 'pufsub')
+    """
+    mb = 1024**2
+    colmem = df.memory_usage(index=False, deep=True)
+    report = pd.DataFrame({'dtype': df.dtypes.astype(str),
+                           'mb': colmem / mb,
+                           'mb_float64': len(df) * 8 / mb})
+    report = report.groupby('dtype').agg(ncols=('mb', 'size'),
+                                         mb=('mb', 'sum'),
+                                         mb_float64=('mb_float64', 'sum'))
+    report.loc['total'] = report.sum()
+    report['ncols'] = report.ncols.astype('int64')
+    report['pct_of_float64'] = report.mb / report.mb_float64 * 100
+    if name is not None:
+        print(f'{name}: {len(df):,} rows, {report.at["total", "mb"]:,.1f} MB, '
+              f'{report.at["total", "pct_of_float64"]:.0f}% of all-float64 size')
+    return report
+
+
 # %% utility functions
 
 def getmem(objects=dir()):
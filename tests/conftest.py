@@ -0,0 +1,37 @@
+# shared fixtures for the tests; the data are synthetic (see
+# functions_synthetic_puf), so the tests run without the puf
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repo, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import functions_synthetic_puf as sp  # noqa: E402
+import puf_constants as pc  # noqa: E402
+
+NRECS = 20000
+
+
+@pytest.fixture(scope='session')
+def tcout():
+    # a synthetic tax-calculator output file, laid out like PUF_REGROWN
+    return sp.synthetic_tcout(NRECS, seed=1, chunksize=7000)
+
+
+@pytest.fixture(scope='session')
+def weights_initial(tcout):
+    return sp.synthetic_weights(tcout)
+
+
+@pytest.fixture(scope='session')
+def ptargets():
+    rwp = pytest.importorskip('functions_reweight_puf', exc_type=ImportError)
+    return rwp.get_possible_targets(pc.DATADIR + 'targets2017_possible.csv')
+
+
+@pytest.fixture(scope='session')
+def pufsub(tcout, ptargets):
+    rwp = pytest.importorskip('functions_reweight_puf', exc_type=ImportError)
+    return rwp.prep_puf(tcout, ptargets)
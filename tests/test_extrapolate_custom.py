@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import functions_synthetic_puf as sp
+import puf_constants as pc
+import puf_extrapolate_custom as xc
+
+NRECS = 5000
+CHUNKSIZE = 1500  # the last chunk is short
+
+
+@pytest.fixture(scope='module')
+def gf_custom():
+    return pd.read_csv(pc.DATADIR + 'growfactors_custom_busincloss.csv')
+
+
+@pytest.fixture(scope='module', params=['csv', 'parquet'])
+def pufpath(request, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('puf') / ('puf.' + request.param))
+    return sp.write_synthetic(path, NRECS, kind='puf', seed=2, chunksize=CHUNKSIZE)
+
+
+@pytest.fixture(scope='module')
+def puf(pufpath):
+    if pufpath.endswith('.csv'):
+        return pd.read_csv(pufpath)
+    return pd.read_parquet(pufpath)
+
+
+def test_extrapolate_custom_signed_and_sums(puf, gf_custom):
+    cumgf = xc.cumulative_growfactors(gf_custom, 2017)
+    pufx = xc.extrapolate_custom(puf, gf_custom, 2017)
+    np.testing.assert_allclose(pufx.e00200, puf.e00200 * cumgf['AWAGE'])
+    expected = np.where(puf.e00900p >= 0, puf.e00900p * cumgf['ASCHCI_ADJ'],
+                        puf.e00900p * cumgf['ASCHCL_ADJ'])
+    np.testing.assert_allclose(pufx.e00900p, expected)
+    np.testing.assert_allclose(pufx.e00900, pufx.e00900p + pufx.e00900s)
+    assert (puf.e00900p < 0).any() and (puf.e00900p > 0).any()
+    pd.testing.assert_series_equal(pufx.RECID, puf.RECID)
+
+
+def test_extrapolate_custom_stream_matches_in_memory(pufpath, puf, gf_custom, tmp_path):
+    savepath = str(tmp_path / 'puf2017.parquet')
+    xc.extrapolate_custom_stream(pufpath, gf_custom, 2017, savepath, chunksize=CHUNKSIZE)
+    streamed = pd.read_parquet(savepath)
+    expected = xc.extrapolate_custom(puf, gf_custom, 2017)
+    pd.testing.assert_frame_equal(streamed, expected)
+
+
+def test_extrapolate_custom_years_matches_each_year(pufpath, puf, gf_custom, tmp_path):
+    years = [2017, 2018, 2019]
+    savedir = str(tmp_path / 'xdir')
+    xc.extrapolate_custom_years(pufpath, gf_custom, years, savedir, chunksize=CHUNKSIZE)
+    for year in years:
+        result = xc.read_extrapolated_year(savedir, year)
+        expected = xc.extrapolate_custom(puf, gf_custom, year)
+        pd.testing.assert_frame_equal(result[expected.columns], expected)
+        assert sorted(result.columns) == sorted(expected.columns)
+
+
+def test_extrapolate_custom_years_hive_dataset(pufpath, gf_custom, tmp_path):
+    # savedir/years reads as a dataset of the grown columns, partitioned by year
+    savedir = str(tmp_path / 'xdir')
+    xc.extrapolate_custom_years(pufpath, gf_custom, [2017, 2018], savedir, chunksize=CHUNKSIZE)
+    years = pd.read_parquet(savedir + '/years')
+    growvars = list(xc.GF_MAP) + list(xc.GF_SIGNED_MAP) + list(xc.GF_SUM_MAP)
+    assert sorted(years.columns) == sorted(['row', 'year'] + growvars)
+    assert years.groupby('year', observed=True).size().tolist() == [NRECS, NRECS]
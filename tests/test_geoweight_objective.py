@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import scipy.sparse as sps
+from scipy.optimize import approx_fprime, minimize
+
+import functions_geoweight_objective as gwo
+
+H, S, K = 9, 4, 3  # records, states, targets
+
+
+@pytest.fixture(scope='module')
+def prob():
+    rng = np.random.default_rng(0)
+    xmat = rng.random((H, K)) * 10
+    targets = rng.random((S, K)) * 100
+    diff_weights = rng.random((S, K)) + .5
+    x = rng.random(H * S) * 5
+    return x, (xmat, targets, 0.7, diff_weights)
+
+
+@pytest.fixture(scope='module')
+def hessian(prob):
+    # f is quadratic, so differences of the exact gradient give the hessian
+    x, args = prob
+    return np.column_stack([gwo.gradient(x + e, *args) - gwo.gradient(x, *args)
+                            for e in np.eye(x.size)])
+
+
+def f(x, xmat, targets, objscale, diff_weights):
+    # the objective as written in puf_geoweight.py
+    whs = x.reshape((xmat.shape[0], targets.shape[0]))
+    diffs = np.dot(whs.T, xmat) - targets
+    return np.square(diffs * diff_weights).sum() * objscale
+
+
+def test_objective_and_gradient(prob):
+    x, args = prob
+    assert gwo.objective(x, *args) == pytest.approx(f(x, *args))
+    grad = gwo.gradient(x, *args)
+    np.testing.assert_allclose(grad, approx_fprime(x, f, 1e-6, *args), rtol=1e-5)
+    obj, grad2 = gwo.objective_and_gradient(x, *args)
+    assert obj == pytest.approx(f(x, *args))
+    np.testing.assert_allclose(grad2, grad)
+
+
+def test_hessian_forms(prob, hessian):
+    x, (xmat, targets, objscale, diff_weights) = prob
+    p = np.random.default_rng(1).random(x.size)
+    np.testing.assert_allclose(gwo.hessp(x, p, xmat, targets, objscale, diff_weights), hessian @ p)
+    np.testing.assert_allclose(gwo.hess_operator(xmat, targets, objscale, diff_weights) @ p, hessian @ p)
+    np.testing.assert_allclose(gwo.hess_diag(xmat, targets, objscale, diff_weights), np.diag(hessian))
+    blocks = gwo.hess_blocks(xmat, objscale, diff_weights)
+    for j in range(S):
+        np.testing.assert_allclose(blocks[j], hessian[j::S, j::S])
+
+
+def test_hess_lower(prob, hessian):
+    x, (xmat, targets, objscale, diff_weights) = prob
+    rows, cols, values = gwo.hess_lower(xmat, objscale, diff_weights)
+    assert (rows >= cols).all()
+    lower = sps.coo_matrix((values, (rows, cols)), shape=hessian.shape).toarray()
+    np.testing.assert_allclose(lower, np.tril(hessian), atol=1e-9)
+    # the structure is exactly the nonzeros: the states' blocks do not interact
+    assert rows.size == np.count_nonzero(np.abs(np.tril(hessian)) > 1e-9)
+
+
+@pytest.mark.parametrize('method', ['trust-ncg', 'trust-krylov'])
+def test_minimize_with_hessp(prob, method):
+    x, args = prob
+    res = minimize(gwo.objective, np.ones(x.size), args=args, jac=gwo.gradient,
+                   hessp=gwo.hessp, method=method)
+    assert res.success
+    np.testing.assert_allclose(gwo.gradient(res.x, *args), 0, atol=1e-4)
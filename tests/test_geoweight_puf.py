@@ -0,0 +1,150 @@
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import puf_constants as pc
+
+gwp = pytest.importorskip('functions_geoweight_puf', exc_type=ImportError)  # needs src.microweight
+
+TARGVARS = ['nret_all', 'c00100']
+STGROUPS = ['AL', 'CA', 'other']
+SHARES = [0.1, 0.3, 0.6]
+
+
+@pytest.fixture(scope='module')
+def geoprob(pufsub, weights_initial):
+    # a few hundred records over the ht2 stubs, with state targets that are
+    # shares of the stub's weighted sums, off by a few percent
+    rng = np.random.default_rng(3)
+    df = pufsub.iloc[::20][['pid', 'ht2_stub'] + TARGVARS].reset_index(drop=True)
+    df = df[df.ht2_stub.isin(df.ht2_stub.value_counts().loc[lambda s: s >= 20].index)]
+    weightdf = weights_initial[['pid', 'weight']]
+    sums = (pd.merge(df, weightdf, on='pid')
+            .assign(**{var: lambda d, var=var: d[var] * d.weight for var in TARGVARS})
+            .groupby('ht2_stub')[TARGVARS].sum())
+    rows = []
+    for stub, stubsums in sums.iterrows():
+        for stgroup, share in zip(STGROUPS, SHARES):
+            row = {'ht2_stub': stub, 'stgroup': stgroup}
+            row.update((stubsums * share * rng.uniform(0.97, 1.03, len(TARGVARS))).to_dict())
+            rows.append(row)
+    ht2wide = pd.DataFrame(rows)
+    dropsdf_wide = ht2wide.copy()
+    dropsdf_wide[TARGVARS] = False
+    return df, weightdf, ht2wide, dropsdf_wide
+
+
+def test_geoweight_parallel_matches_serial(geoprob):
+    df, weightdf, ht2wide, dropsdf_wide = geoprob
+    args = dict(weightdf=weightdf, targvars=TARGVARS, ht2wide=ht2wide, dropsdf_wide=dropsdf_wide,
+                independent=False, geomethod='qmatrix', options={})
+    serial = df.groupby('ht2_stub').apply(gwp.get_geo_weights, **args)
+    parallel, stub_stats = gwp.get_geo_weights_parallel(df, workers=2, **args)
+    pd.testing.assert_frame_equal(parallel, serial)
+    assert (stub_stats.status == 'solved').all()
+    assert stub_stats.ht2_stub.tolist() == sorted(df.ht2_stub.unique())
+
+
+def failing_solve(wh, xmat, targets, geomethod, options, Q):
+    if wh.size == FAILSIZE:
+        raise ValueError('no solution')
+    return SOLVE(wh, xmat, targets, geomethod, options, Q)
+
+
+SOLVE = gwp.geo_stub_solve
+FAILSIZE = None
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                    reason='the workers only see the patched solver when forked')
+def test_geoweight_parallel_raises_on_failed_stub(geoprob, monkeypatch):
+    df, weightdf, ht2wide, dropsdf_wide = geoprob
+    sizes = df.ht2_stub.value_counts()
+    stub = sizes[~sizes.duplicated(keep=False)].index[0]  # the only stub of its size
+    monkeypatch.setattr(gwp, 'geo_stub_solve', failing_solve)
+    monkeypatch.setitem(globals(), 'FAILSIZE', sizes[stub])
+    with pytest.raises(RuntimeError, match=f'failed for ht2 stubs \\[{stub}\\]'):
+        gwp.get_geo_weights_parallel(df, weightdf, TARGVARS, ht2wide, dropsdf_wide,
+                                     False, 'qmatrix', {}, workers=2)
+
+
+def test_collapse_ht2(tmp_path):
+    states = pc.STATES_DCPROA
+    ht2_shares = pd.DataFrame({'state': states, 'pufvar': 'nret_all', 'ht2var': 'N1',
+                               'ht2description': 'returns', 'ht2_stub': 1,
+                               'share': 1 / len(states), 'ht2': 100.0})
+    path = str(tmp_path / 'ht2_shares.csv')
+    ht2_shares.to_csv(path, index=None)
+
+    collapsed = gwp.collapse_ht2(path, ['NY', 'CA'])
+    assert collapsed.stgroup.tolist() == ['CA', 'NY', 'other']
+    assert collapsed.ht2.tolist() == [100, 100, 100 * (len(states) - 2)]
+
+    collapsed = gwp.collapse_ht2(path, 'all')
+    assert sorted(collapsed.stgroup) == sorted(states) and len(collapsed) == 53
+    assert collapsed.share.sum() == pytest.approx(1)
+
+
+@pytest.fixture
+def stored(tmp_path):
+    # state weights for pids 100-109 saved in a Q store; returns the store and
+    # the saved row shares
+    rng = np.random.default_rng(5)
+    whs = rng.uniform(1, 10, (10, len(STGROUPS)))
+    gwp.qstore_save(str(tmp_path), TARGVARS, STGROUPS, 3, np.arange(100, 110), whs)
+    return str(tmp_path), whs / whs.sum(axis=1, keepdims=True)
+
+
+def test_qstore_reorders_pids(stored):
+    qstore, Q = stored
+    pids = np.arange(100, 110)[::-1]
+    np.testing.assert_allclose(gwp.qstore_load(qstore, TARGVARS, STGROUPS, 3, pids), Q[::-1])
+
+
+def test_qstore_fills_missing_pids(stored):
+    # pids not in the store start at the average stored shares
+    qstore, Q = stored
+    pids = np.array([105, 999, 100, 101, 102, 103, 104, 998])
+    Q_init = gwp.qstore_load(qstore, TARGVARS, STGROUPS, 3, pids)
+    np.testing.assert_allclose(Q_init[[0, 2, 3, 4, 5, 6]], Q[[5, 0, 1, 2, 3, 4]])
+    np.testing.assert_allclose(Q_init[[1, 7]], np.tile(Q.mean(axis=0), (2, 1)))
+
+
+def test_qstore_falls_back_to_none(stored):
+    qstore, Q = stored
+    few = np.array([100, 101, 901, 902, 903])  # 40% are in the store
+    assert gwp.qstore_load(qstore, TARGVARS, STGROUPS, 3, few) is None
+    assert gwp.qstore_load(qstore, TARGVARS, STGROUPS, 3, few, min_match=0.4) is not None
+    pids = np.arange(100, 110)
+    assert gwp.qstore_load(qstore, TARGVARS, STGROUPS, 4, pids) is None  # no Q for stub 4
+    assert gwp.qstore_load(qstore, TARGVARS, ['AL', 'other'], 3, pids) is None
+
+
+def test_geo_stub_problem_q_priority(geoprob, tmp_path):
+    # explicit qshares come first, then a Q store warm start, then the
+    # default nret_all shares
+    df, weightdf, ht2wide, dropsdf_wide = geoprob
+    stub = df.ht2_stub.iloc[0]
+    dfstub = df[df.ht2_stub == stub]
+    args = (stub, weightdf, TARGVARS, ht2wide, dropsdf_wide, False)
+    rng = np.random.default_rng(6)
+    n = len(dfstub)
+
+    _, prob = gwp.geo_stub_problem(dfstub.copy(), *args, {'qstore': str(tmp_path)})
+    targets = ht2wide[ht2wide.ht2_stub == stub]
+    np.testing.assert_allclose(prob['Q'], np.tile(targets.nret_all / targets.nret_all.sum(), (n, 1)))
+    assert prob['qstore'] == str(tmp_path) and 'qstore' not in prob['options']
+
+    whs = rng.uniform(1, 10, (n, len(STGROUPS)))
+    gwp.qstore_save(str(tmp_path), TARGVARS, STGROUPS, stub, dfstub.pid, whs)
+    _, prob = gwp.geo_stub_problem(dfstub.copy(), *args, {'qstore': str(tmp_path)})
+    np.testing.assert_allclose(prob['Q'], whs / whs.sum(axis=1, keepdims=True))
+
+    qshares = pd.DataFrame(rng.dirichlet(np.ones(len(STGROUPS)), n), columns=STGROUPS)
+    qshares.insert(0, 'pid', dfstub.pid.to_numpy())
+    qshares.insert(1, 'ht2_stub', stub)
+    _, prob = gwp.geo_stub_problem(dfstub.copy(), *args, {'qstore': str(tmp_path), 'qshares': qshares})
+    np.testing.assert_allclose(prob['Q'], qshares[STGROUPS].to_numpy())
+    assert 'qshares' not in prob['options']
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+rwp = pytest.importorskip('functions_reweight_puf', exc_type=ImportError)  # needs src.microweight
+ha = pytest.importorskip('functions_ht2_analysis', exc_type=ImportError)
+
+STATES = ['AL', 'CA', 'NY', 'other']
+
+
+@pytest.fixture(scope='module')
+def sweights(pufsub, weights_initial):
+    # state weights laid out like the geoweight output: pid, ht2_stub, one
+    # column per state group and their sum
+    rng = np.random.default_rng(2)
+    df = pd.merge(pufsub[['pid', 'ht2_stub']], weights_initial[['pid', 'weight']], on='pid')
+    shares = rng.dirichlet(np.ones(len(STATES)), len(df))
+    df[STATES] = shares * df.weight.to_numpy().reshape(-1, 1)
+    df['geoweight_sum'] = df[STATES].sum(axis=1)
+    return df
+
+
+def test_align_weights():
+    weightdf = pd.DataFrame({'pid': [1, 2, 3], 'a': [10., np.nan, 30.], 'b': [1., 2., 3.]})
+    wmat = rwp.align_weights(np.array([3, 1, 9, 2]), weightdf)
+    np.testing.assert_array_equal(wmat, [[30., 3.], [10., 1.], [0., 0.], [0., 2.]])
+
+
+def test_allstates_cube_matches_get_wtdsums(pufsub, sweights):
+    sumvars = ['nret_all', 'c00100', 'e00200']
+    stubs = pufsub.ht2_stub.to_numpy()
+    wmat = rwp.align_weights(pufsub.pid, sweights[['pid'] + STATES])
+    cube = ha.get_allstates_cube(pufsub[sumvars].to_numpy(dtype=float), wmat, stubs)
+    present = np.concatenate(([0], np.unique(stubs)))
+    for j, state in enumerate(STATES):
+        expected = rwp.get_wtdsums(pufsub, sumvars, sweights[['pid', state]], stubvar='ht2_stub')
+        np.testing.assert_allclose(cube[j, present, :], expected[sumvars].to_numpy(), rtol=1e-9)
+
+
+def test_allstates_wsums_unmatched_get_zero(pufsub, sweights):
+    # records whose pid is missing, or whose ht2_stub differs, get weight 0
+    sumvars = [s for s in pufsub.columns if s not in ['pid', 'filer', 'common_stub', 'ht2_stub']]
+    missing = sweights.pid.isin(pufsub.pid.iloc[::7])
+    moved = sweights.pid.isin(pufsub.pid.iloc[3::11]) & ~missing
+    partial = sweights[~missing].copy()
+    partial.loc[moved, 'ht2_stub'] = partial.loc[moved, 'ht2_stub'] % 10 + 1
+    result = ha.get_allstates_wsums(pufsub, partial)
+
+    matched = ~pufsub.pid.isin(sweights.pid[missing | moved])
+    for state in ['CA', 'other']:
+        expected = rwp.get_wtdsums(pufsub[matched], sumvars, sweights[['pid', state]],
+                                   stubvar='ht2_stub')
+        got = result[result.stgroup == state].pivot(index='ht2_stub', columns='pufvar', values='puf')
+        got = got.reindex(index=expected.index, columns=sumvars)
+        np.testing.assert_allclose(got.to_numpy(), expected[sumvars].to_numpy(), rtol=1e-9, atol=1e-6)
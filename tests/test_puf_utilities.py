@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import puf_constants as pc
+import puf_utilities as pu
+
+
+def test_prep_dtype():
+    assert pu.prep_dtype('pid') == 'int64'
+    assert pu.prep_dtype('common_stub') == 'int8'
+    assert pu.prep_dtype('mars2') == 'uint8'
+    assert pu.prep_dtype('e00200_nnz') == 'uint8'
+    assert pu.prep_dtype('c00100') == 'float64'
+    assert pu.prep_dtype('e00200') == 'float32'
+
+
+def test_enforce_prep_dtypes():
+    df = pd.DataFrame({'pid': [1.0, 2.0], 'mars1': [True, False], 'e00200': [1.5, 2.5],
+                       'c00100': np.array([1, 2], dtype='int32'), 'state': ['NY', 'CA'],
+                       'ht2_stub': pd.cut([5.0, 15.0], [0, 10, 20], labels=[1, 2])})
+    state_dtype = df.state.dtype
+    result = pu.enforce_prep_dtypes(df, cols=['pid', 'mars1', 'e00200', 'state', 'ht2_stub'])
+    assert result is df
+    assert df.drop(columns='state').dtypes.astype(str).tolist() == ['int64', 'uint8', 'float32', 'int32', 'int8']
+    assert df.state.dtype == state_dtype
+    assert df.ht2_stub.tolist() == [1, 2]
+    pu.enforce_prep_dtypes(df)
+    assert df.c00100.dtype == 'float64'
+
+
+def test_pu_prep_puf_casts_only_new_columns(tcout):
+    puf = pu.prep_puf(tcout.copy(), pufvars_to_nnz=['e00200'])
+    newvars = ['common_stub', 'ht2_stub', 'filer', 'nret_all', 'mars1', 'mars5',
+               'c01000pos', 'e26270neg', 'e00200_nnz']
+    assert {var: str(puf[var].dtype) for var in newvars} == {var: pu.prep_dtype(var) for var in newvars}
+    unchanged = tcout.columns.tolist()
+    pd.testing.assert_frame_equal(puf[unchanged], tcout)
+
+
+def test_rwp_prep_puf_follows_schema(pufsub):
+    for col in pufsub.columns:
+        assert str(pufsub[col].dtype) == pu.prep_dtype(col), col
+
+
+def test_compact_wtdsums_match_float64(tcout, pufsub, weights_initial, ptargets, monkeypatch):
+    # the narrowed pufsub against prep_puf's output before the schema is applied;
+    # float32 amounts are summed in float64, so the stub sums barely move
+    rwp = pytest.importorskip('functions_reweight_puf', exc_type=ImportError)
+    monkeypatch.setattr(pu, 'enforce_prep_dtypes', lambda df, cols=None: df)
+    wide = rwp.prep_puf(tcout, ptargets)
+    names = [var for var in ptargets.columns if var != 'common_stub']
+    assert (pufsub[names].dtypes == 'float32').any()
+    assert not (wide[names].dtypes == 'float32').any()
+    compact = rwp.get_wtdsums(pufsub, names, weights_initial)
+    full = rwp.get_wtdsums(wide, names, weights_initial)
+    np.testing.assert_allclose(compact[names].to_numpy(), full[names].to_numpy(), rtol=1e-6)
+    assert not np.array_equal(compact[names].to_numpy(), full[names].to_numpy())
+
+
+def test_memreport(pufsub):
+    report = pu.memreport(pufsub)
+    mb = pufsub.memory_usage(index=False, deep=True).sum() / 1024**2
+    assert report.at['total', 'mb'] == pytest.approx(mb)
+    assert report.at['total', 'ncols'] == pufsub.shape[1]
+    assert report.at['total', 'pct_of_float64'] < 100
+
+
+# gross income filing thresholds from IRS Publication 17 (Publication 501
+# from 2018 on): single <65, >=65; joint both <65, one >=65, both >=65;
+# separate; head of household <65, >=65; widow(er) <65, >=65
+THRESHOLDS = {2017: [10400, 11950, 20800, 22050, 23300, 4050, 13400, 14950, 16750, 18000],
+              2018: [12000, 13600, 24000, 25300, 26600, 5, 18000, 19600, 24000, 25300],
+              2019: [12200, 13850, 24400, 25700, 27000, 5, 18350, 20000, 24400, 25700],
+              2020: [12400, 14050, 24800, 26100, 27400, 5, 18650, 20300, 24800, 26100]}
+
+
+def filers_pandas(puf, year):
+    # the pandas implementation filers replaced, with its thresholds by year
+    (s_lt65, s_ge65, mfj_0, mfj_1, mfj_2, mfs, hoh_lt65, hoh_ge65,
+     qw_lt65, qw_ge65) = THRESHOLDS[year]
+    capital_losses = puf.c23650.lt(0) * puf.c23650 + puf.c01000.lt(0) * puf.c01000
+    above_line_losses = capital_losses + puf.e01200.lt(0) * puf.e01200 \
+        + puf.e00900.lt(0) * puf.e00900 + puf.e02000.lt(0) * puf.e02000 \
+        + puf.e02100.lt(0) * puf.e02100
+    gross_income = puf.c00100 + puf.c02900 - above_line_losses
+    gross_income = gross_income * gross_income.ge(0)
+
+    head65, spouse65 = puf.age_head.ge(65), puf.age_spouse.ge(65)
+    m_required = (puf.MARS.eq(1) & ~head65 & gross_income.ge(s_lt65)) \
+        | (puf.MARS.eq(1) & head65 & gross_income.ge(s_ge65)) \
+        | (puf.MARS.eq(2) & ~head65 & ~spouse65 & gross_income.ge(mfj_0)) \
+        | (puf.MARS.eq(2) & (head65 ^ spouse65) & gross_income.ge(mfj_1)) \
+        | (puf.MARS.eq(2) & head65 & spouse65 & gross_income.ge(mfj_2)) \
+        | (puf.MARS.eq(3) & gross_income.ge(mfs)) \
+        | (puf.MARS.eq(4) & ~head65 & gross_income.ge(hoh_lt65)) \
+        | (puf.MARS.eq(4) & head65 & gross_income.ge(hoh_ge65)) \
+        | (puf.MARS.eq(5) & ~head65 & gross_income.ge(qw_lt65)) \
+        | (puf.MARS.eq(5) & head65 & gross_income.ge(qw_ge65))
+    m_likely = puf.c00100.lt(0) | puf.iitax.ne(0) | puf.c07100.ne(0) | puf.refund.ne(0) \
+        | puf.e00200.ge(1000)
+    return m_required | m_likely
+
+
+@pytest.fixture(scope='module')
+def near_thresholds(tcout):
+    # records that file only on gross income, many of them near a threshold,
+    # in every filing status and age group
+    rng = np.random.default_rng(7)
+    n = len(tcout)
+    return tcout.assign(iitax=0.0, refund=0.0, c07100=0.0,
+                        e00200=np.where(rng.random(n) < 0.1, 1000.0, 0.0),
+                        c00100=rng.uniform(-1000, 30000, n),
+                        MARS=rng.integers(1, 6, n),
+                        age_head=rng.integers(20, 90, n),
+                        age_spouse=rng.integers(20, 90, n))
+
+
+@pytest.mark.parametrize('year', [2017, 2018, 2019, 2020])
+def test_filers_match_pandas_implementation(near_thresholds, year):
+    expected = filers_pandas(near_thresholds, year)
+    assert 0.2 < expected.mean() < 0.9
+    pd.testing.assert_series_equal(pu.filers(near_thresholds, year), expected, check_names=False)
+
+
+def test_filers_table_and_dict_input(near_thresholds):
+    expected = filers_pandas(near_thresholds, 2019).to_numpy()
+    table = pa.Table.from_pandas(near_thresholds, preserve_index=False)
+    np.testing.assert_array_equal(pu.filers(table, 2019), expected)
+    arrays = {col: near_thresholds[col].to_numpy() for col in near_thresholds.columns}
+    np.testing.assert_array_equal(pu.filers(arrays, 2019), expected)
+    with pytest.raises(ValueError):
+        pu.filers(arrays, 2010)
+
+
+class StubCalculator:
+    # records the arguments of calc.dataframe
+    def dataframe(self, variable_list, all_vars=False):
+        self.call = (list(variable_list), all_vars)
+        return pd.DataFrame({var: [0.0] for var in variable_list})
+
+
+@pytest.mark.parametrize('profile', ['reweight', 'analysis', 'full'])
+def test_tc_dataframe_profiles(profile):
+    calc = StubCalculator()
+    df = pu.tc_dataframe(calc, profile)
+    if profile == 'full':
+        assert calc.call == ([], True)
+        return
+    varlist, all_vars = calc.call
+    assert not all_vars and varlist == df.columns.tolist()
+    assert len(set(varlist)) == len(varlist)
+    # every profile keeps the identifiers, the weight, and what filers needs
+    assert set(pc.TC_ID_VARS + pc.TC_FILER_VARS) <= set(varlist)
+    if profile == 'analysis':
+        assert set(pc.TC_PROFILES['reweight']) < set(varlist)
+        assert {'combined', 'payrolltax', 'eitc'} <= set(varlist)
+    pu.filers(df.assign(MARS=1))
@@ -0,0 +1,116 @@
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import puf_constants as pc
+
+fta = pytest.importorskip('functions_tax_analysis', exc_type=ImportError)  # needs taxcalc, src.microweight
+
+NRECS = 500
+# each reform scales iitax or agi; agi changes move records between ht2 stubs
+REFORMS = {'a': {'iitax_scale': 1.1},
+           'b': {'agi_scale': 1.5},
+           'c': {'iitax_scale': 0.8},
+           'd': {'agi_scale': 0.5}}
+
+
+class StubPolicy:
+    def __init__(self):
+        self.params = {'iitax_scale': 1.0, 'agi_scale': 1.0}
+
+    def implement_reform(self, reform):
+        self.params.update(reform)
+
+
+class StubCalculator:
+    # tax-calculator output of the stub records: iitax and agi are scaled by
+    # the policy, the other variables are unchanged
+    runs = 0
+
+    def __init__(self, policy, records):
+        self.params = dict(policy.params)
+        self.records = records
+
+    def calc_all(self):
+        StubCalculator.runs += 1
+        self.df = self.records.data.assign(iitax=self.records.data.iitax * self.params['iitax_scale'],
+                                           c00100=self.records.data.c00100 * self.params['agi_scale'])
+
+    def weighted_total(self, var):
+        return (self.df[var] * self.df.s006).sum()
+
+    def dataframe(self, variable_list, all_vars=False):
+        return self.df[variable_list].copy()
+
+
+@pytest.fixture
+def stubtc(monkeypatch):
+    monkeypatch.setattr(fta, 'tc', types.SimpleNamespace(Policy=StubPolicy, Calculator=StubCalculator,
+                                                         __version__='stub'))
+    monkeypatch.setattr(StubCalculator, 'runs', 0)
+
+
+@pytest.fixture(scope='module')
+def recs():
+    rng = np.random.default_rng(8)
+    data = pd.DataFrame(rng.lognormal(8, 2, (NRECS, len(pc.TC_PROFILES['analysis']))),
+                        columns=pc.TC_PROFILES['analysis'])
+    data['c00100'] = rng.uniform(-10e3, 600e3, NRECS)
+    return types.SimpleNamespace(data=data, current_year=2018)
+
+
+@pytest.fixture(scope='module')
+def pidfiler():
+    return pd.DataFrame({'pid': np.arange(NRECS) * 3, 'filer': True})
+
+
+def direct_frame(order, recs, pidfiler):
+    return fta.cached_reform_frame([REFORMS[name] for name in order], recs, pidfiler)[:2]
+
+
+def test_stack_steps_rebuild_from_deltas(stubtc, recs, pidfiler, tmp_path):
+    stack = fta.ReformStack(REFORMS, recs, pidfiler, str(tmp_path))
+    result = stack.run(['a', 'b', 'c'], 'abc')
+    assert result.source.tolist() == ['computed'] * 3
+    assert StubCalculator.runs == 3
+
+    store = fta.ReformStore(str(tmp_path / 'abc'))
+    assert store.chain('2_c') == ['0_a', '1_b', '2_c']
+    for i, step in enumerate(['0_a', '1_b', '2_c']):
+        df, wsum = direct_frame(['a', 'b', 'c'][:i + 1], recs, pidfiler)
+        pd.testing.assert_frame_equal(store.frame(step), df)
+        assert result.iitax[i] == pytest.approx(wsum)
+    # b changes agi (and so stubs) only, c iitax only
+    assert set(store.index['1_b']['changed_columns']) >= {'c00100', 'ht2_stub'}
+    assert store.index['2_c']['changed_columns'] == ['iitax']
+    assert result.iitax_change.sum() == pytest.approx(result.iitax.iloc[-1])
+
+
+@pytest.mark.parametrize('max_frames, sources', [(2, ['memory', 'computed', 'computed']),
+                                                 (4, ['memory', 'memory', 'computed'])])
+def test_stack_prefix_cache(stubtc, recs, pidfiler, tmp_path, max_frames, sources):
+    # the one-step prefixes stay in memory; longer ones only while they are
+    # among the max_frames most recently used
+    stack = fta.ReformStack(REFORMS, recs, pidfiler, str(tmp_path), max_frames=max_frames)
+    stack.run(['a', 'b', 'c'], 'abc')
+    assert len(stack._frames) == min(3, max_frames)
+    result = stack.run(['a', 'b', 'd'], 'abd')
+    assert result.source.tolist() == sources
+    assert StubCalculator.runs == 3 + sources.count('computed')
+    df, _ = direct_frame(['a', 'b', 'd'], recs, pidfiler)
+    pd.testing.assert_frame_equal(fta.ReformStore(str(tmp_path / 'abd')).frame('2_d'), df)
+
+
+def test_stack_steps_from_disk(stubtc, recs, pidfiler, tmp_path):
+    cache = fta.ReformCache(str(tmp_path / 'cache'))
+    fta.ReformStack(REFORMS, recs, pidfiler, str(tmp_path), cache=cache,
+                    recs_key='stub').run(['a', 'b'], 'ab')
+    # a new session: steps computed before are read from the cache
+    stack = fta.ReformStack(REFORMS, recs, pidfiler, str(tmp_path), cache=cache, recs_key='stub')
+    result = stack.run(['a', 'b', 'c'], 'abc')
+    assert result.source.tolist() == ['disk', 'disk', 'computed']
+    assert StubCalculator.runs == 3
+    df, _ = direct_frame(['a', 'b', 'c'], recs, pidfiler)
+    pd.testing.assert_frame_equal(fta.ReformStore(str(tmp_path / 'abc')).frame('2_c'), df)
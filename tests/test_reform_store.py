@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import puf_constants as pc
+
+fta = pytest.importorskip('functions_tax_analysis', exc_type=ImportError)  # needs taxcalc, src.microweight
+
+
+@pytest.fixture
+def base():
+    rng = np.random.default_rng(9)
+    n = 200
+    df = pd.DataFrame({'pid': np.arange(n) * 2,
+                       'ht2_stub': rng.integers(1, 11, n),
+                       'iitax': rng.normal(5e3, 2e3, n),
+                       'e00200': np.where(rng.random(n) < .2, np.nan, rng.lognormal(10, 1, n)),
+                       'filer': rng.random(n) < .9})
+    df['ht2range'] = df.ht2_stub.map(lambda stub: 'stub ' + str(stub))
+    return df
+
+
+def test_store_round_trip(base, tmp_path):
+    store = fta.ReformStore(str(tmp_path))
+    store.write('base', base)
+    child = base.copy()
+    child.loc[::5, 'iitax'] *= 1.1
+    child.loc[3:7, 'e00200'] = np.nan  # values to NaN and NaN to values
+    child.loc[child.e00200.isna() & (child.index % 2 == 0), 'e00200'] = 1.0
+    child.loc[::9, 'ht2_stub'] = child.ht2_stub[::9] % 10 + 1
+    child['ht2range'] = child.ht2_stub.map(lambda stub: 'stub ' + str(stub))
+    entry = store.write('child', child, 'base')
+    grandchild = child.assign(filer=~child.filer)
+    store.write('grandchild', grandchild, 'child', child)
+
+    store = fta.ReformStore(str(tmp_path))  # a new session reads the index
+    assert store.chain('grandchild') == ['base', 'child', 'grandchild']
+    pd.testing.assert_frame_equal(store.frame('child'), child)
+    pd.testing.assert_frame_equal(store.frame('grandchild'), grandchild)
+    pd.testing.assert_frame_equal(store.frame('grandchild', ['iitax', 'filer']),
+                                  grandchild[['pid', 'iitax', 'filer']])
+
+    changed = ((child != base) & ~(child.isna() & base.isna())).drop(columns='pid')
+    assert entry['changed_rows'] == changed.any(axis=1).sum()
+    assert entry['changed_columns'] == changed.columns[changed.any()].tolist()
+    assert entry['dtypes'] == {}
+    changes = store.changes('child')
+    assert changes.row.tolist() == np.flatnonzero(changed.any(axis=1)).tolist()
+    np.testing.assert_array_equal(changes.pid, child.pid[changes.row])
+    assert store.index['grandchild']['changed_columns'] == ['filer']
+
+
+def test_store_changed_dtype(base, tmp_path):
+    store = fta.ReformStore(str(tmp_path))
+    store.write('base', base)
+    # ht2_stub becomes float with a fractional value; filer becomes int with
+    # the same values, so no record changes
+    child = base.assign(ht2_stub=base.ht2_stub.astype(float), filer=base.filer.astype('int64'))
+    child.loc[4, 'ht2_stub'] = 2.5
+    entry = store.write('child', child, 'base')
+    assert entry['dtypes'] == {'ht2_stub': 'float64', 'filer': 'int64'}
+    assert entry['changed_rows'] == 1 and entry['changed_columns'] == ['ht2_stub']
+    pd.testing.assert_frame_equal(store.frame('child'), child)
+    store.write('grandchild', child.assign(iitax=child.iitax + 1), 'child')
+    pd.testing.assert_frame_equal(store.frame('grandchild'), child.assign(iitax=child.iitax + 1))
+
+
+def test_store_unchanged(base, tmp_path):
+    store = fta.ReformStore(str(tmp_path))
+    store.write('base', base)
+    entry = store.write('same', base.copy(), 'base')
+    assert entry['changed_rows'] == 0 and entry['changed_columns'] == []
+    assert store.delta('same') == {}
+    assert len(store.changes('same')) == 0
+    pd.testing.assert_frame_equal(store.frame('same'), base)
+
+
+def test_write_delta_checks_layout(base, tmp_path):
+    path = str(tmp_path / 'delta.parquet')
+    with pytest.raises(ValueError, match='same columns'):
+        fta.write_delta(base.drop(columns='filer'), base, path)
+    with pytest.raises(ValueError, match='same pids'):
+        fta.write_delta(base.iloc[::-1], base, path)
+
+
+def with_stubs(df):
+    stubs = pd.cut(df.c00100, pc.HT2_AGI_STUBS, labels=range(1, 11), right=False)
+    return df.assign(ht2_stub=stubs.astype('int64'))
+
+
+@pytest.fixture
+def reform_store(tmp_path):
+    # a base and two reforms as a chain; the first moves records between ht2
+    # stubs by changing agi, the second changes iitax on top of it
+    rng = np.random.default_rng(10)
+    n = 1000
+    base = with_stubs(pd.DataFrame({'pid': np.arange(n) * 3,
+                                    'c00100': rng.uniform(-20e3, 1.5e6, n),
+                                    'iitax': rng.normal(10e3, 5e3, n),
+                                    's006': rng.uniform(10, 300, n),
+                                    'XTOT': rng.integers(1, 5, n)}))
+    moved = base.copy()
+    moved.loc[::4, 'c00100'] *= 1.8
+    moved = with_stubs(moved)
+    # the stacked reform also makes an int variable float
+    stacked = moved.assign(iitax=np.where(moved.c00100 > 200e3, moved.iitax * 1.3, moved.iitax),
+                           XTOT=moved.XTOT + np.where(moved.c00100 > 200e3, 0.5, 0))
+    assert (moved.ht2_stub != base.ht2_stub).sum() > 50
+
+    store = fta.ReformStore(str(tmp_path))
+    store.write('base', base)
+    store.write('moved', moved, 'base')
+    store.write('stacked', stacked, 'moved')
+    return store, {'base': base, 'moved': moved, 'stacked': stacked}
+
+
+def groupby_sums(df, weights, areas, varnames):
+    # weighted sums by area and stub (0 is all), direct from a frame
+    df = df.assign(nret=1.0)
+    rows = []
+    for area in areas:
+        w = weights[area].to_numpy()
+        sums = df[varnames].multiply(w, axis=0).groupby(df.ht2_stub).sum()
+        sums = sums.reindex(range(1, 11), fill_value=0)
+        sums.loc[0] = sums.sum()
+        sums = sums.sort_index().reset_index().melt(id_vars='ht2_stub', var_name='variable',
+                                                    value_name='wsum')
+        rows.append(sums.assign(area=area))
+    return pd.concat(rows)
+
+
+def compare(dist, frames, weights, areas, varnames):
+    for name, df in frames.items():
+        expected = groupby_sums(df, weights, areas, varnames)
+        got = dist[dist.reform == name]
+        merged = pd.merge(got, expected, on=['area', 'ht2_stub', 'variable'], how='outer',
+                          suffixes=('', '_expected'), validate='1:1')
+        assert len(merged) == len(areas) * 11 * len(varnames)
+        np.testing.assert_allclose(merged.wsum, merged.wsum_expected, rtol=1e-9, atol=1e-6)
+
+
+def test_dist_table_matches_groupby(reform_store):
+    store, frames = reform_store
+    varnames = ['nret', 'c00100', 'iitax', 'XTOT']
+    dist = fta.dist_table(store, ['base', 'moved', 'stacked'], varnames, batch_size=37)
+    assert dist.reform.unique().tolist() == ['base', 'moved', 'stacked']
+    compare(dist, frames, frames['base'].assign(US=frames['base'].s006), ['US'], varnames)
+    total = dist.query('reform == "moved" & ht2_stub == 0 & variable == "nret"').wsum
+    assert total.item() == pytest.approx(frames['base'].s006.sum())
+    assert (dist.ht2range[dist.ht2_stub == 0] == 'All income ranges').all()
+
+
+def test_dist_table_area_weights(reform_store):
+    # state weights that split each national weight among AL, CA, and
+    # 'other'; the last 100 records have no state weights
+    store, frames = reform_store
+    base = frames['base']
+    rng = np.random.default_rng(11)
+    shares = rng.dirichlet(np.ones(3), len(base))
+    weights = pd.DataFrame(shares * base.s006.to_numpy().reshape(-1, 1), columns=['AL', 'CA', 'other'])
+    weights.insert(0, 'pid', base.pid)
+    weights.insert(1, 'ht2_stub', base.ht2_stub)
+    weights.insert(2, 'weight', base.s006)
+    weights.insert(3, 'geoweight_sum', weights[['AL', 'CA', 'other']].sum(axis=1))
+    weights['shortname'] = 'allweights'
+    weights = weights.iloc[:-100].sample(frac=1, random_state=1)
+
+    wmat, areas = fta.area_weights(base.pid, weights)
+    assert areas == ['AL', 'CA', 'other', 'US']
+    np.testing.assert_allclose(wmat[:-100, 3], base.s006[:-100])
+    assert (wmat[-100:] == 0).all()
+    wmat, areas = fta.area_weights(base.pid, weights, ['other', 'US'])
+    assert areas == ['other', 'US'] and wmat.shape == (len(base), 2)
+
+    varnames = ['nret', 'iitax']
+    dist = fta.dist_table(store, ['base', 'stacked'], varnames, weights=weights, batch_size=64)
+    aligned = pd.merge(base[['pid']], weights, how='left', on='pid').fillna(0)
+    aligned['US'] = aligned[['AL', 'CA', 'other']].sum(axis=1)
+    compare(dist, {name: frames[name] for name in ['base', 'stacked']}, aligned,
+            ['AL', 'CA', 'other', 'US'], varnames)
+    total = dist.query('reform == "base" & area == "US" & ht2_stub == 0 & variable == "nret"').wsum
+    assert total.item() == pytest.approx(base.s006[:-100].sum())
@@ -0,0 +1,79 @@
+import types
+
+import numpy as np
+import pytest
+
+fbm = pytest.importorskip('functions_reweight_benchmark', exc_type=ImportError)  # needs src.microweight
+
+
+def test_fixture_round_trip(tmp_path):
+    fixture = fbm.synthetic_fixture(200, 8, seed=1)
+    path = str(tmp_path / 'synthetic.npz')
+    fbm.save_fixture(path, fixture['wh'], fixture['xmat'], fixture['targets'],
+                     targvars=fixture['targvars'], name=fixture['name'])
+    loaded = fbm.load_fixture(path)
+    assert loaded['name'] == fixture['name']
+    assert loaded['targvars'] == fixture['targvars']
+    for key in ['wh', 'xmat', 'targets', 'pid']:
+        np.testing.assert_array_equal(loaded[key], fixture[key])
+    assert fbm.load_fixtures(str(tmp_path / 'missing')) == []
+
+
+def test_save_stub_fixtures(pufsub, weights_initial, ptargets, tmp_path):
+    drops = ptargets.iloc[[0]].assign(pufvar=ptargets.columns[1])[['common_stub', 'pufvar']]
+    paths = fbm.save_stub_fixtures(pufsub, weights_initial, ptargets, str(tmp_path), drops=drops)
+    fixtures = fbm.load_fixtures(str(tmp_path))
+    assert [fixture['name'] for fixture in fixtures] == \
+        ['stub_' + str(stub) for stub in sorted(pufsub.common_stub.unique())]
+    assert len(paths) == len(fixtures)
+    ntargets = ptargets.shape[1] - 1
+    for fixture in fixtures:
+        stub = int(fixture['name'][5:])
+        assert fixture['xmat'].shape == ((pufsub.common_stub == stub).sum(), len(fixture['targvars']))
+        assert len(fixture['targvars']) == ntargets - (stub in drops.common_stub.values)
+
+
+def test_options_grid():
+    grid = fbm.options_grid(solver='lsq_sparse', xlb=[0.1, 0.01], penalty=(0.01, 1.0), tol=1e-7)
+    assert len(grid) == 4
+    assert grid[0] == {'solver': 'lsq_sparse', 'xlb': 0.1, 'penalty': 0.01, 'tol': 1e-7}
+
+
+def test_lsq_sparse_penalty():
+    # the penalty keeps g near 1; a smaller penalty hits the targets more closely
+    fixture = fbm.synthetic_fixture(3000, 20, seed=2)
+    bench = fbm.run_benchmark([fixture], fbm.options_grid(solver='lsq_sparse', penalty=[0.01, 1.0]))
+    assert bench.solver.tolist() == ['lsq_sparse', 'lsq_sparse']
+    assert bench.g_q50.tolist() == pytest.approx([1, 1], abs=0.05)
+    assert bench.max_abs_pdiff[0] < bench.max_abs_pdiff[1]
+    assert (bench.g_q0 >= 0.1 - 1e-9).all() and (bench.g_q100 <= 100 + 1e-9).all()
+
+
+class StubMicroweight:
+    # records the reweight calls; lsq results carry lsq_linear's nit, ipopt
+    # results cyipopt's info dict, which has no iteration count
+    calls = []
+
+    def __init__(self, wh, xmat, targets):
+        self.n = wh.size
+
+    def reweight(self, method, options):
+        StubMicroweight.calls.append((method, options))
+        method_result = (types.SimpleNamespace(nit=7) if method == 'lsq'
+                         else {'status': 0, 'status_msg': b'ok', 'obj_val': 0.0})
+        return types.SimpleNamespace(g=np.ones(self.n), method_result=method_result)
+
+
+def test_benchmark_grid_microweight(monkeypatch):
+    # the grid the __main__ block runs, for microweight's solvers and the
+    # sparse lsq; lsq's method option is lsq_linear's, not microweight's
+    monkeypatch.setattr(fbm, 'mw', types.SimpleNamespace(Microweight=StubMicroweight))
+    monkeypatch.setattr(StubMicroweight, 'calls', [])
+    grid = [opts for opts in fbm.benchmark_grid() if opts['solver'] != 'ipopt_sparse']
+    bench = fbm.run_benchmark([fbm.synthetic_fixture(300, 5, seed=3)], grid)
+    assert bench.solver.tolist() == ['ipopt', 'lsq', 'lsq_sparse', 'lsq_sparse', 'lsq_sparse', 'lsq_sparse']
+    assert [call[0] for call in StubMicroweight.calls] == ['ipopt', 'lsq']
+    assert StubMicroweight.calls[1][1]['method'] == 'bvls'
+    assert np.isnan(bench.iterations[0])
+    assert bench.iterations[1] == 7
+    assert bench.iterations[2:].notna().all()
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+import scipy.sparse as sps
+
+rwi = pytest.importorskip('functions_reweight_ipopt', exc_type=ImportError)  # needs cyipopt
+
+
+@pytest.fixture(scope='module')
+def stub():
+    # a stub-sized problem with zeros in xmat and targets a few % off the
+    # initial weighted sums
+    rng = np.random.default_rng(0)
+    n, m = 400, 6
+    xmat = rng.lognormal(3, 1, (n, m)) * (rng.random((n, m)) > .4)
+    wh = rng.random(n) * 100 + 10
+    targets = (xmat * wh.reshape(-1, 1)).sum(axis=0) * rng.uniform(.95, 1.05, m)
+    return wh, xmat, targets
+
+
+def test_get_ccscale():
+    cc = np.array([[1., 0., 4.], [3., 0., 2.], [2., 0., 9.]])
+    np.testing.assert_allclose(rwi.get_ccscale(cc), [1 / 2, 1, 1 / 5])
+    np.testing.assert_allclose(rwi.get_ccscale(cc, ccgoal=10, method='median'), [10 / 2, 1, 10 / 4])
+    with pytest.raises(ValueError):
+        rwi.get_ccscale(cc, method='max')
+
+
+@pytest.mark.parametrize('ccscale', ['mean', 'median', None])
+def test_callbacks(stub, ccscale):
+    wh, xmat, targets = stub
+    cb = rwi.ReweightCallbacks(wh, xmat, targets, crange=0.01, ccscale=ccscale)
+    cc = (xmat * wh.reshape(-1, 1)) * cb.ccscale
+    if ccscale == 'mean':
+        np.testing.assert_allclose(cc.mean(axis=0), 1)
+
+    x = np.random.default_rng(1).uniform(0.5, 2, cb.n)
+    rows, cols = cb.jacobianstructure()
+    jac = sps.coo_matrix((cb.jacobian(x), (rows, cols)), shape=(cb.m, cb.n)).toarray()
+    np.testing.assert_allclose(jac, cc.T)
+    assert rows.size == np.count_nonzero(xmat)
+    np.testing.assert_allclose(cb.constraints(x), cc.T @ x)
+    np.testing.assert_allclose(cb.cu - cb.cl, 2 * 0.01 * np.abs(targets * cb.ccscale))
+
+    assert cb.objective(x) == pytest.approx(np.sum((x - 1)**2))
+    np.testing.assert_allclose(cb.gradient(x), 2 * (x - 1))
+    rows, cols = cb.hessianstructure()
+    hess = sps.coo_matrix((cb.hessian(x, None, 0.5), (rows, cols)), shape=(cb.n, cb.n)).toarray()
+    np.testing.assert_allclose(hess, np.eye(cb.n))
+
+
+def test_ipopt_reweight(stub):
+    wh, xmat, targets = stub
+    res = rwi.ipopt_reweight(wh, xmat, targets, xlb=0.1, xub=100, crange=0.001, max_iter=300)
+    assert np.abs(res.pdiff).max() <= 0.1 + 1e-6
+    assert res.g.min() >= 0.1 - 1e-9 and res.g.max() <= 100 + 1e-9
+    assert len(res.iterations) > 0
+    assert {'iter', 'obj', 'inf_pr', 'seconds'} <= set(res.iterations.columns)
@@ -0,0 +1,147 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+rwp = pytest.importorskip('functions_reweight_puf', exc_type=ImportError)  # needs src.microweight
+
+
+def target_names(ptargets):
+    names = ptargets.columns.tolist()
+    names.remove('common_stub')
+    return names
+
+
+def wtdsums_merge_update(pufsub, sumvars, weightdf, stubvar='common_stub'):
+    # the merge + df.update + groupby path get_wtdsums replaced
+    df = pd.merge(pufsub.drop(columns='weight', errors='ignore'),
+                  weightdf.iloc[:, [0, 1]].set_axis(['pid', 'weight'], axis=1),
+                  how='left', on='pid')
+    df[sumvars] = df[sumvars].astype(float)  # the compact dtypes would not take the products
+    df.update(df.loc[:, sumvars].multiply(df.weight, axis=0))
+    dfsums = df.groupby(stubvar)[sumvars].sum().reset_index()
+    grand_sums = dfsums[sumvars].sum().to_frame().transpose()
+    grand_sums[stubvar] = 0
+    dfsums = pd.concat([dfsums, grand_sums], ignore_index=True)
+    return dfsums.sort_values(by=stubvar).set_index(stubvar, drop=False)
+
+
+def test_wtdsums_matches_merge_update(pufsub, weights_initial, ptargets):
+    names = target_names(ptargets)
+    expected = wtdsums_merge_update(pufsub, names, weights_initial)
+    result = rwp.get_wtdsums(pufsub, names, weights_initial)
+    assert result.index.tolist() == expected.index.tolist()
+    np.testing.assert_allclose(result[names].to_numpy(), expected[names].to_numpy(dtype=float),
+                               rtol=1e-9)
+
+
+def test_wtdsums_missing_weights_are_zero(pufsub, weights_initial, ptargets):
+    # records without a weight count as 0 (the old path kept their
+    # unweighted values)
+    names = target_names(ptargets)
+    dropped = weights_initial.pid.isin(pufsub.pid.iloc[::10])
+    result = rwp.get_wtdsums(pufsub, names, weights_initial[~dropped])
+    keep = ~pufsub.pid.isin(weights_initial.pid[dropped])
+    expected = rwp.get_wtdsums(pufsub[keep], names, weights_initial)
+    np.testing.assert_allclose(result.loc[0, names], expected.loc[0, names], rtol=1e-9)
+
+
+def test_wtdsums_multi_matches_single(pufsub, weights_initial, ptargets):
+    names = target_names(ptargets)
+    wide = weights_initial[['pid', 'weight']].assign(half=weights_initial.weight / 2)
+    multi = rwp.get_wtdsums_multi(pufsub, names, wide, stubvars=('common_stub',))
+    single = rwp.get_wtdsums(pufsub, names, weights_initial)
+    pd.testing.assert_frame_equal(multi['common_stub']['weight'], single)
+    np.testing.assert_allclose(multi['common_stub']['half'][names], single[names] / 2)
+
+
+@pytest.fixture(scope='module')
+def drops(ptargets):
+    # like drops_ipopt in puf_runall.py: variable-stub combinations not targeted
+    names = target_names(ptargets)
+    return pd.DataFrame({'common_stub': [1, 2, 2, 5], 'pufvar': [names[1], names[2], names[3], names[1]]})
+
+
+@pytest.mark.parametrize('use_drops', [False, True])
+def test_puf_reweight_parallel_matches_serial(pufsub, weights_initial, ptargets, drops, use_drops):
+    drops = drops if use_drops else None
+    pufsub = pufsub.iloc[::5]  # small stubs, the solver time is not the point here
+    serial = rwp.puf_reweight(pufsub, weights_initial, ptargets, method='lsq', drops=drops)
+    parallel = rwp.puf_reweight(pufsub, weights_initial, ptargets, method='lsq', drops=drops,
+                                workers=2)
+    pd.testing.assert_frame_equal(parallel, serial)
+
+
+def test_wtdsums_empty(pufsub, weights_initial, ptargets):
+    names = target_names(ptargets)
+    sums = rwp.wtdsums_engine(np.empty((0, 3)), np.empty((0, 2)), {'common_stub': np.empty(0)})
+    np.testing.assert_array_equal(sums['common_stub'], np.zeros((2, 1, 3)))
+    result = rwp.get_wtdsums(pufsub.iloc[:0], names, weights_initial)
+    assert result.common_stub.tolist() == [0]
+    assert (result[names] == 0).all(axis=None)
+
+
+def pdiff_order(df):
+    cols = ['common_stub', 'pufvar', 'puf', 'target', 'diff', 'pdiff', 'abspdiff']
+    return df[cols].sort_values(['common_stub', 'pufvar']).reset_index(drop=True)
+
+
+def test_pctdiffs_multi_matches_single(pufsub, weights_initial, ptargets):
+    wide = weights_initial[['pid', 'weight']].assign(half=weights_initial.weight / 2)
+    multi = rwp.get_pctdiffs_multi(pufsub, wide, ptargets)
+    assert multi.weight_name.unique().tolist() == ['weight', 'half']
+    for wname in ['weight', 'half']:
+        single = rwp.get_pctdiffs(pufsub, wide[['pid', wname]], ptargets)
+        pd.testing.assert_frame_equal(pdiff_order(multi[multi.weight_name == wname]),
+                                      pdiff_order(single), check_dtype=False)
+
+
+def test_target_tracker_matches_pctdiffs(pufsub, weights_initial, ptargets):
+    tracker = rwp.TargetTracker(pufsub, weights_initial, ptargets)
+    pd.testing.assert_frame_equal(pdiff_order(tracker.pdiffs()),
+                                  pdiff_order(rwp.get_pctdiffs(pufsub, weights_initial, ptargets)),
+                                  check_dtype=False)
+
+    # change a tenth of the weights, in two updates
+    pids = pufsub.pid.iloc[::10].to_numpy()
+    new = weights_initial[['pid', 'weight']].copy()
+    changed = new.pid.isin(pids)
+    new.loc[changed, 'weight'] *= np.linspace(0.5, 2, changed.sum())
+    newvals = new.set_index('pid').weight.loc[pids].to_numpy()
+    half = pids.size // 2
+    tracker.update(pids[:half], newvals[:half])
+    tracker.update(pids[half:], newvals[half:])
+    expected = pdiff_order(rwp.get_pctdiffs(pufsub, new, ptargets))
+    pd.testing.assert_frame_equal(pdiff_order(tracker.pdiffs()), expected, check_dtype=False,
+                                  rtol=1e-9)
+    tracker.recompute()
+    pd.testing.assert_frame_equal(pdiff_order(tracker.pdiffs()), expected, check_dtype=False,
+                                  rtol=1e-9)
+
+    with pytest.raises(ValueError):
+        tracker.update([-1], [1.0])
+
+
+def test_prep_puf_cached(tcout, ptargets, tmp_path, capsys):
+    puf_path = str(tmp_path / 'puf.parquet')
+    tcout.to_parquet(puf_path)
+    cachedir = str(tmp_path / 'cache')
+    first = rwp.prep_puf_cached(puf_path, ptargets, cachedir)
+    pd.testing.assert_frame_equal(first.reset_index(drop=True),
+                                  rwp.prep_puf(tcout, ptargets).reset_index(drop=True))
+    assert 'saving to cache' in capsys.readouterr().out
+
+    again = rwp.prep_puf_cached(puf_path, ptargets, cachedir)
+    assert 'loading cached' in capsys.readouterr().out
+    pd.testing.assert_frame_equal(again, first)
+
+    # a changed target list or source file gets its own entry
+    fewer = ptargets.drop(columns=target_names(ptargets)[-1])
+    rwp.prep_puf_cached(puf_path, fewer, cachedir)
+    assert 'saving to cache' in capsys.readouterr().out
+    tcout.iloc[::2].to_parquet(puf_path)
+    changed = rwp.prep_puf_cached(puf_path, ptargets, cachedir)
+    assert 'saving to cache' in capsys.readouterr().out
+    assert len(changed) < len(first)
+    assert len([s for s in os.listdir(cachedir) if s.startswith('pufsub_')]) == 3
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import functions_synthetic_puf as sp
+import puf_constants as pc
+
+
+def test_chunks_fix_the_file():
+    a = sp.synthetic_tcout(3000, seed=4, chunksize=1000)
+    pd.testing.assert_frame_equal(sp.synthetic_tcout(3000, seed=4, chunksize=1000), a)
+    assert not a.equals(sp.synthetic_tcout(3000, seed=5, chunksize=1000))
+    assert a.pid.tolist() == list(range(3000))
+
+
+def test_puf_schema():
+    puf = sp.synthetic_puf(2000, seed=4, chunksize=700)
+    assert puf.columns.tolist() == pc.pufvars.pufvar.tolist()
+    assert puf.RECID.tolist() == list(range(1, 2001))
+    assert (puf.MARS.isin([1, 2, 3, 4])).all()
+    assert (puf.s006 > 0).all()
+    weights = sp.tc_weights(puf, years=[2017, 2018])
+    assert weights.columns.tolist() == ['WT2017', 'WT2018']
+    np.testing.assert_array_equal(weights.WT2018, puf.s006.round())
+
+
+def test_tcout_schema(tcout):
+    expected = list(dict.fromkeys(pc.TC_PROFILES['reweight'] + ['RECID', 'pid', 'filer']))
+    assert sorted(tcout.columns) == sorted(expected)
+    assert tcout.filer.dtype == bool
+    weights = sp.synthetic_weights(tcout)
+    assert weights.columns.tolist() == ['pid', 'weight', 'shortname']
+
+
+@pytest.mark.parametrize('ext', ['parquet', 'csv'])
+@pytest.mark.parametrize('kind', ['tcout', 'puf'])
+def test_write_synthetic(kind, ext, tmp_path):
+    path = sp.write_synthetic(str(tmp_path / ('synthetic.' + ext)), 2500, kind=kind, seed=6,
+                              chunksize=1000)
+    written = pd.read_parquet(path) if ext == 'parquet' else pd.read_csv(path)
+    expected = sp.synthetic_chunks(2500, kind, seed=6, chunksize=1000)
+    pd.testing.assert_frame_equal(written, pd.concat(expected, ignore_index=True),
+                                  check_dtype=ext == 'parquet')
+
+
+def test_calibrated_to_targets(pufsub, weights_initial, ptargets):
+    # the weighted totals are near the IRS totals before any reweighting
+    rwp = pytest.importorskip('functions_reweight_puf', exc_type=ImportError)
+    names = ['nret_all', 'c00100', 'e00200']
+    sums = rwp.get_wtdsums(pufsub, names, weights_initial)
+    np.testing.assert_allclose(sums.loc[0, names].to_numpy(dtype=float),
+                               ptargets.loc[0, names].to_numpy(dtype=float), rtol=0.1)
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import functions_synthetic_puf as sp
+
+tc = pytest.importorskip('taxcalc')
+fta = pytest.importorskip('functions_tax_analysis', exc_type=ImportError)  # needs src.microweight
+
+NRECS = 2000
+REFORMS = {'base': {},
+           'sd': {'STD': {'2018': [12000, 24000, 12000, 18000, 24000]}},
+           'salt': {'ID_AllTaxes_c': {'2018': [10000.0, 10000.0, 5000.0, 10000.0, 10000.0]}},
+           'rate': {'II_rt3': {'2018': 0.22}}}
+
+
+@pytest.fixture(scope='module')
+def puf2018():
+    puf = sp.synthetic_puf(NRECS, seed=3)
+    puf['FLPDYR'] = 2018
+    return puf
+
+
+@pytest.fixture(scope='module')
+def recs(puf2018):
+    return tc.Records(data=puf2018, start_year=2018,
+                      weights=sp.tc_weights(puf2018, years=range(2018, tc.Policy.LAST_BUDGET_YEAR + 1)),
+                      adjust_ratios=None)
+
+
+@pytest.fixture(scope='module')
+def pidfiler():
+    return pd.DataFrame({'pid': np.arange(NRECS), 'filer': True})
+
+
+def direct_frame(reform_list, recs, pidfiler):
+    # the output of a Calculator run on the reforms, implemented in order
+    pol = tc.Policy()
+    for reform in reform_list:
+        pol.implement_reform(reform)
+    calc = tc.Calculator(policy=pol, records=recs)
+    calc.calc_all()
+    return calc.weighted_total('iitax') / 1e9, fta.prep_tcout(calc, pidfiler)
+
+
+def test_run_reform_batch_matches_direct_runs(recs, pidfiler, tmp_path):
+    names = ['sd', 'salt', 'rate']
+    timings = fta.run_reform_batch(names, 'base', REFORMS, recs, pidfiler, str(tmp_path / 'solo'),
+                                   workers=2)
+    assert timings.reform.tolist() == names
+    assert not timings.cached.any()
+    store = fta.ReformStore(str(tmp_path / 'solo'))
+    wsum_base, df_base = direct_frame([REFORMS['base']], recs, pidfiler)
+    pd.testing.assert_frame_equal(store.frame('base'), df_base)
+    for row in timings.itertuples():
+        wsum, df = direct_frame([REFORMS['base'], REFORMS[row.reform]], recs, pidfiler)
+        assert row.iitax == pytest.approx(wsum)
+        assert row.iitax_change == pytest.approx(wsum - wsum_base)
+        pd.testing.assert_frame_equal(store.frame(row.reform + '_vs_base'), df)
+
+
+def test_merge_reforms():
+    merged = fta.merge_reforms([{'a': {'2017': 1, '2019': 3}}, {'a': {2018: 2}}, {'b': {'2018': 5}}])
+    assert merged == {'a': {'2017': 1, '2018': 2}, 'b': {'2018': 5}}
+
+
+def test_records_key(puf2018):
+    key = fta.records_key(puf2018, None, 2018)
+    assert key == fta.records_key(puf2018.copy(), None, 2018)
+    assert key != fta.records_key(puf2018.assign(s006=puf2018.s006 + 1), None, 2018)
+    assert key != fta.records_key(puf2018, None, 2019)
+
+
+def test_reform_cache_reruns_nothing(recs, pidfiler, tmp_path):
+    names = ['sd', 'salt']
+    cache = fta.ReformCache(str(tmp_path / 'cache'))
+    first = fta.run_reform_batch(names, 'base', REFORMS, recs, pidfiler, str(tmp_path / 'solo'),
+                                 workers=2, cache=cache, recs_key='synthetic')
+    # a new session: the cache index is read from disk
+    cache = fta.ReformCache(str(tmp_path / 'cache'))
+    assert len(cache.index) == 3
+    second = fta.run_reform_batch(names + ['rate'], 'base', REFORMS, recs, pidfiler,
+                                  str(tmp_path / 'solo2'), workers=2, cache=cache,
+                                  recs_key='synthetic')
+    assert second.cached.tolist() == [True, True, False]
+    np.testing.assert_allclose(second.iitax[:2], first.iitax)
+    store, store2 = fta.ReformStore(str(tmp_path / 'solo')), fta.ReformStore(str(tmp_path / 'solo2'))
+    for name in names:
+        pd.testing.assert_frame_equal(store2.frame(name + '_vs_base'), store.frame(name + '_vs_base'))
+
+    # the same policy, reached another way, is the same entry
+    key = cache.key([REFORMS['base'], REFORMS['sd']], 'synthetic', 2018)
+    assert key == cache.key([REFORMS['sd']], 'synthetic', 2018)
+    assert key != cache.key([REFORMS['sd']], 'other records', 2018)
+    assert key in cache
+
+
+def test_reform_cache_evicts_least_recently_used(tmp_path):
+    cache = fta.ReformCache(str(tmp_path / 'cache'))
+    df = pd.DataFrame({'x': np.arange(1000.0)})
+    for key in ['a', 'b', 'c']:
+        cache.save(key, df, 1.0)
+    cache.load('a')  # now b is the least recently used
+    cache.max_bytes = cache.nbytes - 1
+    cache.evict()
+    assert sorted(cache.index) == ['a', 'c']
+    assert 'b' not in cache
+    cache.max_bytes = 0
+    cache.save('d', df, 2.0)  # the entry just added is kept
+    assert list(cache.index) == ['d']
+    assert fta.ReformCache(str(tmp_path / 'cache')).load('d')[1] == 2.0
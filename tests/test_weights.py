@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import functions_weights as fw
+
+
+@pytest.fixture
+def weightdf():
+    rng = np.random.default_rng(5)
+    n = 1000
+    return pd.DataFrame({'pid': rng.permutation(n) + 10,
+                         'weight': rng.uniform(1, 500, n),
+                         'ht2_stub': rng.integers(1, 11, n),
+                         'NY': rng.uniform(0, 50, n),
+                         'shortname': 'geo_test'})
+
+
+def test_weight_store_round_trip(weightdf, tmp_path):
+    base = str(tmp_path / 'weights2017_test')
+    wm = fw.save_weights(weightdf, base, provenance={'method': 'lsq'})
+    assert fw.weights_exist(base)
+
+    wm = fw.load_weights(base)
+    assert isinstance(wm.values, np.memmap) and np.isfortran(wm.values)
+    assert len(wm) == len(weightdf)
+    assert wm.shortname == 'geo_test'
+    assert wm.meta['provenance'] == {'method': 'lsq'}
+    np.testing.assert_array_equal(wm.col('NY'), weightdf.NY)
+    pd.testing.assert_frame_equal(wm.frame(), weightdf.drop(columns='shortname'))
+    pd.testing.assert_frame_equal(wm.frame(['ht2_stub']), weightdf[['pid', 'ht2_stub']])
+
+
+def test_csv_to_weights(weightdf, tmp_path):
+    csvpath = str(tmp_path / 'weights2017_test.csv')
+    weightdf.to_csv(csvpath, index=None)
+    wm = fw.csv_to_weights(csvpath)
+    assert wm.base == str(tmp_path / 'weights2017_test')
+    assert wm.meta['provenance'] == {'source': 'weights2017_test.csv'}
+    pd.testing.assert_frame_equal(wm.frame(), weightdf.drop(columns='shortname'))
+
+
+def test_scale_weights(weightdf, tmp_path):
+    base = str(tmp_path / 'weights2017_test')
+    newbase = str(tmp_path / 'weights2018_test')
+    fw.save_weights(weightdf, base)
+    wm = fw.scale_weights(base, newbase, 1.02)
+    expected = weightdf.drop(columns='shortname').assign(weight=weightdf.weight * 1.02,
+                                                          NY=weightdf.NY * 1.02)
+    pd.testing.assert_frame_equal(wm.frame(), expected)
+    assert np.isfortran(wm.values)
+    assert wm.meta['provenance']['scaled_columns'] == ['weight', 'NY']
+    assert os.path.basename(base) == wm.meta['provenance']['scaled_from']
+
+
+def test_weight_registry(weightdf, tmp_path):
+    weightdir = str(tmp_path) + '/'
+    national = weightdf[['pid', 'weight', 'shortname']]
+    national.to_csv(weightdir + 'weights2017_test.csv', index=None)
+    fw.save_weights(national, weightdir + 'weights2017_test')  # preferred to the csv
+    reweighted = national.iloc[::2].assign(weight=national.weight.iloc[::2] * 2, shortname='rwt')
+    reweighted.to_csv(weightdir + 'weights2017_rwt.csv', index=None)
+    weightdf.to_csv(weightdir + 'allweights2017_geo.csv', index=None)
+
+    reg = fw.WeightRegistry(weightdir)
+    assert reg.index.name.tolist() == ['allweights2017_geo', 'weights2017_rwt', 'weights2017_test']
+    assert reg.index.loc['weights2017_test', 'format'] == 'store'
+    assert reg.select(states=False).name.tolist() == ['weights2017_rwt', 'weights2017_test']
+    assert reg.loaded == []
+
+    wide = reg.wide()
+    expected = (pd.merge(national[['pid', 'weight']], reweighted[['pid', 'weight']],
+                         on='pid', how='left', suffixes=('_test', '_rwt'))
+                .set_axis(['pid', 'geo_test', 'rwt'], axis=1)
+                .sort_values('pid', ignore_index=True))
+    pd.testing.assert_frame_equal(wide, expected[['pid', 'rwt', 'geo_test']])
+    assert len(reg.long()) == len(national) + len(reweighted)
+
+    frame = reg.frame('allweights2017_geo')
+    pd.testing.assert_frame_equal(frame, weightdf.drop(columns='shortname')
+                                  .sort_values('pid', ignore_index=True))
+    with pytest.raises(KeyError):
+        reg.name('geo_test')  # the shortname of two sets